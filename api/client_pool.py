@@ -0,0 +1,157 @@
+# api/client_pool.py
+
+"""
+进程级 OpenAI 客户端注册表
+
+同一进程内按 (base_url, api_key) 复用客户端及其底层连接池，
+避免每个会话、每次"开始新对话"都重新建立 TCP+TLS 连接。
+
+openai 和 httpx 的导入耗时较长，推迟到第一次创建客户端时才导入，
+导入本模块不会拖慢界面首屏。
+"""
+import asyncio
+import logging
+import threading
+import weakref
+from typing import TYPE_CHECKING, Dict, Tuple, Optional
+
+if TYPE_CHECKING:
+    from openai import OpenAI, AsyncOpenAI
+
+logger = logging.getLogger(__name__)
+
+# 连接池默认参数
+DEFAULT_POOL_CONFIG = {
+    "max_connections": 100,
+    "max_keepalive_connections": 20,
+    "keepalive_expiry": 120.0,
+    "http2": False,
+    "timeout": 600.0,
+}
+
+_clients: "Dict[Tuple[str, str], OpenAI]" = {}
+_warmed = set()
+_lock = threading.Lock()
+
+# 异步客户端绑定在创建它的事件循环上，因此按事件循环分别维护
+_async_clients: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, Dict[Tuple[str, str], AsyncOpenAI]]" = \
+    weakref.WeakKeyDictionary()
+
+
+def _http2_available() -> bool:
+    """HTTP/2 需要额外安装 h2 包（pip install httpx[http2]）"""
+    try:
+        import h2  # noqa: F401
+        return True
+    except ImportError:
+        return False
+
+
+def _http_client_kwargs(pool_config: Dict) -> Dict:
+    """根据连接池配置生成 httpx 客户端参数（同步/异步通用）"""
+    import httpx
+
+    config = dict(DEFAULT_POOL_CONFIG)
+    config.update(pool_config or {})
+    http2 = config["http2"]
+    if http2 and not _http2_available():
+        logger.warning("未安装 h2，HTTP/2 已回退为 HTTP/1.1")
+        http2 = False
+    limits = httpx.Limits(
+        max_connections=config["max_connections"],
+        max_keepalive_connections=config["max_keepalive_connections"],
+        keepalive_expiry=config["keepalive_expiry"],
+    )
+    return {"limits": limits, "http2": http2, "timeout": config["timeout"]}
+
+
+def get_client(api_key: str, base_url: str, pool_config: Optional[Dict] = None) -> "OpenAI":
+    """
+    获取（或创建）共享的 OpenAI 客户端。
+    连接池参数只在首次创建时生效，之后同一 (base_url, api_key) 复用已有客户端。
+    """
+    key = (base_url, api_key)
+    client = _clients.get(key)
+    if client is not None:
+        return client
+
+    with _lock:
+        client = _clients.get(key)
+        if client is None:
+            import httpx
+            from openai import OpenAI
+
+            client = OpenAI(
+                api_key=api_key,
+                base_url=base_url,
+                http_client=httpx.Client(**_http_client_kwargs(pool_config))
+            )
+            _clients[key] = client
+            logger.info(f"已创建共享API客户端: {base_url}")
+    return client
+
+
+def get_async_client(api_key: str, base_url: str, pool_config: Optional[Dict] = None) -> "AsyncOpenAI":
+    """
+    获取当前事件循环内共享的 AsyncOpenAI 客户端。
+    必须在运行中的事件循环里调用；事件循环结束后对应的客户端随之释放。
+    """
+    loop = asyncio.get_running_loop()
+    key = (base_url, api_key)
+    with _lock:
+        loop_clients = _async_clients.setdefault(loop, {})
+        client = loop_clients.get(key)
+        if client is None:
+            import httpx
+            from openai import AsyncOpenAI
+
+            client = AsyncOpenAI(
+                api_key=api_key,
+                base_url=base_url,
+                http_client=httpx.AsyncClient(**_http_client_kwargs(pool_config))
+            )
+            loop_clients[key] = client
+            logger.info(f"已创建共享异步API客户端: {base_url}")
+    return client
+
+
+def prewarm(api_key: str, base_url: str, pool_config: Optional[Dict] = None, background: bool = True):
+    """
+    预热连接：提前完成 DNS、TCP 和 TLS 握手，让首条消息直接复用热连接。
+    每个 (base_url, api_key) 在进程内只预热一次；失败只记录日志，不影响正常使用。
+    """
+    def _warm():
+        try:
+            get_client(api_key, base_url, pool_config).models.list()
+            logger.info(f"API连接预热完成: {base_url}")
+        except Exception as e:
+            logger.warning(f"API连接预热失败: {e}")
+
+    if not api_key:
+        return
+    key = (base_url, api_key)
+    with _lock:
+        if key in _warmed:
+            return
+        _warmed.add(key)
+    if background:
+        threading.Thread(target=_warm, name="api-prewarm", daemon=True).start()
+    else:
+        _warm()
+
+
+def close_all():
+    """关闭所有共享的同步客户端（主要用于测试和进程退出）"""
+    with _lock:
+        for client in _clients.values():
+            client.close()
+        _clients.clear()
+        _warmed.clear()
+
+
+async def aclose_all():
+    """关闭当前事件循环内所有共享的异步客户端"""
+    with _lock:
+        loop_clients = _async_clients.pop(asyncio.get_running_loop(), {})
+    for client in loop_clients.values():
+        await client.close()
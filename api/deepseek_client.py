@@ -3,27 +3,121 @@
 """
 DeepSeek API 客户端
 """
-from openai import OpenAI
+from api.client_pool import get_client, get_async_client
+from api.response_cache import ResponseCache
+from utils.token_counter import count_tokens
+import asyncio
 import logging
 import time
-from typing import List, Dict, Optional, Any, Generator
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from dataclasses import dataclass
+from typing import List, Dict, Optional, Any, Generator, AsyncGenerator
 
 logger = logging.getLogger(__name__)
 
+
+@dataclass
+class ChatResult:
+    """批量请求中单个请求的结果，失败时 error 非空"""
+    index: int
+    content: Optional[str] = None
+    error: Optional[Exception] = None
+
+    @property
+    def ok(self) -> bool:
+        return self.error is None
+
+
+# 流式事件类型：推理过程（deepseek-reasoner 的 reasoning_content）和正式回答
+REASONING = "reasoning"
+CONTENT = "content"
+
+
+@dataclass
+class StreamEvent:
+    """流式输出中的一段增量文本，kind 区分推理过程和正式回答"""
+    kind: str
+    text: str
+
+
+def _delta_events(chunk) -> List[StreamEvent]:
+    """从一个流式数据块中提取推理和回答增量"""
+    if not chunk.choices or not chunk.choices[0].delta:
+        return []
+    delta = chunk.choices[0].delta
+    events = []
+    reasoning = getattr(delta, "reasoning_content", None)
+    if reasoning:
+        events.append(StreamEvent(REASONING, reasoning))
+    if delta.content:
+        events.append(StreamEvent(CONTENT, delta.content))
+    return events
+
+
+# 推理阶段中断、尚无正式回答时需要重新推理，在推理通道中插入此提示
+REASONING_RESTART_NOTICE = "\n\n*（连接中断，重新推理）*\n\n"
+
+# 从 usage 中读取的字段；prompt_cache_* 为 DeepSeek 上下文缓存的命中/未命中token数
+USAGE_FIELDS = ("prompt_tokens", "completion_tokens", "total_tokens",
+                "prompt_cache_hit_tokens", "prompt_cache_miss_tokens")
+
+
+def _usage_to_dict(usage) -> Dict[str, int]:
+    """把 SDK 返回的 usage 对象转换为普通字典，缺失的字段记为0"""
+    if usage is None:
+        return {}
+    result = {field: getattr(usage, field, None) or 0 for field in USAGE_FIELDS}
+    details = getattr(usage, "completion_tokens_details", None)
+    result["reasoning_tokens"] = getattr(details, "reasoning_tokens", None) or 0
+    return result
+
+
+# 续写时至少保留的输出 token 数
+MIN_RESUME_TOKENS = 256
+
+
+def prefix_completion_base_url(base_url: str) -> str:
+    """DeepSeek 的对话前缀续写（assistant prefix）只在 beta 端点上提供"""
+    url = base_url.rstrip("/")
+    if "api.deepseek.com" in url and not url.endswith("/beta"):
+        return url + "/beta"
+    return url
+
+
+def _continuation_params(params: Dict[str, Any], partial: str) -> Dict[str, Any]:
+    """
+    构建续写请求：把已生成的部分作为 assistant 前缀，让模型只生成缺失的尾部。
+    max_tokens 相应扣除已生成的部分。
+    """
+    resumed = dict(params)
+    resumed["messages"] = list(params["messages"]) + [
+        {"role": "assistant", "content": partial, "prefix": True}
+    ]
+    if params.get("max_tokens"):
+        resumed["max_tokens"] = max(params["max_tokens"] - count_tokens(partial), MIN_RESUME_TOKENS)
+    return resumed
+
+
 class DeepSeekClient:
     """DeepSeek API 客户端封装"""
 
-    def __init__(self, api_key: str, base_url: str, model_name: str, max_retries: int = 3, retry_delay: int = 1):
+    def __init__(self, api_key: str, base_url: str, model_name: str, max_retries: int = 3, retry_delay: int = 1,
+                 pool_config: Optional[Dict[str, Any]] = None, cache: Optional[ResponseCache] = None):
         """
         初始化客户端，接收所有必要的配置。
+        底层 OpenAI 客户端来自进程级注册表，相同 (base_url, api_key) 共享连接池。
+        传入 cache 时，完全相同的请求直接返回缓存的回复。
         """
-        self.client = OpenAI(
-            api_key=api_key,
-            base_url=base_url
-        )
+        self.client = get_client(api_key, base_url, pool_config)
+        self.api_key = api_key
+        self.base_url = base_url
+        self.pool_config = pool_config
         self.model = model_name
         self.max_retries = max_retries
         self.retry_delay = retry_delay
+        self.cache = cache
+        # 最近一次请求的 token 用量（缓存命中时为空字典）
+        self.last_usage: Dict[str, int] = {}
 
     def chat(self, messages: List[Dict[str, str]], stream: bool = False, **kwargs) -> str:
         """
@@ -32,10 +126,22 @@ class DeepSeekClient:
         """
         params = self._build_params(messages, stream=False, **kwargs)
 
+        self.last_usage = {}
+        cache_key = None
+        if self.cache is not None:
+            cache_key = self.cache.make_key(params)
+            cached = self.cache.get(cache_key)
+            if cached is not None:
+                return cached
+
         for attempt in range(self.max_retries):
             try:
                 response = self.client.chat.completions.create(**params)
-                return response.choices[0].message.content
+                self.last_usage = _usage_to_dict(response.usage)
+                content = response.choices[0].message.content
+                if cache_key is not None and content:
+                    self.cache.set(cache_key, content)
+                return content
             except Exception as e:
                 logger.warning(f"API调用失败 (尝试 {attempt + 1}/{self.max_retries}): {e}")
                 if attempt < self.max_retries - 1:
@@ -46,17 +152,60 @@ class DeepSeekClient:
 
     def chat_stream(self, messages: List[Dict[str, str]], **kwargs) -> Generator[str, None, None]:
         """
-        流式聊天请求。
+        流式聊天请求，只产出正式回答文本。
+        kwargs: temperature, max_tokens, top_p, 等模型参数
+        """
+        for event in self.chat_stream_events(messages, **kwargs):
+            if event.kind == CONTENT:
+                yield event.text
+
+    def chat_stream_events(self, messages: List[Dict[str, str]], **kwargs) -> Generator[StreamEvent, None, None]:
+        """
+        流式聊天请求，推理过程和正式回答分别作为 REASONING / CONTENT 事件产出。
+        流中途断开时不会从头重新生成，而是以已输出的回答为前缀续写，
+        调用方收到的文本没有重复。
         kwargs: temperature, max_tokens, top_p, 等模型参数
         """
         params = self._build_params(messages, stream=True, **kwargs)
+        # 让服务端在最后一个数据块中返回 usage
+        params.setdefault("stream_options", {"include_usage": True})
+
+        self.last_usage = {}
+        cache_key = None
+        if self.cache is not None:
+            cache_key = self.cache.make_key(params)
+            cached = self.cache.get(cache_key)
+            if cached is not None:
+                for text in self.cache.replay(cached):
+                    yield StreamEvent(CONTENT, text)
+                return
 
+        parts = []
+        reasoned = False
         for attempt in range(self.max_retries):
             try:
-                response_stream = self.client.chat.completions.create(**params)
+                if parts:
+                    # 已有部分输出：续写缺失的尾部，而不是重新生成整个回答
+                    logger.info(f"从第 {sum(len(p) for p in parts)} 个字符处续写中断的流")
+                    response_stream = self._prefix_client().chat.completions.create(
+                        **_continuation_params(params, "".join(parts))
+                    )
+                else:
+                    if reasoned:
+                        yield StreamEvent(REASONING, REASONING_RESTART_NOTICE)
+                    response_stream = self.client.chat.completions.create(**params)
                 for chunk in response_stream:
-                    if chunk.choices and chunk.choices[0].delta and chunk.choices[0].delta.content:
-                        yield chunk.choices[0].delta.content
+                    if getattr(chunk, "usage", None):
+                        self.last_usage = _usage_to_dict(chunk.usage)
+                    for event in _delta_events(chunk):
+                        if event.kind == CONTENT:
+                            parts.append(event.text)
+                        else:
+                            reasoned = True
+                        yield event
+                # 只缓存完整结束的回复
+                if cache_key is not None and parts:
+                    self.cache.set(cache_key, "".join(parts))
                 return # 成功完成，退出重试循环
             except Exception as e:
                 logger.warning(f"流式API调用失败 (尝试 {attempt + 1}/{self.max_retries}): {e}")
@@ -66,6 +215,48 @@ class DeepSeekClient:
                     logger.error(f"流式API调用最终失败: {e}")
                     raise
 
+    def _prefix_client(self):
+        """用于前缀续写的客户端（DeepSeek 需要 beta 端点）"""
+        return get_client(self.api_key, prefix_completion_base_url(self.base_url), self.pool_config)
+
+    def chat_many(self, messages_list: List[List[Dict[str, str]]], concurrency: int = 8, **kwargs) -> List[ChatResult]:
+        """
+        并发执行多个相互独立的非流式请求，结果按输入顺序返回。
+        单个请求失败不影响其他请求，失败信息记录在对应 ChatResult.error 中。
+        """
+        results = [None] * len(messages_list)
+        for result in self.iter_chat_many(messages_list, concurrency=concurrency, **kwargs):
+            results[result.index] = result
+        return results
+
+    def iter_chat_many(self, messages_list: List[List[Dict[str, str]]], concurrency: int = 8,
+                       **kwargs) -> Generator[ChatResult, None, None]:
+        """
+        并发执行多个相互独立的非流式请求，按完成顺序逐个产出结果。
+        同时在途的请求不超过 concurrency 个，输入再多也不会一次性全部提交。
+        """
+        def _run(index: int, messages: List[Dict[str, str]]) -> ChatResult:
+            try:
+                return ChatResult(index=index, content=self.chat(messages, **kwargs))
+            except Exception as e:
+                return ChatResult(index=index, error=e)
+
+        pending_items = iter(enumerate(messages_list))
+        with ThreadPoolExecutor(max_workers=max(1, concurrency), thread_name_prefix="chat-many") as executor:
+            in_flight = set()
+            for index, messages in pending_items:
+                in_flight.add(executor.submit(_run, index, messages))
+                if len(in_flight) >= concurrency:
+                    break
+
+            while in_flight:
+                done, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+                for future in done:
+                    next_item = next(pending_items, None)
+                    if next_item is not None:
+                        in_flight.add(executor.submit(_run, *next_item))
+                    yield future.result()
+
     def _build_params(self, messages: List[Dict[str, str]], stream: bool, **kwargs) -> Dict[str, Any]:
         """
         构建API请求参数。优先使用kwargs传入的参数。
@@ -78,3 +269,126 @@ class DeepSeekClient:
         # 合并来自kwargs的动态参数
         params.update(kwargs)
         return params
+
+
+class AsyncDeepSeekClient:
+    """
+    DeepSeek API 异步客户端。
+    与 DeepSeekClient 的参数构建和重试策略一致，但不占用线程，
+    单个事件循环即可驱动大量并发流。
+    """
+
+    def __init__(self, api_key: str, base_url: str, model_name: str, max_retries: int = 3, retry_delay: int = 1,
+                 pool_config: Optional[Dict[str, Any]] = None):
+        """
+        初始化客户端。
+        AsyncOpenAI 客户端绑定事件循环，因此在首次请求时才从注册表获取。
+        """
+        self.api_key = api_key
+        self.base_url = base_url
+        self.pool_config = pool_config
+        self.model = model_name
+        self.max_retries = max_retries
+        self.retry_delay = retry_delay
+        # 最近一次请求的 token 用量
+        self.last_usage: Dict[str, int] = {}
+
+    # 与同步客户端共用同一套参数构建逻辑
+    _build_params = DeepSeekClient._build_params
+
+    @property
+    def client(self):
+        """当前事件循环内共享的 AsyncOpenAI 客户端"""
+        return get_async_client(self.api_key, self.base_url, self.pool_config)
+
+    async def chat(self, messages: List[Dict[str, str]], stream: bool = False, **kwargs) -> str:
+        """
+        非流式聊天请求（异步）。
+        kwargs: temperature, max_tokens, top_p, 等模型参数
+        """
+        params = self._build_params(messages, stream=False, **kwargs)
+
+        self.last_usage = {}
+        for attempt in range(self.max_retries):
+            try:
+                response = await self.client.chat.completions.create(**params)
+                self.last_usage = _usage_to_dict(response.usage)
+                return response.choices[0].message.content
+            except Exception as e:
+                logger.warning(f"API调用失败 (尝试 {attempt + 1}/{self.max_retries}): {e}")
+                if attempt < self.max_retries - 1:
+                    await asyncio.sleep(self.retry_delay * (attempt + 1))
+                else:
+                    logger.error(f"API调用最终失败: {e}")
+                    raise
+
+    async def chat_many(self, messages_list: List[List[Dict[str, str]]], concurrency: int = 8,
+                        **kwargs) -> List[ChatResult]:
+        """
+        并发执行多个相互独立的非流式请求（异步），结果按输入顺序返回。
+        单个请求失败不影响其他请求，失败信息记录在对应 ChatResult.error 中。
+        """
+        semaphore = asyncio.Semaphore(max(1, concurrency))
+
+        async def _run(index: int, messages: List[Dict[str, str]]) -> ChatResult:
+            async with semaphore:
+                try:
+                    return ChatResult(index=index, content=await self.chat(messages, **kwargs))
+                except Exception as e:
+                    return ChatResult(index=index, error=e)
+
+        return list(await asyncio.gather(*(_run(i, m) for i, m in enumerate(messages_list))))
+
+    async def chat_stream(self, messages: List[Dict[str, str]], **kwargs) -> AsyncGenerator[str, None]:
+        """
+        流式聊天请求（异步），只产出正式回答文本。
+        kwargs: temperature, max_tokens, top_p, 等模型参数
+        """
+        async for event in self.chat_stream_events(messages, **kwargs):
+            if event.kind == CONTENT:
+                yield event.text
+
+    async def chat_stream_events(self, messages: List[Dict[str, str]],
+                                 **kwargs) -> AsyncGenerator[StreamEvent, None]:
+        """
+        流式聊天请求（异步），推理过程和正式回答分别作为事件产出。
+        与同步版本一样，中途断开时以已输出的回答为前缀续写。
+        kwargs: temperature, max_tokens, top_p, 等模型参数
+        """
+        params = self._build_params(messages, stream=True, **kwargs)
+        params.setdefault("stream_options", {"include_usage": True})
+
+        self.last_usage = {}
+        parts = []
+        reasoned = False
+        for attempt in range(self.max_retries):
+            try:
+                if parts:
+                    logger.info(f"从第 {sum(len(p) for p in parts)} 个字符处续写中断的流")
+                    prefix_client = get_async_client(
+                        self.api_key, prefix_completion_base_url(self.base_url), self.pool_config
+                    )
+                    response_stream = await prefix_client.chat.completions.create(
+                        **_continuation_params(params, "".join(parts))
+                    )
+                else:
+                    if reasoned:
+                        yield StreamEvent(REASONING, REASONING_RESTART_NOTICE)
+                    response_stream = await self.client.chat.completions.create(**params)
+                async for chunk in response_stream:
+                    if getattr(chunk, "usage", None):
+                        self.last_usage = _usage_to_dict(chunk.usage)
+                    for event in _delta_events(chunk):
+                        if event.kind == CONTENT:
+                            parts.append(event.text)
+                        else:
+                            reasoned = True
+                        yield event
+                return # 成功完成，退出重试循环
+            except Exception as e:
+                logger.warning(f"流式API调用失败 (尝试 {attempt + 1}/{self.max_retries}): {e}")
+                if attempt < self.max_retries - 1:
+                    await asyncio.sleep(self.retry_delay * (attempt + 1))
+                else:
+                    logger.error(f"流式API调用最终失败: {e}")
+                    raise
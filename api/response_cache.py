@@ -0,0 +1,205 @@
+# api/response_cache.py
+
+"""
+API 响应缓存
+
+两级缓存：进程内 LRU（内存）+ SQLite（磁盘），均支持 TTL 过期和容量淘汰。
+缓存键是模型、消息和采样参数的规范化哈希，只有完全相同的请求才会命中。
+"""
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Generator, Optional
+
+logger = logging.getLogger(__name__)
+
+# 默认缓存配置
+DEFAULT_CACHE_CONFIG = {
+    "enabled": False,
+    "max_memory_entries": 256,
+    "ttl": 7 * 24 * 3600,
+    "disk_path": "output/cache/responses.db",
+    "max_disk_bytes": 200 * 1024 * 1024,
+}
+
+# 不影响响应内容、不参与缓存键计算的参数
+_NON_SEMANTIC_PARAMS = {"stream", "stream_options", "timeout", "extra_headers"}
+
+
+class ResponseCache:
+    """精确匹配的响应缓存"""
+
+    def __init__(self, max_memory_entries: int = 256, ttl: float = 7 * 24 * 3600,
+                 disk_path: Optional[str] = None, max_disk_bytes: int = 200 * 1024 * 1024):
+        """
+        Args:
+            max_memory_entries: 内存层最多保留的条目数
+            ttl: 条目有效期（秒）
+            disk_path: 磁盘层 SQLite 文件路径，为 None 时只使用内存层
+            max_disk_bytes: 磁盘层内容总字节数上限
+        """
+        self.max_memory_entries = max_memory_entries
+        self.ttl = ttl
+        self.max_disk_bytes = max_disk_bytes
+        self.hits = 0
+        self.misses = 0
+        self._memory: "OrderedDict[str, tuple]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._conn = None
+        self._disk_bytes = 0
+        if disk_path:
+            self._open_disk(disk_path)
+
+    def _open_disk(self, disk_path: str):
+        """打开（或创建）磁盘层数据库"""
+        os.makedirs(os.path.dirname(disk_path) or ".", exist_ok=True)
+        self._conn = sqlite3.connect(disk_path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS responses ("
+            "key TEXT PRIMARY KEY, content TEXT NOT NULL, size INTEGER NOT NULL, "
+            "created REAL NOT NULL, accessed REAL NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_responses_accessed ON responses(accessed)")
+        self._conn.execute("DELETE FROM responses WHERE created < ?", (time.time() - self.ttl,))
+        self._disk_bytes = self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+
+    @staticmethod
+    def make_key(params: Dict[str, Any]) -> str:
+        """根据请求参数计算规范化的缓存键"""
+        canonical = {k: v for k, v in params.items() if k not in _NON_SEMANTIC_PARAMS}
+        payload = json.dumps(canonical, sort_keys=True, ensure_ascii=False, separators=(",", ":"), default=str)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def get(self, key: str) -> Optional[str]:
+        """查询缓存，先查内存层，未命中再查磁盘层"""
+        now = time.time()
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None:
+                content, created = entry
+                if now - created <= self.ttl:
+                    self._memory.move_to_end(key)
+                    self.hits += 1
+                    return content
+                del self._memory[key]
+
+            if self._conn is not None:
+                row = self._conn.execute(
+                    "SELECT content, created FROM responses WHERE key = ?", (key,)
+                ).fetchone()
+                if row is not None:
+                    content, created = row
+                    if now - created <= self.ttl:
+                        self._conn.execute("UPDATE responses SET accessed = ? WHERE key = ?", (now, key))
+                        self._remember(key, content, created)
+                        self.hits += 1
+                        return content
+                    self._delete_disk(key)
+
+            self.misses += 1
+            return None
+
+    def set(self, key: str, content: str):
+        """写入缓存（内存层和磁盘层）"""
+        now = time.time()
+        with self._lock:
+            self._remember(key, content, now)
+            if self._conn is not None:
+                size = len(content.encode("utf-8"))
+                self._delete_disk(key)
+                self._conn.execute(
+                    "INSERT INTO responses (key, content, size, created, accessed) VALUES (?, ?, ?, ?, ?)",
+                    (key, content, size, now, now)
+                )
+                self._disk_bytes += size
+                self._evict_disk()
+
+    def _remember(self, key: str, content: str, created: float):
+        """写入内存层并按 LRU 淘汰"""
+        self._memory[key] = (content, created)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_memory_entries:
+            self._memory.popitem(last=False)
+
+    def _delete_disk(self, key: str):
+        row = self._conn.execute("SELECT size FROM responses WHERE key = ?", (key,)).fetchone()
+        if row is not None:
+            self._conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+            self._disk_bytes -= row[0]
+
+    def _evict_disk(self):
+        """磁盘层超出容量时，按最近访问时间从旧到新淘汰"""
+        while self._disk_bytes > self.max_disk_bytes:
+            rows = self._conn.execute(
+                "SELECT key, size FROM responses ORDER BY accessed LIMIT 64"
+            ).fetchall()
+            if not rows:
+                self._disk_bytes = 0
+                break
+            for key, size in rows:
+                self._conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+                self._disk_bytes -= size
+                if self._disk_bytes <= self.max_disk_bytes:
+                    break
+
+    @staticmethod
+    def replay(content: str, chunk_size: int = 16) -> Generator[str, None, None]:
+        """把缓存的完整回复切分为小块，按流式接口的形式重放"""
+        for i in range(0, len(content), chunk_size):
+            yield content[i:i + chunk_size]
+
+    def stats(self) -> Dict[str, Any]:
+        """命中/未命中计数和各层条目数"""
+        with self._lock:
+            total = self.hits + self.misses
+            disk_entries = 0
+            if self._conn is not None:
+                disk_entries = self._conn.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / total if total else 0.0,
+                "memory_entries": len(self._memory),
+                "disk_entries": disk_entries,
+                "disk_bytes": self._disk_bytes,
+            }
+
+    def clear(self):
+        """清空两级缓存"""
+        with self._lock:
+            self._memory.clear()
+            if self._conn is not None:
+                self._conn.execute("DELETE FROM responses")
+            self._disk_bytes = 0
+
+
+_shared_cache: Optional[ResponseCache] = None
+_shared_lock = threading.Lock()
+
+
+def get_response_cache(cache_config: Optional[Dict[str, Any]] = None) -> Optional[ResponseCache]:
+    """
+    获取进程内共享的响应缓存。
+    缓存是可选功能，配置中 enabled 不为真时返回 None。
+    """
+    global _shared_cache
+    config = dict(DEFAULT_CACHE_CONFIG)
+    config.update(cache_config or {})
+    if not config["enabled"]:
+        return None
+
+    with _shared_lock:
+        if _shared_cache is None:
+            _shared_cache = ResponseCache(
+                max_memory_entries=config["max_memory_entries"],
+                ttl=config["ttl"],
+                disk_path=config["disk_path"],
+                max_disk_bytes=config["max_disk_bytes"]
+            )
+    return _shared_cache
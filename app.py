@@ -2,14 +2,23 @@
 
 import streamlit as st
 import json
-import os
+import uuid
 from datetime import datetime
 
 # 导入重构后的核心模块
 from conversation.manager import ConversationManager
+from conversation.session_pool import get_session_pool
+from conversation.sqlite_history import (
+    SQLiteConversationHistory, list_conversations, list_filter_values, recover_pending_replies, search_messages
+)
+from api import client_pool
+from api.deepseek_client import REASONING
+from api.response_cache import get_response_cache
+from prompts.loader import PromptLoader
 from user_configs import prompt_manager
 from user_configs.api_config_manager import APIConfigManager
 from utils.markdown_export import MarkdownExporter
+from utils.stream_coalescer import FlushPolicy, coalesce_events
 
 # --- 0. 页面基础配置 ---
 st.set_page_config(
@@ -20,11 +29,18 @@ st.set_page_config(
 
 # --- 1. 初始化 & 状态管理 ---
 
+@st.cache_resource
+def recover_interrupted_replies():
+    """每个进程只执行一次：把上次进程崩溃或重启时被中断的回复写回各自的对话"""
+    return recover_pending_replies()
+
 def initialize_app():
     """初始化应用状态"""
     if "app_initialized" in st.session_state:
         return
 
+    recover_interrupted_replies()
+
     # 初始化API配置管理器
     api_config_manager = APIConfigManager()
     
@@ -32,11 +48,19 @@ def initialize_app():
     prompt_manager.initialize_default_prompts()
     
     # 步骤2: 初始化会话状态
-    st.session_state.manager = None
+    # 对话管理器保存在进程共享的会话池中，按本会话的键取出
+    st.session_state.session_key = uuid.uuid4().hex
     st.session_state.api_config_manager = api_config_manager
     
     # 加载保存的API配置
     st.session_state.api_config = api_config_manager.load_config()
+
+    # 预热共享连接池，首条消息无需再等待握手
+    client_pool.prewarm(
+        st.session_state.api_config.get('api_key'),
+        st.session_state.api_config['base_url'],
+        st.session_state.api_config.get('connection_pool')
+    )
     
     # 初始化Prompt库相关状态
     st.session_state.prompt_page = 0
@@ -50,13 +74,52 @@ def initialize_app():
     st.session_state.current_prompt_mode_name = available_modes[0] if available_modes else "新模式"
 
     # 加载默认模式的配置
-    st.session_state.current_prompt_config = prompt_manager.load_prompt_mode(st.session_state.current_prompt_mode_name)
+    select_prompt_mode(st.session_state.current_prompt_mode_name)
+    st.session_state.modes_version = prompt_manager.get_mode_repository().version
 
     # 标记为已初始化
     st.session_state.app_initialized = True
 
+def select_prompt_mode(name: str):
+    """切换到指定模式，并记下加载时的配置，用于判断是否有未保存的编辑"""
+    st.session_state.current_prompt_mode_name = name
+    st.session_state.current_prompt_config = prompt_manager.load_prompt_mode(name)
+    st.session_state.loaded_prompt_config = dict(st.session_state.current_prompt_config)
+
+def sync_prompt_modes():
+    """其他会话修改了提示模式时，刷新本会话的模式列表和当前模式（有未保存的编辑时不覆盖）"""
+    repository = prompt_manager.get_mode_repository()
+    if st.session_state.modes_version == repository.version:
+        return
+    st.session_state.modes_version = repository.version
+    st.session_state.available_modes = repository.list_modes()
+    latest = repository.get(st.session_state.current_prompt_mode_name)
+    if latest is None or latest == st.session_state.current_prompt_config:
+        return
+    if st.session_state.current_prompt_config != st.session_state.loaded_prompt_config:
+        return
+    select_prompt_mode(st.session_state.current_prompt_mode_name)
+    # 丢弃文本框的状态，使其显示新的内容
+    for key in ("cognitive_textarea", "meta_textarea", "system_textarea"):
+        st.session_state.pop(key, None)
+    st.toast(f"模式 '{st.session_state.current_prompt_mode_name}' 已在其他会话中更新", icon="🔄")
+
 # 每次脚本重新运行时都调用初始化函数
 initialize_app()
+sync_prompt_modes()
+
+# 定期检查提示模式是否有变化，有变化时重新运行以推送到本会话
+if hasattr(st, "fragment"):
+    @st.fragment(run_every=2)
+    def watch_prompt_modes():
+        if st.session_state.modes_version != prompt_manager.get_mode_repository().version:
+            st.rerun()
+
+    watch_prompt_modes()
+
+# 本会话的对话管理器；空闲时可能已被换出到磁盘，取出时自动还原
+session_pool = get_session_pool(st.session_state.api_config.get('session_pool'))
+manager = session_pool.get(st.session_state.session_key, st.session_state.api_config)
 
 # --- 2. 侧边栏 (控制中心) ---
 
@@ -113,7 +176,44 @@ with st.sidebar:
             st.session_state.api_config.get('max_tokens', 4096),
             key="max_tokens_slider"  # 添加唯一key
         )
+
+        # 上下文窗口设置（输入预算 = 上下文窗口 - 最大Tokens）
+        st.session_state.api_config['context_window'] = st.number_input(
+            "上下文窗口 (Tokens)",
+            min_value=4096,
+            max_value=1048576,
+            value=st.session_state.api_config.get('context_window', 65536),
+            step=4096,
+            help="超出预算时只发送能放入窗口的最新对话",
+            key="context_window_input"  # 添加唯一key
+        )
         
+        # 响应缓存开关（完全相同的请求直接返回缓存结果）
+        cache_config = st.session_state.api_config.setdefault('response_cache', {})
+        cache_config['enabled'] = st.checkbox(
+            "启用响应缓存",
+            value=cache_config.get('enabled', False),
+            help="模型、消息和参数完全相同的请求直接返回缓存结果，适合温度为0的场景",
+            key="response_cache_checkbox"  # 添加唯一key
+        )
+
+        # 系统提示压缩开关（去掉多余的空白和标记，减少每轮重复发送的输入token）
+        st.session_state.api_config['minify_prompts'] = st.checkbox(
+            "压缩系统提示",
+            value=st.session_state.api_config.get('minify_prompts', False),
+            help="发送前去掉系统提示中多余的空白、空行和闭合标签，对新对话生效",
+            key="minify_prompts_checkbox"  # 添加唯一key
+        )
+
+        # 长对话后台压缩开关（较早的对话合并为摘要，原始消息仍然保留）
+        compaction_config = st.session_state.api_config.setdefault('compaction', {})
+        compaction_config['enabled'] = st.checkbox(
+            "后台压缩长对话",
+            value=compaction_config.get('enabled', False),
+            help="历史超过输入预算的一半时，在两轮对话之间把较早的对话合并为摘要，之后的请求只发送摘要和最近的对话",
+            key="compaction_checkbox"  # 添加唯一key
+        )
+
         # 保存配置按钮
         if st.button("💾 保存API配置", use_container_width=True, key="save_api_config"):
             st.session_state.api_config_manager.save_config(st.session_state.api_config)
@@ -131,8 +231,7 @@ with st.sidebar:
         )
         
         if selected_mode != st.session_state.current_prompt_mode_name:
-            st.session_state.current_prompt_mode_name = selected_mode
-            st.session_state.current_prompt_config = prompt_manager.load_prompt_mode(selected_mode)
+            select_prompt_mode(selected_mode)
             st.rerun()
 
         st.session_state.current_prompt_config['cognitive'] = st.text_area(
@@ -153,11 +252,25 @@ with st.sidebar:
             height=150,
             key="system_textarea"  # 添加唯一key
         )
+
+        # 各层的token开销（按内容指纹缓存，内容不变时不重新计数）
+        compiled_prompt = PromptLoader(
+            st.session_state.current_prompt_config,
+            st.session_state.current_prompt_mode_name,
+            minify=st.session_state.api_config.get('minify_prompts', False)
+        ).compile()
+        st.caption(
+            f"Token: 认知架构 {compiled_prompt.layer_tokens['cognitive']} · "
+            f"元提示 {compiled_prompt.layer_tokens['meta']} · "
+            f"系统提示 {compiled_prompt.layer_tokens['system']} · "
+            f"合计 {compiled_prompt.message_tokens}"
+        )
         
         col1, col2 = st.columns(2)
         with col1:
             if st.button("💾 更新当前模式", use_container_width=True, key="update_mode"):
                 prompt_manager.save_prompt_mode(st.session_state.current_prompt_mode_name, st.session_state.current_prompt_config)
+                st.session_state.loaded_prompt_config = dict(st.session_state.current_prompt_config)
                 st.toast(f"模式 '{st.session_state.current_prompt_mode_name}' 已更新!", icon="✅")
         
         with col2:
@@ -168,26 +281,24 @@ with st.sidebar:
                 key="new_mode_name"  # 添加唯一key
             )
             if st.button("✚ 另存为新模式", use_container_width=True, key="save_as_new") and new_mode_name:
-                if f"{new_mode_name}.json" in os.listdir("user_configs"):
+                if new_mode_name in prompt_manager.get_available_modes():
                     st.warning(f"模式 '{new_mode_name}' 已存在。")
                 else:
                     prompt_manager.save_prompt_mode(new_mode_name, st.session_state.current_prompt_config)
                     st.session_state.available_modes = prompt_manager.get_available_modes()
                     st.session_state.current_prompt_mode_name = new_mode_name
+                    st.session_state.loaded_prompt_config = dict(st.session_state.current_prompt_config)
                     st.toast(f"新模式 '{new_mode_name}' 已创建!", icon="🎉")
                     st.rerun()
 
     # 任务提示库管理
     with st.expander("📚 任务提示库管理", expanded=False):
-        # 获取Prompt字典
-        prompt_dict = prompt_manager.get_prompt_dictionary()
-        
         # 新建/编辑Prompt表单
         st.write("### 📝 新建/编辑 Prompt")
         
         # 如果正在编辑，加载编辑的内容
         if st.session_state.editing_prompt_id:
-            editing_prompt = next((p for p in prompt_dict if p['id'] == st.session_state.editing_prompt_id), None)
+            editing_prompt = prompt_manager.get_prompt_entry(st.session_state.editing_prompt_id)
             if editing_prompt:
                 default_title = editing_prompt['title']
                 default_content = editing_prompt['content']
@@ -244,19 +355,28 @@ with st.sidebar:
         # 显示Prompt列表
         st.write("### 📋 Prompt列表")
         
+        # 全文检索：有查询词时显示最相关的结果，不分页
+        search_query = st.text_input(
+            "🔍 搜索Prompt",
+            placeholder="按标题或内容搜索...",
+            key="prompt_search_input"
+        ).strip()
+        
         # 分页计算
         items_per_page = 10
-        total_items = len(prompt_dict)
-        total_pages = max(1, (total_items + items_per_page - 1) // items_per_page)
-        
-        # 确保当前页有效
-        if st.session_state.prompt_page >= total_pages:
-            st.session_state.prompt_page = max(0, total_pages - 1)
-        
-        # 获取当前页的项目
-        start_idx = st.session_state.prompt_page * items_per_page
-        end_idx = min(start_idx + items_per_page, total_items)
-        current_page_prompts = prompt_dict[start_idx:end_idx]
+        if search_query:
+            total_pages = 1
+            current_page_prompts = prompt_manager.search_prompt_entries(search_query, k=items_per_page)
+        else:
+            total_items = prompt_manager.count_prompt_entries()
+            total_pages = max(1, (total_items + items_per_page - 1) // items_per_page)
+            
+            # 确保当前页有效
+            if st.session_state.prompt_page >= total_pages:
+                st.session_state.prompt_page = max(0, total_pages - 1)
+            
+            # 只读取当前页的项目
+            current_page_prompts = prompt_manager.get_prompt_page(st.session_state.prompt_page, items_per_page)
         
         # 显示当前页的Prompt
         if current_page_prompts:
@@ -287,6 +407,8 @@ with st.sidebar:
                             prompt_manager.delete_prompt_entry(prompt['id'])
                             st.toast("Prompt已删除!", icon="🗑️")
                             st.rerun()
+        elif search_query:
+            st.info("没有匹配的Prompt")
         else:
             st.info("暂无Prompt，请添加新的Prompt")
         
@@ -309,12 +431,99 @@ with st.sidebar:
     st.header("📜 对话管理")
     
     if st.button("🗑️ 开始新对话", use_container_width=True, key="new_conversation"):
-        st.session_state.manager = None
+        session_pool.discard(st.session_state.session_key)
         st.rerun()
 
-    if st.session_state.manager and st.session_state.manager.get_history():
-        md_content = MarkdownExporter._generate_markdown(
-            messages=st.session_state.manager.get_history(),
+    with st.expander("🕘 历史对话", expanded=False):
+        # 全文检索所有已保存对话中的消息，点击结果在命中的消息处打开对话
+        history_query = st.text_input(
+            "🔍 搜索历史消息", placeholder="输入关键词...", key="history_search_input"
+        ).strip()
+        if history_query:
+            filter_values = list_filter_values()
+            col1, col2 = st.columns(2)
+            with col1:
+                search_mode = st.selectbox("模式", ["全部"] + filter_values["mode_name"], key="history_search_mode")
+            with col2:
+                search_model = st.selectbox("模型", ["全部"] + filter_values["model_name"], key="history_search_model")
+            date_range = st.date_input("日期范围", value=(), key="history_search_dates")
+            since = date_range[0].isoformat() if len(date_range) > 0 else None
+            until = date_range[1].isoformat() if len(date_range) > 1 else since
+
+            search_results = search_messages(
+                history_query,
+                mode_name=None if search_mode == "全部" else search_mode,
+                model_name=None if search_model == "全部" else search_model,
+                since=since,
+                until=until
+            )
+            if not search_results:
+                st.info("没有匹配的消息")
+            for result in search_results:
+                role_icon = "🧑" if result["role"] == "user" else "🤖"
+                if st.button(
+                    f"{role_icon} {result['snippet']}",
+                    key=f"open_search_result_{result['conversation_id']}_{result['seq']}",
+                    use_container_width=True,
+                    help=f"{result['title'] or '（无标题）'} · {result['mode_name']} · {result['timestamp'][:16]}"
+                ):
+                    st.session_state.reopen_conversation_id = result['conversation_id']
+                    st.session_state.focus_message = (result['conversation_id'], result['seq'])
+                    if result['mode_name'] in st.session_state.available_modes:
+                        select_prompt_mode(result['mode_name'])
+                    session_pool.discard(st.session_state.session_key)
+                    st.rerun()
+            st.divider()
+
+        past_conversations = list_conversations(limit=20)
+        if not past_conversations:
+            st.info("暂无保存的对话")
+        for conversation in past_conversations:
+            if st.button(
+                f"💬 {conversation['title'] or '（无标题）'}",
+                key=f"open_conversation_{conversation['id']}",
+                use_container_width=True,
+                help=f"{conversation['mode_name']} · {conversation['updated'][:16]} · {conversation['message_count']} 条消息"
+            ):
+                st.session_state.reopen_conversation_id = conversation['id']
+                st.session_state.focus_message = None
+                if conversation['mode_name'] in st.session_state.available_modes:
+                    select_prompt_mode(conversation['mode_name'])
+                session_pool.discard(st.session_state.session_key)
+                st.rerun()
+
+    if manager and manager.usage_stats["requests"]:
+        usage_stats = manager.usage_stats
+        st.caption(
+            f"上下文缓存命中率: {manager.prompt_cache_hit_rate():.0%} "
+            f"(命中 {usage_stats['prompt_cache_hit_tokens']} / "
+            f"未命中 {usage_stats['prompt_cache_miss_tokens']} tokens)"
+        )
+
+    if manager and manager.history.summary_until:
+        st.caption(f"已将前 {manager.history.summary_until} 条消息压缩为摘要")
+
+    response_cache = get_response_cache(st.session_state.api_config.get('response_cache'))
+    if response_cache is not None:
+        cache_stats = response_cache.stats()
+        st.caption(
+            f"响应缓存: 命中 {cache_stats['hits']} / 未命中 {cache_stats['misses']} "
+            f"({cache_stats['hit_rate']:.0%})"
+        )
+
+    pool_stats = session_pool.stats()
+    session_bytes = session_pool.session_bytes(st.session_state.session_key)
+    st.caption(
+        f"会话池: 常驻 {pool_stats['resident']} / 已换出 {pool_stats['spilled']} 个会话，"
+        f"约 {pool_stats['resident_bytes'] / 1024 / 1024:.1f} / {pool_stats['max_bytes'] / 1024 / 1024:.0f} MB，"
+        f"{pool_stats['rehydrated_sessions']} / {pool_stats['sessions']} 个会话曾从磁盘还原"
+        + (f"；当前会话约 {session_bytes / 1024:.0f} KB" if session_bytes is not None else "")
+    )
+
+    if manager and manager.dialog_count():
+        # 按对话的消息条数缓存，对话没有变化时重新运行不会重新生成文档
+        md_content = MarkdownExporter.cached_markdown(
+            history=manager.history,
             api_config=st.session_state.api_config,
             prompt_config=st.session_state.current_prompt_config
         )
@@ -332,23 +541,95 @@ with st.sidebar:
 st.title(f"对话模式: {st.session_state.current_prompt_mode_name}")
 
 # 初始化对话管理器实例
-if st.session_state.manager is None:
+if manager is None:
     if not st.session_state.api_config.get("api_key"):
         st.warning("欢迎使用！请在左侧侧边栏的\"通用API配置\"中输入您的API Key以开始对话。")
         st.stop()
     
-    st.session_state.manager = ConversationManager(
+    # 对话持久化到本地 SQLite；从"历史对话"中选择时重新打开已有对话
+    manager = ConversationManager(
         api_config=st.session_state.api_config,
         prompt_config=st.session_state.current_prompt_config,
-        prompt_mode_name=st.session_state.current_prompt_mode_name
+        prompt_mode_name=st.session_state.current_prompt_mode_name,
+        history=SQLiteConversationHistory(
+            conversation_id=st.session_state.pop('reopen_conversation_id', None),
+            mode_name=st.session_state.current_prompt_mode_name,
+            model_name=st.session_state.api_config['model_name']
+        )
     )
-    st.session_state.manager.initialize()
+    manager.initialize()
+    session_pool.put(st.session_state.session_key, manager)
+
+# 上一次回复被中断（重新运行或崩溃）时，直接显示已生成的部分而不是重新生成
+if manager.recover_interrupted():
+    st.toast("已恢复上次被中断的回复", icon="♻️")
+
+def stream_assistant_reply(prompt: str):
+    """流式显示助手回复，推理过程显示在回答上方的可折叠区域中"""
+    reasoning_slot = st.empty()
+    reasoning_view = None
+    reasoning_parts = []
+
+    def content_stream():
+        nonlocal reasoning_view
+        # 按时间窗口合并细碎的增量，减少前端重新渲染次数
+        events = coalesce_events(
+            manager.chat_stream_events(prompt),
+            FlushPolicy.from_config(st.session_state.api_config.get('stream_coalesce'))
+        )
+        for event in events:
+            if event.kind == REASONING:
+                if reasoning_view is None:
+                    reasoning_view = reasoning_slot.expander("💭 思考过程", expanded=True).empty()
+                reasoning_parts.append(event.text)
+                reasoning_view.markdown("".join(reasoning_parts))
+            else:
+                yield event.text
+
+    st.write_stream(content_stream())
+
+# 显示历史消息：只渲染最新的一段，更早的消息按需加载
+RENDER_PAGE_SIZE = 30
+current_conversation_id = manager.history.conversation_id
+if st.session_state.get("render_conversation_id") != current_conversation_id:
+    st.session_state.render_conversation_id = current_conversation_id
+    st.session_state.render_window = RENDER_PAGE_SIZE
+    # 从搜索结果打开时，窗口扩展到命中的消息
+    focus = st.session_state.get("focus_message")
+    if focus and focus[0] == current_conversation_id:
+        st.session_state.render_window = max(
+            RENDER_PAGE_SIZE, manager.history.count() - focus[1]
+        )
+
+# 最新窗口内的消息，附带其在对话中的序号
+window_start = max(manager.history.count() - st.session_state.render_window, 0)
+visible_messages = [
+    (window_start + offset, m)
+    for offset, m in enumerate(manager.get_recent_history(st.session_state.render_window))
+    if m["role"] != "system"
+]
+hidden_count = manager.dialog_count() - len(visible_messages)
+if hidden_count > 0:
+    if st.button(f"⬆️ 加载更早的消息（还有 {hidden_count} 条）", key="load_earlier_messages"):
+        st.session_state.render_window += RENDER_PAGE_SIZE
+        st.rerun()
+
+def prepare_markdown(text: str) -> str:
+    """补全未闭合的代码块，使被中断或截断的回复也能正确渲染"""
+    fence_lines = sum(1 for line in text.splitlines() if line.lstrip().startswith("```"))
+    return text + "\n```" if fence_lines % 2 else text
 
-# 显示历史消息
-for message in st.session_state.manager.get_history():
-    if message["role"] != "system":
-        with st.chat_message(message["role"]):
-            st.markdown(message["content"])
+focus = st.session_state.get("focus_message")
+for seq, message in visible_messages:
+    with st.chat_message(message["role"]):
+        if focus == (current_conversation_id, seq):
+            st.caption("🔍 搜索命中的消息")
+        if message.get("reasoning_content"):
+            with st.expander("💭 思考过程", expanded=False):
+                st.markdown(prepare_markdown(message["reasoning_content"]))
+        st.markdown(prepare_markdown(message["content"]))
+        if message.get("interrupted"):
+            st.caption("⚠️ 回复被中断，以上为已生成的部分")
 
 # 检查是否有待发送的Prompt
 if hasattr(st.session_state, 'pending_prompt') and st.session_state.pending_prompt:
@@ -361,8 +642,7 @@ if hasattr(st.session_state, 'pending_prompt') and st.session_state.pending_prom
     
     # 获取并显示助手回复
     with st.chat_message("assistant"):
-        response_stream = st.session_state.manager.chat_stream(prompt)
-        st.write_stream(response_stream)
+        stream_assistant_reply(prompt)
     
     st.rerun()
 
@@ -372,7 +652,6 @@ if prompt := st.chat_input("请输入您的问题..."):
         st.markdown(prompt)
 
     with st.chat_message("assistant"):
-        response_stream = st.session_state.manager.chat_stream(prompt)
-        st.write_stream(response_stream)
+        stream_assistant_reply(prompt)
 
     st.rerun()
@@ -0,0 +1,165 @@
+# conversation/batch_runner.py
+
+"""
+无界面的批量运行器
+
+从 JSONL 读取输入，用指定的提示模式逐条提问，结果逐行追加写入输出 JSONL。
+每条输入是一次独立的单轮对话，请求经由 ConversationManager 的异步接口发出，
+与界面使用相同的客户端、连接池、重试和续写逻辑。
+
+输入文件每行一个 JSON 对象：{"id": "可选的唯一ID", "input": "问题"}，
+没有 id 时使用行号。输出文件同时就是检查点：重新运行时跳过已经成功的条目，
+失败的条目会重新执行（同一 id 以最后一行为准）。
+
+用法（在项目根目录运行）:
+    python -m conversation.batch_runner questions.jsonl results.jsonl --mode 编程模式 --concurrency 16
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import time
+from typing import Dict, Iterator, Optional, Set
+
+from api.deepseek_client import REASONING
+from conversation.manager import ConversationManager
+from user_configs import prompt_manager
+from user_configs.api_config_manager import APIConfigManager
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_CONCURRENCY = 8
+
+
+def iter_inputs(input_path: str) -> Iterator[Dict]:
+    """逐行读取输入，返回 {"id", "input"}"""
+    with open(input_path, "r", encoding="utf-8") as f:
+        for line_no, line in enumerate(f, 1):
+            line = line.strip()
+            if not line:
+                continue
+            record = json.loads(line)
+            yield {"id": str(record.get("id", line_no)), "input": record["input"]}
+
+
+def completed_ids(output_path: str) -> Set[str]:
+    """从已有的输出文件中读取已经成功的条目（崩溃时写了一半的最后一行会被忽略）"""
+    done: Set[str] = set()
+    if not os.path.exists(output_path):
+        return done
+    with open(output_path, "r", encoding="utf-8") as f:
+        for line in f:
+            try:
+                row = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            if row.get("error"):
+                done.discard(row["id"])
+            else:
+                done.add(row["id"])
+    return done
+
+
+class BatchRunner:
+    """用一个提示模式并发执行一批独立的单轮对话"""
+
+    def __init__(self, api_config: Dict, mode_name: str, concurrency: int = DEFAULT_CONCURRENCY):
+        self.api_config = api_config
+        self.mode_name = mode_name
+        self.prompt_config = prompt_manager.load_prompt_mode(mode_name)
+        self.concurrency = max(1, concurrency)
+
+    async def run_one(self, item: Dict) -> Dict:
+        """执行一条输入，返回带耗时和token统计的结果行"""
+        manager = ConversationManager(self.api_config, self.prompt_config, self.mode_name)
+        content_parts, reasoning_parts = [], []
+        started = time.perf_counter()
+        first_token: Optional[float] = None
+        async for event in manager.achat_stream_events(item["input"]):
+            if first_token is None:
+                first_token = time.perf_counter() - started
+            (reasoning_parts if event.kind == REASONING else content_parts).append(event.text)
+        latency = time.perf_counter() - started
+
+        row = {
+            "id": item["id"],
+            "input": item["input"],
+            "mode": self.mode_name,
+            "model": self.api_config["model_name"],
+            "output": None if manager.last_error else "".join(content_parts),
+            "reasoning": "".join(reasoning_parts) or None,
+            "error": str(manager.last_error) if manager.last_error else None,
+            "latency_s": round(latency, 3),
+            "first_token_s": round(first_token, 3) if first_token is not None else None,
+        }
+        row.update({key: value for key, value in manager.usage_stats.items() if key != "requests"})
+        return row
+
+    async def run(self, input_path: str, output_path: str) -> Dict[str, int]:
+        """
+        执行整批输入，结果逐行追加写入 output_path 并立即刷盘。
+        Returns:
+            {"total", "skipped", "succeeded", "failed"}
+        """
+        done = completed_ids(output_path)
+        stats = {"total": 0, "skipped": 0, "succeeded": 0, "failed": 0}
+        queue: asyncio.Queue = asyncio.Queue(maxsize=self.concurrency * 2)
+
+        async def produce():
+            for item in iter_inputs(input_path):
+                stats["total"] += 1
+                if item["id"] in done:
+                    stats["skipped"] += 1
+                    continue
+                await queue.put(item)
+            for _ in range(self.concurrency):
+                await queue.put(None)
+
+        os.makedirs(os.path.dirname(output_path) or ".", exist_ok=True)
+        with open(output_path, "a", encoding="utf-8") as out:
+            async def work():
+                while True:
+                    item = await queue.get()
+                    if item is None:
+                        return
+                    row = await self.run_one(item)
+                    out.write(json.dumps(row, ensure_ascii=False) + "\n")
+                    out.flush()
+                    stats["failed" if row["error"] else "succeeded"] += 1
+                    finished = stats["succeeded"] + stats["failed"]
+                    if finished % 50 == 0:
+                        logger.info(f"已完成 {finished} 条（失败 {stats['failed']}）")
+
+            await asyncio.gather(produce(), *(work() for _ in range(self.concurrency)))
+        return stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description="用指定提示模式批量执行 JSONL 中的问题")
+    parser.add_argument("input", help="输入 JSONL，每行 {\"id\": ..., \"input\": ...}")
+    parser.add_argument("output", help="输出 JSONL（追加写入，同时作为续跑的检查点）")
+    parser.add_argument("--mode", default="编程模式", help="提示模式名称")
+    parser.add_argument("--concurrency", type=int, default=DEFAULT_CONCURRENCY, help="同时进行的请求数")
+    parser.add_argument("--model", help="覆盖配置中的模型")
+    parser.add_argument("--temperature", type=float, help="覆盖配置中的温度")
+    parser.add_argument("--max-tokens", type=int, help="覆盖配置中的最大Tokens")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+    api_config = APIConfigManager().load_config()
+    for key, value in (("model_name", args.model), ("temperature", args.temperature), ("max_tokens", args.max_tokens)):
+        if value is not None:
+            api_config[key] = value
+    if not api_config.get("api_key"):
+        parser.error("未配置 API Key，请先在界面中保存 API 配置")
+    if args.mode not in prompt_manager.get_available_modes():
+        parser.error(f"提示模式 '{args.mode}' 不存在，可用模式: {', '.join(prompt_manager.get_available_modes())}")
+
+    runner = BatchRunner(api_config, args.mode, args.concurrency)
+    stats = asyncio.run(runner.run(args.input, args.output))
+    print(f"共 {stats['total']} 条：跳过 {stats['skipped']}，成功 {stats['succeeded']}，失败 {stats['failed']}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,47 +1,314 @@
 """
 对话历史管理
 """
+import sys
+import threading
+import uuid
+from bisect import bisect_left
 from datetime import datetime
-from typing import List, Dict
+from itertools import islice
+from typing import Any, Iterator, List, Dict, Optional, Tuple
+
+from utils.token_counter import count_message_tokens
+
+# 每条消息在元数据索引中占用的内存估计值（字节）：角色引用、token数及其前缀和
+_METADATA_BYTES_PER_MESSAGE = 80
 
 class ConversationHistory:
-    """管理对话历史记录"""
-    
-    def __init__(self):
+    """
+    管理对话历史记录
+
+    消息选取（limit / token预算 / 前缀稳定窗口）只依赖内存中的轻量元数据
+    （角色和token数），选定下标后才通过 _load_messages 读取消息内容，
+    子类可以替换消息的存储方式而不必加载整段对话。
+
+    设置了滚动摘要（set_summary）后，摘要覆盖的早期消息不再发送给API，
+    改为在系统消息之后插入一条摘要消息；原始消息仍完整保留，供显示和导出。
+    摘要由后台线程写入，摘要和窗口起点的读写都在 _lock 下进行。
+    """
+
+    # 消息是否持久保存、进程重启后可按 conversation_id 重新打开
+    persistent = False
+
+    def __init__(self, conversation_id: Optional[str] = None):
+        self.conversation_id = conversation_id or uuid.uuid4().hex
         self.messages: List[Dict[str, str]] = []
         self.start_time = datetime.now()
-    
-    def add_message(self, role: str, content: str):
-        """添加消息到历史"""
-        self.messages.append({
+        # 消息每次增加或清空时递增；只在同一个历史对象内有意义，重新打开的对话从 0 开始
+        self.version = 0
+        # 保护摘要和窗口起点（后台压缩线程会调用 set_summary）；子类也用它串行化存储操作
+        self._lock = threading.RLock()
+        self._reset_index()
+
+    def _reset_index(self):
+        """重置消息元数据"""
+        self._roles: List[str] = []
+        # 每条消息的token数，在 add_message 时计算一次并缓存
+        self.token_counts: List[int] = []
+        self._system_indices: List[int] = []
+        self._system_tokens = 0
+        # 非系统消息token数的前缀和：_cumulative_tokens[i] 为前 i 条消息的合计
+        self._cumulative_tokens: List[int] = [0]
+        # 前缀稳定模式下当前窗口的起始位置，只在超出预算时成块前移
+        self._window_start = 0
+        # 滚动摘要：summary 概括了下标 summary_until 之前的全部对话
+        self.summary = ""
+        self.summary_until = 0
+        self._summary_tokens = 0
+
+    def _index_message(self, role: str, tokens: int):
+        """把一条消息的元数据追加到索引"""
+        self._roles.append(role)
+        self.token_counts.append(tokens)
+        if role == "system":
+            self._system_indices.append(len(self._roles) - 1)
+            self._system_tokens += tokens
+            self._cumulative_tokens.append(self._cumulative_tokens[-1])
+        else:
+            self._cumulative_tokens.append(self._cumulative_tokens[-1] + tokens)
+
+    def add_message(self, role: str, content: str, reasoning_content: Optional[str] = None,
+                    interrupted: bool = False, tokens: Optional[int] = None):
+        """
+        添加消息到历史
+        reasoning_content: deepseek-reasoner 的推理过程，仅用于展示，不计入token预算也不发回API
+        interrupted: 回复在生成过程中被中断，content 只是已生成的部分
+        tokens: 已知的消息token数（含消息格式开销），省略时在此计算
+        """
+        message = {
             "role": role,
             "content": content,
             "timestamp": datetime.now().isoformat()
-        })
-    
-    def get_messages(self, limit: int = None) -> List[Dict[str, str]]:
-        """获取消息历史（用于API调用）"""
-        # 获取指定数量的最新消息
-        messages = self.messages
-        
-        if limit and len(messages) > limit:
-            # 保留系统消息和最新的对话
-            system_messages = [m for m in messages if m["role"] == "system"]
-            other_messages = [m for m in messages if m["role"] != "system"]
-            
-            # 保留最新的limit条对话
-            recent_messages = other_messages[-(limit-len(system_messages)):]
-            
-            messages = system_messages + recent_messages
-        
+        }
+        if reasoning_content:
+            message["reasoning_content"] = reasoning_content
+        if interrupted:
+            message["interrupted"] = True
+        if tokens is None:
+            tokens = count_message_tokens(content)
+        self._store_message(message, tokens)
+        self._index_message(role, tokens)
+        self.version += 1
+
+    def _store_message(self, message: Dict[str, str], tokens: int):
+        """保存消息内容"""
+        self.messages.append(message)
+
+    def _load_messages(self, indices: List[int]) -> List[Dict[str, str]]:
+        """按下标读取消息内容"""
+        return [self.messages[i] for i in indices]
+
+    def _on_window_moved(self):
+        """前缀稳定窗口起点变化时的回调，供持久化的子类保存"""
+
+    def _store_summary(self):
+        """滚动摘要变化时的回调，供持久化的子类保存"""
+
+    def set_summary(self, summary: str, until: int, expected_until: Optional[int] = None) -> bool:
+        """
+        设置滚动摘要，summary 概括下标 until 之前的全部对话（应包含之前的摘要内容）。
+        until 应指向一条用户消息，使摘要之后的窗口以完整的一轮对话开头。
+        expected_until: 给出时，只有当前摘要终点仍为该值（生成期间没有更新的摘要）才写入。
+        返回是否已写入；历史已被清空到 until 之前时不写入。
+        """
+        summary_tokens = count_message_tokens(summary) if summary else 0
+        with self._lock:
+            if until > len(self._roles) or (expected_until is not None and self.summary_until != expected_until):
+                return False
+            self.summary = summary
+            self.summary_until = until
+            self._summary_tokens = summary_tokens
+            self._store_summary()
+            if self._window_start < until:
+                self._window_start = until
+                self._on_window_moved()
+            return True
+
+    def summary_state(self) -> Tuple[str, int]:
+        """当前的摘要及其终点（一致的一对值）"""
+        with self._lock:
+            return self.summary, self.summary_until
+
+    def summary_message(self) -> Optional[Dict[str, str]]:
+        """发送给API的摘要消息，没有摘要时返回 None"""
+        summary = self.summary
+        if not summary:
+            return None
+        return {"role": "system", "content": f"[早期对话摘要]\n{summary}"}
+
+    def uncompacted_tokens(self) -> int:
+        """摘要之后（尚未被摘要覆盖）的对话消息token总数"""
+        with self._lock:
+            return self._cumulative_tokens[-1] - self._cumulative_tokens[self.summary_until]
+
+    def compaction_cut(self, keep_tokens: int) -> Optional[int]:
+        """
+        计算下一次摘要的终点：保留最新的约 keep_tokens 个token的对话原样发送，
+        更早的部分交给摘要。终点对齐到用户消息；没有可以摘要的内容时返回 None。
+        """
+        with self._lock:
+            end = len(self._roles)
+            cut = bisect_left(self._cumulative_tokens, self._cumulative_tokens[end] - keep_tokens,
+                              lo=self.summary_until)
+            while cut < end and self._roles[cut] != "user":
+                cut += 1
+            if cut >= end or cut <= self.summary_until:
+                return None
+            return cut
+
+    def get_range(self, start: int, end: int) -> List[Dict[str, str]]:
+        """读取下标 [start, end) 范围内的对话消息（不含系统消息，包含时间戳）"""
+        return self._load_messages([i for i in range(start, end) if self._roles[i] != "system"])
+
+    def get_messages(self, limit: int = None, token_budget: Optional[int] = None,
+                     trim_ratio: Optional[float] = None) -> List[Dict[str, str]]:
+        """
+        获取消息历史（用于API调用）
+        Args:
+            limit: 最多保留的消息条数
+            token_budget: 输入token预算。设置后从最新消息向前选取，直到预算用尽；
+                          系统消息始终保留并计入预算
+            trim_ratio: 前缀稳定模式。设置后窗口起点保持不变，直到超出预算才一次性
+                        裁掉足够多的早期对话，腾出 trim_ratio 比例的预算，
+                        使之后多轮请求的前缀字节不变，从而命中服务端的上下文缓存
+        """
+        # 选取的下标和摘要须来自同一时刻，否则可能与后台写入的摘要重叠或留出空档
+        with self._lock:
+            indices = self._select_indices(limit, token_budget, trim_ratio)
+            summary_message = self.summary_message()
+        messages = [{"role": m["role"], "content": m["content"]} for m in self._load_messages(indices)]
+
+        # 摘要紧跟在系统消息之后
+        if summary_message is not None:
+            messages.insert(len(self._system_indices), summary_message)
+
         # 返回API所需格式
-        return [{"role": m["role"], "content": m["content"]} for m in messages]
-    
+        return messages
+
+    def _select_indices(self, limit: Optional[int], token_budget: Optional[int],
+                        trim_ratio: Optional[float]) -> List[int]:
+        """选出要发送的消息下标：系统消息在前，其余按时间顺序；需持有 _lock"""
+        total = len(self._roles)
+        system_indices = list(self._system_indices)
+
+        if token_budget is not None and trim_ratio is not None and not limit:
+            return system_indices + self._stable_window(token_budget, trim_ratio)
+
+        # 从最新消息向前遍历非系统消息，只访问会被选中的部分（摘要覆盖的消息除外）
+        candidates = (i for i in range(total - 1, self.summary_until - 1, -1) if self._roles[i] != "system")
+        if limit and total > limit:
+            # 保留系统消息和最新的limit条对话
+            candidates = islice(candidates, max(limit - len(system_indices), 0))
+
+        if token_budget is None:
+            return system_indices + sorted(candidates)
+
+        remaining = token_budget - self._system_tokens - self._summary_tokens
+        selected: List[int] = []
+        for i in candidates:
+            # 最新一条消息无论如何都要发送
+            if self.token_counts[i] > remaining and selected:
+                break
+            remaining -= self.token_counts[i]
+            selected.append(i)
+        selected.reverse()
+
+        # 窗口不应以助手回复开头
+        while len(selected) > 1 and self._roles[selected[0]] == "assistant":
+            selected.pop(0)
+
+        return system_indices + selected
+
+    def _stable_window(self, token_budget: int, trim_ratio: float) -> List[int]:
+        """在预算内保持窗口起点不动，超出时按大步长对齐裁剪；需持有 _lock"""
+        end = len(self._roles)
+        available = token_budget - self._system_tokens - self._summary_tokens
+
+        if self._cumulative_tokens[end] - self._cumulative_tokens[self._window_start] > available:
+            # 裁剪后窗口最多占用 (1 - trim_ratio) 的预算，为后续轮次留出增长空间
+            target = available * (1 - trim_ratio)
+            start = bisect_left(self._cumulative_tokens, self._cumulative_tokens[end] - target, lo=self._window_start)
+            start = min(start, end - 1)
+            # 对齐到用户消息，保证窗口以完整的一轮对话开头
+            while start < end - 1 and self._roles[start] != "user":
+                start += 1
+            self._window_start = start
+            self._on_window_moved()
+
+        return [i for i in range(self._window_start, end) if self._roles[i] != "system"]
+
+    def count(self) -> int:
+        """消息总数"""
+        return len(self._roles)
+
+    def dialog_count(self) -> int:
+        """对话消息（不含系统消息）总数"""
+        return len(self._roles) - len(self._system_indices)
+
+    def get_recent(self, n: int) -> List[Dict[str, str]]:
+        """获取最新的 n 条消息（包含时间戳）"""
+        total = self.count()
+        return self._load_messages(list(range(max(total - n, 0), total)))
+
+    def get_page(self, page: int, page_size: int = 50) -> List[Dict[str, str]]:
+        """按页获取消息（包含时间戳），第0页为最早的消息"""
+        start = page * page_size
+        return self._load_messages(list(range(start, min(start + page_size, self.count()))))
+
+    def iter_messages(self, start: int = 0, page_size: int = 200) -> Iterator[Dict[str, str]]:
+        """从下标 start 开始按页读取消息（包含时间戳），长对话不必一次加载全部内容"""
+        total = self.count()
+        for page_start in range(start, total, page_size):
+            yield from self._load_messages(list(range(page_start, min(page_start + page_size, total))))
+
     def get_all_messages(self) -> List[Dict[str, str]]:
         """获取所有消息（包含时间戳）"""
         return self.messages
-    
+
+    def memory_bytes(self) -> int:
+        """内存占用的估计值（字节）：消息元数据、内存中保存的消息内容和摘要"""
+        size = len(self._roles) * _METADATA_BYTES_PER_MESSAGE + sys.getsizeof(self.summary)
+        for message in self.messages:
+            size += sys.getsizeof(message) + sum(sys.getsizeof(value) for value in message.values())
+        return size
+
+    def snapshot(self) -> Dict[str, Any]:
+        """可 JSON 序列化的完整状态，restore 可据此还原（供会话池换出到磁盘）"""
+        with self._lock:
+            return {
+                "conversation_id": self.conversation_id,
+                "start_time": self.start_time.isoformat(),
+                "version": self.version,
+                "messages": self.messages,
+                "token_counts": self.token_counts,
+                "summary": self.summary,
+                "summary_until": self.summary_until,
+                "window_start": self._window_start,
+            }
+
+    @classmethod
+    def restore(cls, state: Dict[str, Any]) -> "ConversationHistory":
+        """从 snapshot 的结果还原，token数直接沿用，不再重新计算"""
+        history = cls(state["conversation_id"])
+        history.start_time = datetime.fromisoformat(state["start_time"])
+        for message, tokens in zip(state["messages"], state["token_counts"]):
+            history._store_message(message, tokens)
+            history._index_message(message["role"], tokens)
+        history.summary = state["summary"]
+        history.summary_until = state["summary_until"]
+        history._summary_tokens = count_message_tokens(history.summary) if history.summary else 0
+        history._window_start = state["window_start"]
+        # 版本号延续换出前的值
+        history.version = state["version"]
+        return history
+
+    def close(self):
+        """释放占用的资源（内存中的历史无需处理）"""
+
     def clear(self):
         """清除历史"""
-        self.messages = []
-        self.start_time = datetime.now()
+        with self._lock:
+            self.messages = []
+            self.start_time = datetime.now()
+            self._reset_index()
+            self.version += 1
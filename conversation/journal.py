@@ -0,0 +1,195 @@
+# conversation/journal.py
+
+"""
+进行中回复的预写日志
+
+流式回复在完成前只存在于内存中，脚本重新运行或进程崩溃都会丢失已生成的内容。
+这里把每个增量追加写入按对话ID命名的日志文件，回复完成后删除；
+如果日志残留，说明上一次回复被中断，可以据此恢复已生成的部分。
+
+日志按持久化对话的ID命名，进程重启后重新打开同一对话即可找到；
+启动时 pending_journals 还会扫描整个目录，找出已无人写入的残留日志统一恢复或丢弃。
+写入中的日志持有文件锁（不支持 fcntl 的平台按修改时间判断），不会被其他会话或进程误当作残留。
+"""
+import json
+import logging
+import os
+import time
+from typing import Dict, Iterator, List, Optional
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_JOURNAL_DIR = "output/journal"
+
+# 没有文件锁时，超过该时长（秒）未被写入的日志视为残留
+STALE_SECONDS = 120
+
+
+def _in_use(path: str) -> bool:
+    """日志是否正被某个进行中的回复写入"""
+    if fcntl is None:
+        try:
+            return time.time() - os.path.getmtime(path) < STALE_SECONDS
+        except OSError:
+            return False
+    try:
+        with open(path, "rb") as f:
+            try:
+                fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                return True
+            fcntl.flock(f, fcntl.LOCK_UN)
+    except OSError:
+        return False
+    return False
+
+
+def pending_journals(journal_dir: str = DEFAULT_JOURNAL_DIR) -> Iterator[str]:
+    """目录中残留（已无人写入）的日志对应的对话ID"""
+    if not os.path.isdir(journal_dir):
+        return
+    for name in os.listdir(journal_dir):
+        if name.endswith(".jsonl") and not _in_use(os.path.join(journal_dir, name)):
+            yield name[:-len(".jsonl")]
+
+
+class ResponseJournal:
+    """单个对话的回复日志（追加写，JSON Lines 格式）"""
+
+    # 两次刷盘之间的最长间隔（秒），崩溃时最多丢失这段时间内的增量
+    FLUSH_INTERVAL = 0.25
+
+    def __init__(self, conversation_id: str, journal_dir: str = DEFAULT_JOURNAL_DIR, enabled: bool = True):
+        """
+        enabled: 为 False 时不写日志（如只在内存中的对话，重启后无法按ID找回，日志没有意义）
+        """
+        self.conversation_id = conversation_id
+        self.journal_dir = journal_dir
+        self.enabled = enabled
+        self.path = os.path.join(journal_dir, f"{conversation_id}.jsonl")
+        self._file = None
+        self._active = False
+        self._last_flush = 0.0
+
+    @property
+    def active(self) -> bool:
+        """是否有正在记录的回复"""
+        return self._active
+
+    def begin(self, user_input: str):
+        """开始记录一次新的回复"""
+        self._close()
+        self._active = True
+        if not self.enabled:
+            return
+        os.makedirs(self.journal_dir, exist_ok=True)
+        self._file = open(self.path, "w", encoding="utf-8")
+        if fcntl is not None:
+            # 持有锁直到回复结束，进程崩溃时由系统释放
+            try:
+                fcntl.flock(self._file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                logger.warning(f"对话 {self.conversation_id} 的回复日志正被另一个会话写入")
+        self._write({"type": "begin", "user": user_input, "time": time.time()})
+        self._flush()
+
+    def append(self, kind: str, text: str, autoflush: bool = True):
+        """
+        追加一个增量；按时间间隔批量刷盘，避免每个增量一次系统调用。
+        autoflush: 为 False 时只写入缓冲区，由调用方在 flush_due 时调用 flush（如在事件循环外刷盘）
+        """
+        if self._file is None:
+            return
+        self._write({"type": kind, "text": text})
+        if autoflush and self.flush_due:
+            self._flush()
+
+    @property
+    def flush_due(self) -> bool:
+        """距上次刷盘已超过 FLUSH_INTERVAL"""
+        return self._file is not None and time.monotonic() - self._last_flush >= self.FLUSH_INTERVAL
+
+    def flush(self):
+        """立即把缓冲的增量写入磁盘"""
+        if self._file is not None:
+            self._flush()
+
+    @property
+    def stale(self) -> bool:
+        """日志文件残留且已无人写入"""
+        return not self._active and os.path.exists(self.path) and not _in_use(self.path)
+
+    def commit(self):
+        """回复已完整写入历史，删除日志"""
+        self._close()
+        if self.enabled and os.path.exists(self.path):
+            os.remove(self.path)
+
+    def recover_into(self, history) -> bool:
+        """
+        把残留日志中被中断的回复写入 history（已生成的部分作为被中断的助手消息），然后删除日志。
+        返回是否有回复被恢复。
+        """
+        pending = self.pending()
+        if pending is None:
+            return False
+        messages = history.get_recent(1)
+        if not messages or messages[-1]["role"] != "user" or messages[-1]["content"] != pending["user"]:
+            history.add_message("user", pending["user"])
+        history.add_message(
+            "assistant",
+            pending["content"],
+            reasoning_content=pending["reasoning"] or None,
+            interrupted=True
+        )
+        self.commit()
+        logger.info(f"已恢复对话 {self.conversation_id} 被中断的回复（{len(pending['content'])} 字符）")
+        return True
+
+    def pending(self) -> Optional[Dict[str, str]]:
+        """
+        读取残留日志中被中断的回复。
+        返回 {"user": 用户输入, "content": 已生成回答, "reasoning": 已生成推理}，无残留时返回 None。
+        """
+        if not self.enabled or not self.stale:
+            return None
+        user_input = None
+        content: List[str] = []
+        reasoning: List[str] = []
+        with open(self.path, "r", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    # 崩溃时最后一行可能只写了一半
+                    break
+                if record["type"] == "begin":
+                    user_input = record["user"]
+                elif record["type"] == "reasoning":
+                    reasoning.append(record["text"])
+                else:
+                    content.append(record["text"])
+        if user_input is None:
+            return None
+        return {"user": user_input, "content": "".join(content), "reasoning": "".join(reasoning)}
+
+    def _write(self, record: Dict):
+        self._file.write(json.dumps(record, ensure_ascii=False) + "\n")
+
+    def _flush(self):
+        self._file.flush()
+        self._last_flush = time.monotonic()
+
+    def _close(self):
+        self._active = False
+        if self._file is not None:
+            try:
+                self._file.close()
+            except OSError as e:
+                logger.warning(f"关闭回复日志失败: {e}")
+            self._file = None
@@ -1,65 +1,412 @@
 # conversation/manager.py (重构后)
 
-from api.deepseek_client import DeepSeekClient
+from api.deepseek_client import DeepSeekClient, AsyncDeepSeekClient, StreamEvent, REASONING, CONTENT
+from api.response_cache import get_response_cache
 from conversation.history import ConversationHistory
-from prompts.loader import PromptLoader
+from conversation.journal import ResponseJournal
+from prompts.loader import PROMPT_LAYERS, PromptLoader
+from utils.token_counter import count_tokens
+import asyncio
 import logging
-from typing import Generator, List, Dict
+import sys
+import threading
+from typing import Any, AsyncGenerator, Generator, List, Dict, Optional
 
 logger = logging.getLogger(__name__)
 
 class ConversationManager:
     """管理对话流程和状态，接收动态配置"""
 
-    def __init__(self, api_config: dict, prompt_config: dict, prompt_mode_name: str):
+    # 未在配置中指定时使用的模型上下文窗口大小（tokens）
+    DEFAULT_CONTEXT_WINDOW = 65536
+    # 前缀稳定模式下，超出预算时一次性腾出的预算比例
+    DEFAULT_HISTORY_TRIM_RATIO = 0.25
+    # 历史压缩：未摘要的对话超过输入预算的 trigger_ratio 时，在后台把较早的对话
+    # 合并进滚动摘要，只保留最新约 keep_ratio 预算的对话原样发送
+    DEFAULT_COMPACTION_CONFIG = {
+        "enabled": False,
+        "trigger_ratio": 0.5,
+        "keep_ratio": 0.2,
+        "max_summary_tokens": 1024,
+        "model_name": None,  # 默认与对话使用同一模型
+    }
+    COMPACTION_PROMPT = (
+        "请把下面的对话压缩成一份简洁的摘要，供后续对话作为上下文使用。"
+        "保留用户的目标和约束、已经得出的结论和决定、关键的事实、数据、代码和文件名，"
+        "以及尚未解决的问题；省略寒暄和重复内容。直接输出摘要正文。"
+    )
+    # 客户端、回复日志等对象的固定内存开销估计值（字节）；底层连接池为进程共享，不计入
+    BASE_MEMORY_BYTES = 16 * 1024
+
+    def __init__(self, api_config: dict, prompt_config: dict, prompt_mode_name: str,
+                 history: Optional[ConversationHistory] = None):
+        """
+        Args:
+            history: 对话历史存储，默认使用内存中的 ConversationHistory；
+                     传入已有消息的历史（如重新打开的持久化对话）时沿用其中的系统提示
+        """
         self.api_config = api_config
         self.client = DeepSeekClient(
             api_key=api_config['api_key'],
             base_url=api_config['base_url'],
-            model_name=api_config['model_name']
+            model_name=api_config['model_name'],
+            pool_config=api_config.get('connection_pool'),
+            cache=get_response_cache(api_config.get('response_cache'))
+        )
+        self._async_client = None
+        self.history = history if history is not None else ConversationHistory()
+        # 只有持久化的对话在重启后能按ID重新打开，回复日志才有意义
+        self.journal = ResponseJournal(self.history.conversation_id, enabled=self.history.persistent)
+        self.prompt_mode_name = prompt_mode_name
+        self.prompt_loader = PromptLoader(
+            prompt_config, prompt_mode_name, minify=api_config.get("minify_prompts", False)
         )
-        self.history = ConversationHistory()
-        self.prompt_loader = PromptLoader(prompt_config, prompt_mode_name)
+        # 本次对话累计的 token 用量，含上下文缓存命中情况
+        self.usage_stats = {
+            "requests": 0,
+            "prompt_tokens": 0,
+            "completion_tokens": 0,
+            "prompt_cache_hit_tokens": 0,
+            "prompt_cache_miss_tokens": 0,
+            "reasoning_tokens": 0,
+        }
+        # 最近一轮对话失败时的异常（失败时回复中只有错误提示），成功时为 None
+        self.last_error: Optional[Exception] = None
         self._initialized = False
+        self._compaction_thread: Optional[threading.Thread] = None
+        # 正在生成回复时持有，见 _claim_turn
+        self._turn_lock = threading.Lock()
 
     def initialize(self):
         if self._initialized:
             return
-        system_prompt = self.prompt_loader.get_combined_prompt()
-        if system_prompt:
-            self.history.add_message("system", system_prompt)
+        if self.history.count() > 0:
+            # 已有对话：沿用保存的系统提示，保证请求前缀不变
+            self._initialized = True
+            return
+        compiled_prompt = self.prompt_loader.compile()
+        if compiled_prompt.text:
+            self.history.add_message("system", compiled_prompt.text, tokens=compiled_prompt.message_tokens)
             logger.info(f"已加载 {self.prompt_loader.mode_name} 模式的系统提示")
         self._initialized = True
 
     def chat_stream(self, user_input: str) -> Generator[str, None, None]:
+        """流式对话，只产出正式回答文本"""
+        for event in self.chat_stream_events(user_input):
+            if event.kind == CONTENT:
+                yield event.text
+
+    def chat_stream_events(self, user_input: str) -> Generator[StreamEvent, None, None]:
+        """
+        流式对话，推理过程（REASONING）和正式回答（CONTENT）分别作为事件产出。
+        推理文本随助手消息保存以便展示和导出，但不会在后续轮次中发回给API。
+        """
+        self._claim_turn()
+        try:
+            if not self._initialized:
+                self.initialize()
+
+            self.history.add_message("user", user_input)
+            self.journal.begin(user_input)
+            self.last_error = None
+
+            model_params = self._model_params()
+
+            # 分块收集后一次性拼接，避免长回复上字符串反复拼接的平方级开销
+            content_parts: List[str] = []
+            reasoning_parts: List[str] = []
+            try:
+                stream_generator = self.client.chat_stream_events(
+                    messages=self._request_messages(model_params["max_tokens"]),
+                    **model_params
+                )
+                for event in stream_generator:
+                    if event.kind == REASONING:
+                        reasoning_parts.append(event.text)
+                    else:
+                        content_parts.append(event.text)
+                    self.journal.append(event.kind, event.text)
+                    yield event
+
+                self._record_usage(self.client.last_usage, "".join(reasoning_parts))
+                self._save_response(content_parts, reasoning_parts)
+            except GeneratorExit:
+                # 调用方提前结束（如 Streamlit 重新运行），保留已生成的部分
+                self._save_response(content_parts, reasoning_parts, interrupted=True)
+                raise
+            except Exception as e:
+                self.last_error = e
+                error_msg = f"抱歉，处理您的请求时出现错误: {str(e)}"
+                logger.error(f"流式对话出错: {e}")
+                self.history.add_message("assistant", error_msg)
+                self.journal.commit()
+                yield StreamEvent(CONTENT, error_msg)
+        finally:
+            self._turn_lock.release()
+
+    async def achat_stream(self, user_input: str) -> AsyncGenerator[str, None]:
+        """chat_stream 的异步版本，供批处理和服务端在单个事件循环中并发驱动"""
+        async for event in self.achat_stream_events(user_input):
+            if event.kind == CONTENT:
+                yield event.text
+
+    async def achat_stream_events(self, user_input: str) -> AsyncGenerator[StreamEvent, None]:
+        """
+        chat_stream_events 的异步版本。
+        历史读写、回复日志刷盘和token计数都在线程池中执行，不阻塞事件循环上的其他对话。
+        """
+        self._claim_turn()
+        try:
+            model_params = self._model_params()
+            self.last_error = None
+            messages = await asyncio.to_thread(self._begin_turn, user_input, model_params["max_tokens"])
+
+            # 分块收集后一次性拼接，避免长回复上字符串反复拼接的平方级开销
+            content_parts: List[str] = []
+            reasoning_parts: List[str] = []
+            try:
+                stream_generator = self.async_client.chat_stream_events(messages=messages, **model_params)
+                async for event in stream_generator:
+                    if event.kind == REASONING:
+                        reasoning_parts.append(event.text)
+                    else:
+                        content_parts.append(event.text)
+                    self.journal.append(event.kind, event.text, autoflush=False)
+                    if self.journal.flush_due:
+                        await asyncio.to_thread(self.journal.flush)
+                    yield event
+
+                await asyncio.to_thread(self._finish_turn, content_parts, reasoning_parts, self.async_client.last_usage)
+            except GeneratorExit:
+                # 调用方提前结束（如客户端断开），保留已生成的部分
+                await asyncio.to_thread(self._save_response, content_parts, reasoning_parts, True)
+                raise
+            except Exception as e:
+                self.last_error = e
+                error_msg = f"抱歉，处理您的请求时出现错误: {str(e)}"
+                logger.error(f"流式对话出错: {e}")
+                await asyncio.to_thread(self._save_error, error_msg)
+                yield StreamEvent(CONTENT, error_msg)
+        finally:
+            self._turn_lock.release()
+
+    def _claim_turn(self):
+        """同一会话同时只能有一轮回复在生成，上一轮未结束时拒绝新的一轮，避免两轮的消息交错写入历史"""
+        if not self._turn_lock.acquire(blocking=False):
+            raise RuntimeError("上一轮回复仍在生成中，请等待完成后再发送")
+
+    def _begin_turn(self, user_input: str, max_tokens: int) -> List[Dict[str, str]]:
+        """记录用户消息、开始回复日志，返回本轮请求的消息"""
         if not self._initialized:
             self.initialize()
-        
         self.history.add_message("user", user_input)
-        
-        model_params = {
+        self.journal.begin(user_input)
+        return self._request_messages(max_tokens)
+
+    def _finish_turn(self, content_parts: List[str], reasoning_parts: List[str], usage: Dict[str, int]):
+        self._record_usage(usage, "".join(reasoning_parts))
+        self._save_response(content_parts, reasoning_parts)
+
+    def _save_error(self, error_msg: str):
+        self.history.add_message("assistant", error_msg)
+        self.journal.commit()
+
+    def _save_response(self, content_parts: List[str], reasoning_parts: List[str], interrupted: bool = False):
+        """把回复写入历史并清除对应的回复日志"""
+        reasoning = "".join(reasoning_parts)
+        self.history.add_message(
+            "assistant",
+            "".join(content_parts),
+            reasoning_content=reasoning or None,
+            interrupted=interrupted
+        )
+        self.journal.commit()
+        self._maybe_compact()
+
+    def _compaction_config(self) -> Dict:
+        config = dict(self.DEFAULT_COMPACTION_CONFIG)
+        config.update(self.api_config.get("compaction") or {})
+        return config
+
+    def _maybe_compact(self):
+        """历史超过阈值时在后台线程中生成滚动摘要，不阻塞当前和下一轮对话"""
+        config = self._compaction_config()
+        if not config["enabled"]:
+            return
+        if self._compaction_thread is not None and self._compaction_thread.is_alive():
+            return
+        budget = self._input_token_budget(self._model_params()["max_tokens"])
+        if self.history.uncompacted_tokens() <= budget * config["trigger_ratio"]:
+            return
+        cut = self.history.compaction_cut(int(budget * config["keep_ratio"]))
+        if cut is None:
+            return
+        self._compaction_thread = threading.Thread(
+            target=self._compact, args=(cut, budget, config), name="history-compaction", daemon=True
+        )
+        self._compaction_thread.start()
+
+    def _compact(self, cut: int, budget: int, config: Dict):
+        """把摘要终点 cut 之前的对话（连同之前的摘要）合并为新的摘要"""
+        previous_summary, start = self.history.summary_state()
+        messages = self.history.get_range(start, cut)
+        turns = [
+            f"{'用户' if message['role'] == 'user' else '助手'}: {message['content']}"
+            for message in messages
+        ]
+        # 摘要请求本身也不能超出上下文窗口，过长时丢弃最早的消息
+        remaining = budget - count_tokens(previous_summary)
+        kept: List[str] = []
+        for turn in reversed(turns):
+            remaining -= count_tokens(turn)
+            if remaining < 0 and kept:
+                break
+            kept.append(turn)
+        dropped = len(turns) - len(kept)
+        if dropped:
+            # 这些消息既不会进入摘要，摘要生效后也不再发送给模型
+            logger.warning(
+                f"待摘要的对话超出上下文窗口，消息 [{start}, {cut}) 中最早的 {dropped} 条未纳入摘要"
+                f"（{messages[0]['timestamp']} ~ {messages[dropped - 1]['timestamp']}）"
+            )
+        transcript = ([f"[早期对话摘要]\n{previous_summary}"] if previous_summary else []) + kept[::-1]
+
+        # 独立的客户端实例，避免与进行中的对话请求互相覆盖 last_usage；底层连接池仍是共享的
+        client = DeepSeekClient(
+            api_key=self.api_config['api_key'],
+            base_url=self.api_config['base_url'],
+            model_name=config["model_name"] or self.api_config['model_name'],
+            pool_config=self.api_config.get('connection_pool')
+        )
+        try:
+            summary = client.chat(
+                [{"role": "system", "content": self.COMPACTION_PROMPT},
+                 {"role": "user", "content": "\n\n".join(transcript)}],
+                temperature=0.3,
+                max_tokens=config["max_summary_tokens"]
+            )
+        except Exception as e:
+            logger.warning(f"生成对话摘要失败，下一轮回复后重试: {e}")
+            return
+        if not summary or not self.history.set_summary(summary.strip(), cut, expected_until=start):
+            # 生成期间历史被清空或已有更新的摘要
+            return
+        logger.info(f"已压缩对话历史：前 {cut} 条消息合并为摘要（{count_tokens(summary)} tokens）")
+
+    def wait_for_compaction(self, timeout: Optional[float] = None):
+        """等待进行中的后台压缩完成（批处理和测试中使用）"""
+        if self._compaction_thread is not None:
+            self._compaction_thread.join(timeout)
+
+    def recover_interrupted(self) -> bool:
+        """
+        恢复上一次被中断（如进程崩溃）的回复：已生成的部分作为助手消息写入历史，不再重新生成。
+        返回是否有回复被恢复。
+        """
+        return self.journal.recover_into(self.history)
+
+    def is_busy(self) -> bool:
+        """是否正在生成回复或在后台压缩历史（此时不应换出或关闭）"""
+        if self._turn_lock.locked() or self.journal.active:
+            return True
+        return self._compaction_thread is not None and self._compaction_thread.is_alive()
+
+    def memory_bytes(self) -> int:
+        """本会话内存占用的估计值（字节）"""
+        prompt_bytes = sum(sys.getsizeof(getattr(self.prompt_loader, layer)) for layer in PROMPT_LAYERS)
+        return self.BASE_MEMORY_BYTES + prompt_bytes + self.history.memory_bytes()
+
+    def snapshot(self) -> Dict[str, Any]:
+        """可 JSON 序列化的会话状态（不含API配置），restore 可据此还原"""
+        return {
+            "history_type": type(self.history).__name__,
+            "history": self.history.snapshot(),
+            "prompt_config": {layer: getattr(self.prompt_loader, layer) for layer in PROMPT_LAYERS},
+            "prompt_mode_name": self.prompt_mode_name,
+            "usage_stats": dict(self.usage_stats),
+            "initialized": self._initialized,
+        }
+
+    @classmethod
+    def restore(cls, state: Dict[str, Any], api_config: dict,
+                history: ConversationHistory) -> "ConversationManager":
+        """用 snapshot 的结果和已还原的历史重建会话；API配置由调用方传入，不写入磁盘"""
+        manager = cls(api_config, state["prompt_config"], state["prompt_mode_name"], history=history)
+        manager.usage_stats.update(state["usage_stats"])
+        manager._initialized = state["initialized"]
+        return manager
+
+    def close(self):
+        """释放历史存储占用的资源（如数据库连接）"""
+        self.history.close()
+
+    @property
+    def async_client(self) -> AsyncDeepSeekClient:
+        """按需创建的异步客户端，与同步客户端使用相同的配置"""
+        if self._async_client is None:
+            self._async_client = AsyncDeepSeekClient(
+                api_key=self.api_config['api_key'],
+                base_url=self.api_config['base_url'],
+                model_name=self.api_config['model_name'],
+                pool_config=self.api_config.get('connection_pool')
+            )
+        return self._async_client
+
+    def _model_params(self) -> Dict:
+        """从API配置中提取模型参数"""
+        return {
             "temperature": self.api_config.get("temperature", 1.0),
             "max_tokens": self.api_config.get("max_tokens", 4096),
             "top_p": self.api_config.get("top_p", 0.95),
             # 其他参数可以类似添加
         }
 
-        try:
-            full_response = ""
-            stream_generator = self.client.chat_stream(
-                messages=self.history.get_messages(),
-                **model_params
-            )
-            for chunk in stream_generator:
-                full_response += chunk
-                yield chunk
-            
-            self.history.add_message("assistant", full_response)
-        except Exception as e:
-            error_msg = f"抱歉，处理您的请求时出现错误: {str(e)}"
-            logger.error(f"流式对话出错: {e}")
-            yield error_msg
-            self.history.add_message("assistant", error_msg)
+    def _input_token_budget(self, max_tokens: int) -> int:
+        """上下文窗口中扣除为输出预留的 max_tokens 后剩余的输入预算"""
+        context_window = self.api_config.get("context_window", self.DEFAULT_CONTEXT_WINDOW)
+        return max(context_window - max_tokens, 0)
+
+    def _request_messages(self, max_tokens: int) -> List[Dict[str, str]]:
+        """
+        组装发送给API的消息。
+        默认启用前缀稳定模式：系统提示和早期对话逐字节保持不变，
+        历史只在超出预算时成块裁剪，以便持续命中服务端上下文缓存。
+        """
+        trim_ratio = None
+        if self.api_config.get("stable_prefix", True):
+            trim_ratio = self.api_config.get("history_trim_ratio", self.DEFAULT_HISTORY_TRIM_RATIO)
+        return self.history.get_messages(
+            token_budget=self._input_token_budget(max_tokens),
+            trim_ratio=trim_ratio
+        )
+
+    def _record_usage(self, usage: Dict[str, int], reasoning: str = ""):
+        """累计单次请求的 token 用量"""
+        if not usage:
+            return
+        self.usage_stats["requests"] += 1
+        for key in ("prompt_tokens", "completion_tokens", "prompt_cache_hit_tokens", "prompt_cache_miss_tokens"):
+            self.usage_stats[key] += usage.get(key, 0)
+        # 服务端未返回推理 token 数时按推理文本估算
+        self.usage_stats["reasoning_tokens"] += usage.get("reasoning_tokens") or count_tokens(reasoning)
+        logger.info(
+            f"上下文缓存: 命中 {usage.get('prompt_cache_hit_tokens', 0)} / "
+            f"未命中 {usage.get('prompt_cache_miss_tokens', 0)} tokens"
+        )
+
+    def prompt_cache_hit_rate(self) -> float:
+        """本次对话中输入token的上下文缓存命中率"""
+        hit = self.usage_stats["prompt_cache_hit_tokens"]
+        total = hit + self.usage_stats["prompt_cache_miss_tokens"]
+        return hit / total if total else 0.0
 
     def get_history(self) -> List[Dict[str, str]]:
         return self.history.get_all_messages()
+
+    def get_recent_history(self, n: int) -> List[Dict[str, str]]:
+        """只读取最新的 n 条消息，供界面分窗口显示"""
+        return self.history.get_recent(n)
+
+    def dialog_count(self) -> int:
+        """对话消息（不含系统提示）总数"""
+        return self.history.dialog_count()
@@ -0,0 +1,383 @@
+# conversation/session_pool.py
+
+"""
+有内存上限的会话池
+
+界面的每个浏览器会话、服务端的每个对话都对应一个 ConversationManager。
+会话池按键（界面会话ID或对话ID）保存这些实例，估算的总内存超过上限时，
+按最近最少使用的顺序把空闲的会话换出到磁盘（gzip 压缩的 JSON 快照）并释放，
+再次访问时从快照透明地还原。
+
+- 持久化到 SQLite 的对话，快照只记录对话ID等打开参数，还原时只重新加载元数据
+- 正在生成回复、后台压缩中，或在 idle_seconds 内被访问过的会话不会被换出
+- API配置不写入快照，还原时由调用方传入当前配置
+"""
+import gzip
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Dict, List, Optional, Set, Tuple
+
+from conversation.history import ConversationHistory
+from conversation.manager import ConversationManager
+from conversation.sqlite_history import SQLiteConversationHistory
+
+logger = logging.getLogger(__name__)
+
+# 默认会话池配置
+DEFAULT_POOL_CONFIG = {
+    "max_memory_mb": 256,
+    "idle_seconds": 60,
+    "spill_dir": "output/sessions",
+    # 超过该时长（秒）未被访问的快照视为已废弃（如浏览器标签已关闭），启动时和运行中定期清理
+    "spill_ttl": 7 * 24 * 3600,
+}
+
+_HISTORY_TYPES = {cls.__name__: cls for cls in (ConversationHistory, SQLiteConversationHistory)}
+
+# 清理过期快照的最短间隔（秒）
+_PURGE_INTERVAL = 3600
+
+
+class _Entry:
+    """常驻内存的会话"""
+    __slots__ = ("manager", "bytes", "last_used")
+
+    def __init__(self, manager: ConversationManager):
+        self.manager = manager
+        self.bytes = manager.memory_bytes()
+        self.last_used = time.monotonic()
+
+
+class SessionPool:
+    """
+    按 LRU 换出空闲会话的会话池
+
+    锁只保护内存中的状态：换出时先在锁内把会话标记为换出中，再在锁外写快照；
+    还原时同样在锁外读快照，同一会话的并发还原只执行一次。
+    """
+
+    def __init__(self, max_bytes: int = 256 * 1024 * 1024, idle_seconds: float = 60,
+                 spill_dir: str = "output/sessions", spill_ttl: float = 7 * 24 * 3600):
+        """
+        Args:
+            max_bytes: 常驻会话估算内存的上限
+            idle_seconds: 最近这段时间内被访问过的会话不会被换出
+            spill_dir: 换出快照的保存目录
+            spill_ttl: 快照的保留时长（秒）
+        """
+        self.max_bytes = max_bytes
+        self.idle_seconds = idle_seconds
+        self.spill_dir = spill_dir
+        self.spill_ttl = spill_ttl
+        self.rehydrations = 0
+        self.evictions = 0
+        self._resident: "OrderedDict[str, _Entry]" = OrderedDict()
+        # 正在写快照的会话；写完前再次访问会取消换出
+        self._spilling: Dict[str, _Entry] = {}
+        # 正在从快照还原的会话，其他线程等待还原完成
+        self._loading: Dict[str, threading.Event] = {}
+        # 本进程换出的会话及其快照大小（字节）
+        self._spilled: Dict[str, int] = {}
+        # 访问过的会话、其中至少从快照还原过一次的会话（界面每次重新运行都会取一次会话，
+        # 按次数统计的命中率没有意义，因此按会话统计）
+        self._seen: Set[str] = set()
+        self._rehydrated: Set[str] = set()
+        self._lock = threading.Lock()
+        self._last_purge = 0.0
+        os.makedirs(spill_dir, exist_ok=True)
+        self._purge_expired()
+
+    def get(self, key: str, api_config: dict) -> Optional[ConversationManager]:
+        """
+        取出会话：常驻内存时直接返回，已换出时从快照还原，都没有时返回 None。
+        api_config: 还原时使用的API配置（与新建会话时传入的相同）
+        """
+        return self.get_or_create(key, api_config)
+
+    def get_or_create(self, key: str, api_config: dict,
+                      factory: Optional[Callable[[], ConversationManager]] = None) -> Optional[ConversationManager]:
+        """
+        与 get 相同，但会话既不常驻也没有快照时调用 factory 创建并放入会话池。
+        同一个键的并发调用只会还原或创建一次，其余调用等待并得到同一个会话；
+        factory 抛出的异常原样传给调用方
+        """
+        while True:
+            with self._lock:
+                self._seen.add(key)
+                manager = self._touch(key)
+                if manager is not None:
+                    victims = self._select_victims()
+                    break
+                loading = self._loading.get(key)
+                if loading is None:
+                    loading = self._loading[key] = threading.Event()
+                    break
+            # 其他线程正在还原或创建同一会话，等待完成后重新查找
+            loading.wait()
+
+        if manager is None:
+            manager, victims = self._load(key, api_config, loading, factory)
+        self._spill_all(victims)
+        return manager
+
+    def put(self, key: str, manager: ConversationManager):
+        """放入（或替换）会话；被替换的旧会话会被关闭"""
+        with self._lock:
+            previous = self._resident.pop(key, None)
+            self._spilling.pop(key, None)
+            self._loading.pop(key, None)
+            self._spilled.pop(key, None)
+            self._resident[key] = _Entry(manager)
+            victims = self._select_victims()
+        if previous is not None and previous.manager is not manager:
+            self._close(previous.manager)
+        self._remove_snapshot(key)
+        self._spill_all(victims)
+
+    def discard(self, key: str):
+        """移除会话（包括已换出的快照），如开始新对话时丢弃当前会话"""
+        with self._lock:
+            entry = self._resident.pop(key, None)
+            self._spilling.pop(key, None)
+            self._loading.pop(key, None)
+            self._spilled.pop(key, None)
+        if entry is not None:
+            self._close(entry.manager)
+        self._remove_snapshot(key)
+
+    def _touch(self, key: str) -> Optional[ConversationManager]:
+        """取出常驻（或正在换出）的会话并标记为最近使用；需持有锁"""
+        entry = self._resident.get(key)
+        if entry is not None:
+            self._resident.move_to_end(key)
+        else:
+            entry = self._spilling.pop(key, None)
+            if entry is None:
+                return None
+            # 取消换出，已写出的快照由换出线程丢弃
+            self._resident[key] = entry
+        entry.last_used = time.monotonic()
+        return entry.manager
+
+    def _select_victims(self) -> List[Tuple[str, _Entry]]:
+        """
+        刷新常驻会话的内存估计，超过上限时从最久未使用的空闲会话开始标记为换出中；
+        需持有锁，返回的会话由调用方在锁外写快照
+        """
+        total = 0
+        for entry in self._resident.values():
+            entry.bytes = entry.manager.memory_bytes()
+            total += entry.bytes
+        victims = []
+        if total > self.max_bytes:
+            now = time.monotonic()
+            for key, entry in list(self._resident.items()):
+                if total <= self.max_bytes:
+                    break
+                if now - entry.last_used < self.idle_seconds or entry.manager.is_busy():
+                    continue
+                del self._resident[key]
+                self._spilling[key] = entry
+                victims.append((key, entry))
+                total -= entry.bytes
+            if total > self.max_bytes:
+                logger.info(f"会话池超出内存上限（{total} / {self.max_bytes} 字节），其余会话均在使用中")
+        return victims
+
+    def _spill_all(self, victims: List[Tuple[str, _Entry]]):
+        """在锁外写出被标记的会话，并按需清理过期快照"""
+        for key, entry in victims:
+            self._spill(key, entry)
+        with self._lock:
+            purge_due = time.monotonic() - self._last_purge >= _PURGE_INTERVAL
+            if purge_due:
+                self._last_purge = time.monotonic()
+        if purge_due:
+            self._purge_expired()
+
+    def _spill_path(self, key: str) -> str:
+        digest = hashlib.sha1(key.encode("utf-8")).hexdigest()
+        return os.path.join(self.spill_dir, f"{digest}.json.gz")
+
+    def _spill(self, key: str, entry: _Entry):
+        """把会话快照写入磁盘并关闭会话；写入期间会话被再次访问或移除时丢弃快照"""
+        path = self._spill_path(key)
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        try:
+            with gzip.open(tmp_path, "wt", encoding="utf-8", compresslevel=5) as f:
+                json.dump(entry.manager.snapshot(), f, ensure_ascii=False, separators=(",", ":"))
+            size = os.path.getsize(tmp_path)
+        except Exception as e:
+            logger.warning(f"换出会话 {key} 失败，保留在内存中: {e}")
+            self._remove_file(tmp_path)
+            with self._lock:
+                if self._spilling.get(key) is entry:
+                    del self._spilling[key]
+                    self._resident[key] = entry
+                    self._resident.move_to_end(key, last=False)
+            return
+
+        with self._lock:
+            committed = self._spilling.get(key) is entry
+            if committed:
+                # 改名与状态更新在同一临界区内完成，否则并发的还原可能找不到快照
+                del self._spilling[key]
+                os.replace(tmp_path, path)
+                self._spilled[key] = size
+                self.evictions += 1
+            reclaimed = self._resident.get(key) is entry
+        if not committed:
+            self._remove_file(tmp_path)
+        if not reclaimed:
+            self._close(entry.manager)
+
+    def _load(self, key: str, api_config: dict, loading: threading.Event,
+              factory: Optional[Callable[[], ConversationManager]] = None
+              ) -> Tuple[Optional[ConversationManager], List[Tuple[str, _Entry]]]:
+        """在锁外从快照还原（或用 factory 创建）会话，完成后放入常驻会话并唤醒等待的线程"""
+        manager = None
+        rehydrated = False
+        victims = []
+        try:
+            manager = self._rehydrate(key, api_config)
+            rehydrated = manager is not None
+            if manager is None and factory is not None:
+                manager = factory()
+        finally:
+            with self._lock:
+                if self._loading.get(key) is loading:
+                    del self._loading[key]
+                    self._spilled.pop(key, None)
+                    if manager is not None:
+                        self._resident[key] = _Entry(manager)
+                        if rehydrated:
+                            self._rehydrated.add(key)
+                            self.rehydrations += 1
+                        victims = self._select_victims()
+                    stale = None
+                else:
+                    # 还原期间会话被替换或移除，以当前状态为准
+                    stale = manager
+                    manager = self._touch(key)
+            loading.set()
+        if stale is not None:
+            self._close(stale)
+        return manager, victims
+
+    def _rehydrate(self, key: str, api_config: dict) -> Optional[ConversationManager]:
+        """从快照还原会话，成功后删除快照"""
+        path = self._spill_path(key)
+        if not os.path.exists(path):
+            return None
+        try:
+            with gzip.open(path, "rt", encoding="utf-8") as f:
+                state = json.load(f)
+            history = _HISTORY_TYPES[state["history_type"]].restore(state["history"])
+            manager = ConversationManager.restore(state, api_config, history)
+        except Exception as e:
+            logger.warning(f"还原会话 {key} 失败，丢弃快照: {e}")
+            manager = None
+        self._remove_file(path)
+        return manager
+
+    def _remove_snapshot(self, key: str):
+        self._remove_file(self._spill_path(key))
+
+    @staticmethod
+    def _remove_file(path: str):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+    @staticmethod
+    def _close(manager: ConversationManager):
+        # 仍在后台压缩的会话由压缩线程持有，结束后随对象一起释放
+        if not manager.is_busy():
+            manager.close()
+
+    def _purge_expired(self):
+        """删除长时间未被访问的快照，并忘记已不存在的会话"""
+        self._last_purge = time.monotonic()
+        cutoff = time.time() - self.spill_ttl
+        existing = set()
+        for name in os.listdir(self.spill_dir):
+            path = os.path.join(self.spill_dir, name)
+            try:
+                if os.path.getmtime(path) < cutoff:
+                    os.remove(path)
+                else:
+                    existing.add(path)
+            except OSError:
+                continue
+        with self._lock:
+            self._spilled = {
+                key: size for key, size in self._spilled.items() if self._spill_path(key) in existing
+            }
+            live = set(self._resident) | set(self._spilling) | set(self._loading) | set(self._spilled)
+            self._seen &= live
+            self._rehydrated &= live
+
+    def stats(self) -> Dict[str, Any]:
+        """会话池统计：常驻/换出的会话数、估算内存、需要从快照还原的会话数等"""
+        with self._lock:
+            return {
+                "resident": len(self._resident),
+                "spilled": len(self._spilled),
+                "resident_bytes": sum(entry.bytes for entry in self._resident.values()),
+                "spilled_bytes": sum(self._spilled.values()),
+                "max_bytes": self.max_bytes,
+                "sessions": len(self._seen),
+                "rehydrated_sessions": len(self._rehydrated),
+                "rehydrations": self.rehydrations,
+                "evictions": self.evictions,
+            }
+
+    def session_stats(self) -> List[Dict[str, Any]]:
+        """每个常驻会话的估算内存和空闲时间，按内存降序"""
+        with self._lock:
+            now = time.monotonic()
+            sessions = [
+                {
+                    "key": key,
+                    "conversation_id": entry.manager.history.conversation_id,
+                    "bytes": entry.bytes,
+                    "messages": entry.manager.history.count(),
+                    "idle_seconds": round(now - entry.last_used, 1),
+                    "busy": entry.manager.is_busy(),
+                }
+                for key, entry in self._resident.items()
+            ]
+        sessions.sort(key=lambda session: session["bytes"], reverse=True)
+        return sessions
+
+    def session_bytes(self, key: str) -> Optional[int]:
+        """单个常驻会话的估算内存，未常驻时返回 None"""
+        with self._lock:
+            entry = self._resident.get(key)
+            return entry.bytes if entry is not None else None
+
+
+_shared_pool: Optional[SessionPool] = None
+_shared_lock = threading.Lock()
+
+
+def get_session_pool(pool_config: Optional[Dict[str, Any]] = None) -> SessionPool:
+    """获取进程内共享的会话池，配置只在首次创建时生效"""
+    global _shared_pool
+    config = dict(DEFAULT_POOL_CONFIG)
+    config.update(pool_config or {})
+    with _shared_lock:
+        if _shared_pool is None:
+            _shared_pool = SessionPool(
+                max_bytes=int(config["max_memory_mb"] * 1024 * 1024),
+                idle_seconds=config["idle_seconds"],
+                spill_dir=config["spill_dir"],
+                spill_ttl=config["spill_ttl"]
+            )
+    return _shared_pool
@@ -0,0 +1,466 @@
+# conversation/sqlite_history.py
+
+"""
+基于 SQLite 的持久化对话历史
+
+每条消息一行，数据库使用 WAL 模式，读写互不阻塞。
+打开对话时只加载角色和token数等元数据，消息内容按需分窗口读取，
+即使是上千条消息的长对话，界面和API路径也只读取需要的尾部。
+
+用户和助手消息在写入时同步加入全文索引（utils.text_search），
+search_messages 可以跨对话检索，并按提示模式、模型和日期过滤。
+"""
+import os
+import sqlite3
+import threading
+from contextlib import contextmanager
+from datetime import datetime
+from typing import Any, Dict, Iterator, List, Optional, Set, Tuple
+
+from conversation.history import ConversationHistory
+from conversation.journal import DEFAULT_JOURNAL_DIR, ResponseJournal, pending_journals
+from utils.text_search import SearchIndex
+from utils.token_counter import count_message_tokens
+
+DEFAULT_DB_PATH = "output/history.db"
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS conversations (
+    id TEXT PRIMARY KEY,
+    title TEXT NOT NULL DEFAULT '',
+    mode_name TEXT NOT NULL DEFAULT '',
+    model_name TEXT NOT NULL DEFAULT '',
+    created TEXT NOT NULL,
+    updated TEXT NOT NULL,
+    message_count INTEGER NOT NULL DEFAULT 0,
+    window_start INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS idx_conversations_updated ON conversations(updated);
+CREATE TABLE IF NOT EXISTS messages (
+    conversation_id TEXT NOT NULL,
+    seq INTEGER NOT NULL,
+    role TEXT NOT NULL,
+    content TEXT NOT NULL,
+    reasoning_content TEXT,
+    interrupted INTEGER NOT NULL DEFAULT 0,
+    tokens INTEGER NOT NULL,
+    timestamp TEXT NOT NULL,
+    PRIMARY KEY (conversation_id, seq)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS message_refs (
+    id INTEGER PRIMARY KEY,
+    conversation_id TEXT NOT NULL,
+    seq INTEGER NOT NULL,
+    UNIQUE (conversation_id, seq)
+);
+"""
+
+# 全文索引的文档ID为 message_refs.id（messages 表没有整数主键）
+_message_index = SearchIndex("message_search")
+
+# 数据库结构版本（PRAGMA user_version），低于该版本时在打开时依次迁移：
+# 1 - 已有消息建立全文索引；2 - conversations 增加滚动摘要字段；
+# 3 - 分词规则变化（SearchIndex.TOKENIZER_VERSION = 2，支持单字检索），重建全文索引
+_SCHEMA_VERSION = 3
+
+# 检索结果中摘要的长度（字符）
+SNIPPET_LENGTH = 80
+
+# 对话标题取首条用户消息的前若干个字符
+TITLE_LENGTH = 50
+
+
+# 本进程中已完成建表和迁移检查的数据库
+_prepared_paths: Set[str] = set()
+_prepare_lock = threading.Lock()
+
+# 模块级查询函数共用的连接：{数据库路径: (连接, 锁)}
+_shared_connections: Dict[str, Tuple[sqlite3.Connection, threading.Lock]] = {}
+
+
+def connect(db_path: str = DEFAULT_DB_PATH) -> sqlite3.Connection:
+    """打开历史数据库；WAL 模式设置、建表和迁移检查每个进程对每个数据库只执行一次"""
+    os.makedirs(os.path.dirname(db_path) or ".", exist_ok=True)
+    conn = sqlite3.connect(db_path, check_same_thread=False, isolation_level=None)
+    conn.row_factory = sqlite3.Row
+    conn.execute("PRAGMA synchronous=NORMAL")
+    key = os.path.abspath(db_path)
+    if key not in _prepared_paths:
+        with _prepare_lock:
+            if key not in _prepared_paths:
+                conn.execute("PRAGMA journal_mode=WAL")
+                conn.executescript(_SCHEMA)
+                _message_index.create_tables(conn)
+                if conn.execute("PRAGMA user_version").fetchone()[0] < _SCHEMA_VERSION:
+                    _migrate(conn)
+                _prepared_paths.add(key)
+    return conn
+
+
+@contextmanager
+def _shared_connection(db_path: str) -> Iterator[sqlite3.Connection]:
+    """取得该数据库的共用连接（按需打开，之后一直复用），使用期间独占"""
+    key = os.path.abspath(db_path)
+    with _prepare_lock:
+        shared = _shared_connections.get(key)
+    if shared is None:
+        shared = (connect(db_path), threading.Lock())
+        with _prepare_lock:
+            shared = _shared_connections.setdefault(key, shared)
+    conn, lock = shared
+    with lock:
+        yield conn
+
+
+def _migrate(conn: sqlite3.Connection):
+    """把旧版本的数据库升级到当前结构（在一个事务中完成，多个进程同时打开也只执行一次）"""
+    with conn:
+        conn.execute("BEGIN IMMEDIATE")
+        version = conn.execute("PRAGMA user_version").fetchone()[0]
+        if version < 1:
+            _build_message_index(conn)
+        if version < 2:
+            conn.execute("ALTER TABLE conversations ADD COLUMN summary TEXT NOT NULL DEFAULT ''")
+            conn.execute("ALTER TABLE conversations ADD COLUMN summary_until INTEGER NOT NULL DEFAULT 0")
+        if 1 <= version < 3:
+            _reindex_messages(conn)
+        conn.execute(f"PRAGMA user_version = {_SCHEMA_VERSION}")
+
+
+def _index_message_content(conn: sqlite3.Connection, conversation_id: str, seq: int, content: str):
+    """把一条消息加入全文索引；需在调用方的事务中执行"""
+    cursor = conn.execute(
+        "INSERT INTO message_refs (conversation_id, seq) VALUES (?, ?)", (conversation_id, seq)
+    )
+    _message_index.index_document(conn, cursor.lastrowid, content)
+
+
+def _unindex_conversation(conn: sqlite3.Connection, conversation_id: str):
+    """从全文索引中移除一个对话的全部消息；需在调用方的事务中执行"""
+    ref_ids = [row[0] for row in conn.execute(
+        "SELECT id FROM message_refs WHERE conversation_id = ?", (conversation_id,)
+    )]
+    for ref_id in ref_ids:
+        _message_index.remove_document(conn, ref_id)
+    conn.execute("DELETE FROM message_refs WHERE conversation_id = ?", (conversation_id,))
+
+
+def _build_message_index(conn: sqlite3.Connection):
+    """为建立索引之前保存的消息补建全文索引；需在调用方的事务中执行"""
+    rows = conn.execute(
+        "SELECT conversation_id, seq, content FROM messages WHERE role != 'system' "
+        "AND NOT EXISTS (SELECT 1 FROM message_refs r "
+        "WHERE r.conversation_id = messages.conversation_id AND r.seq = messages.seq)"
+    ).fetchall()
+    for row in rows:
+        _index_message_content(conn, row["conversation_id"], row["seq"], row["content"])
+
+
+def _reindex_messages(conn: sqlite3.Connection):
+    """按当前分词规则重新写入已索引消息的全文索引；需在调用方的事务中执行"""
+    rows = conn.execute(
+        "SELECT r.id, m.content FROM message_refs r "
+        "JOIN messages m ON m.conversation_id = r.conversation_id AND m.seq = r.seq"
+    ).fetchall()
+    for row in rows:
+        _message_index.index_document(conn, row["id"], row["content"])
+
+
+def list_conversations(db_path: str = DEFAULT_DB_PATH, limit: int = 20, offset: int = 0) -> List[Dict[str, Any]]:
+    """按最近更新时间列出已保存的对话（不含消息内容）"""
+    with _shared_connection(db_path) as conn:
+        rows = conn.execute(
+            "SELECT id, title, mode_name, model_name, created, updated, message_count "
+            "FROM conversations WHERE message_count > 0 ORDER BY updated DESC LIMIT ? OFFSET ?",
+            (limit, offset)
+        ).fetchall()
+        return [dict(row) for row in rows]
+
+
+def _snippet(content: str, query_terms: List[str]) -> str:
+    """截取消息中第一个命中词附近的一段文字"""
+    lowered = content.lower()
+    positions = [pos for pos in (lowered.find(term) for term in query_terms) if pos >= 0]
+    start = max(min(positions, default=0) - SNIPPET_LENGTH // 4, 0)
+    snippet = content[start:start + SNIPPET_LENGTH].replace("\n", " ")
+    return ("…" if start > 0 else "") + snippet + ("…" if start + SNIPPET_LENGTH < len(content) else "")
+
+
+def search_messages(query: str, mode_name: Optional[str] = None, model_name: Optional[str] = None,
+                    since: Optional[str] = None, until: Optional[str] = None, limit: int = 20,
+                    db_path: str = DEFAULT_DB_PATH) -> List[Dict[str, Any]]:
+    """
+    在所有已保存的对话中全文检索消息，按相关度（BM25）降序返回。
+    Args:
+        mode_name, model_name: 只检索该提示模式/模型下的对话
+        since, until: 消息时间范围（ISO 格式日期或时间，含两端；只给日期时 until 包含当天）
+    Returns:
+        [{"conversation_id", "seq", "role", "snippet", "timestamp", "title",
+          "mode_name", "model_name", "score"}]
+    """
+    conditions, params = [], []
+    if mode_name:
+        conditions.append("c.mode_name = ?")
+        params.append(mode_name)
+    if model_name:
+        conditions.append("c.model_name = ?")
+        params.append(model_name)
+    if since:
+        conditions.append("m.timestamp >= ?")
+        params.append(since)
+    if until:
+        # 时间戳是 ISO 字符串，"2024-05-01" 之后补上 "\uffff" 使当天的所有时间都不大于上界
+        conditions.append("m.timestamp <= ?")
+        params.append(until + "\uffff")
+    doc_filter = ""
+    if conditions:
+        doc_filter = (
+            "EXISTS (SELECT 1 FROM message_refs r JOIN conversations c ON c.id = r.conversation_id "
+            "JOIN messages m ON m.conversation_id = r.conversation_id AND m.seq = r.seq "
+            "WHERE r.id = d.doc_id AND " + " AND ".join(conditions) + ")"
+        )
+
+    with _shared_connection(db_path) as conn:
+        hits = _message_index.search(conn, query, k=limit, doc_filter=doc_filter, filter_params=params)
+        query_terms = [term for term in query.lower().split() if term]
+        results = []
+        for ref_id, score in hits:
+            row = conn.execute(
+                "SELECT r.conversation_id, r.seq, m.role, m.content, m.timestamp, "
+                "c.title, c.mode_name, c.model_name FROM message_refs r "
+                "JOIN messages m ON m.conversation_id = r.conversation_id AND m.seq = r.seq "
+                "JOIN conversations c ON c.id = r.conversation_id WHERE r.id = ?",
+                (ref_id,)
+            ).fetchone()
+            if row is None:
+                continue
+            result = dict(row)
+            result["snippet"] = _snippet(result.pop("content"), query_terms)
+            result["score"] = score
+            results.append(result)
+        return results
+
+
+def list_filter_values(db_path: str = DEFAULT_DB_PATH) -> Dict[str, List[str]]:
+    """已保存对话中出现过的提示模式和模型，用于检索过滤选项"""
+    with _shared_connection(db_path) as conn:
+        return {
+            field: [row[0] for row in conn.execute(
+                f"SELECT DISTINCT {field} FROM conversations WHERE {field} != '' ORDER BY {field}"
+            )]
+            for field in ("mode_name", "model_name")
+        }
+
+
+def delete_conversation(conversation_id: str, db_path: str = DEFAULT_DB_PATH):
+    """删除一个已保存的对话"""
+    with _shared_connection(db_path) as conn:
+        with conn:
+            conn.execute("BEGIN IMMEDIATE")
+            _unindex_conversation(conn, conversation_id)
+            conn.execute("DELETE FROM messages WHERE conversation_id = ?", (conversation_id,))
+            conn.execute("DELETE FROM conversations WHERE id = ?", (conversation_id,))
+
+
+def recover_pending_replies(db_path: str = DEFAULT_DB_PATH, journal_dir: str = DEFAULT_JOURNAL_DIR) -> Dict[str, int]:
+    """
+    启动时扫描残留的回复日志：对话已保存的，把被中断的回复写回该对话；
+    对话不存在的（从未落库的新对话）直接丢弃日志。
+    Returns:
+        {"recovered", "discarded"}
+    """
+    result = {"recovered": 0, "discarded": 0}
+    for conversation_id in list(pending_journals(journal_dir)):
+        journal = ResponseJournal(conversation_id, journal_dir)
+        with _shared_connection(db_path) as conn:
+            exists = conn.execute("SELECT 1 FROM conversations WHERE id = ?", (conversation_id,)).fetchone()
+        if exists is None:
+            journal.commit()
+            result["discarded"] += 1
+            continue
+        history = SQLiteConversationHistory(conversation_id, db_path)
+        try:
+            if journal.recover_into(history):
+                result["recovered"] += 1
+            elif journal.stale:
+                # 日志中没有可恢复的内容（如只写了一半的开头）
+                journal.commit()
+                result["discarded"] += 1
+        finally:
+            history.close()
+    return result
+
+
+def _row_to_message(row: sqlite3.Row) -> Dict[str, Any]:
+    message = {"role": row["role"], "content": row["content"], "timestamp": row["timestamp"]}
+    if row["reasoning_content"]:
+        message["reasoning_content"] = row["reasoning_content"]
+    if row["interrupted"]:
+        message["interrupted"] = True
+    return message
+
+
+class SQLiteConversationHistory(ConversationHistory):
+    """持久化到 SQLite 的对话历史，接口与 ConversationHistory 相同"""
+
+    persistent = True
+
+    def __init__(self, conversation_id: Optional[str] = None, db_path: str = DEFAULT_DB_PATH,
+                 mode_name: str = "", model_name: str = ""):
+        """
+        Args:
+            conversation_id: 要重新打开的对话ID，为 None 时新建对话
+            db_path: 数据库文件路径
+            mode_name, model_name: 新建对话时记录的提示模式和模型
+        """
+        super().__init__(conversation_id)
+        self.db_path = db_path
+        self.mode_name = mode_name
+        self.model_name = model_name
+        self._conn = connect(db_path)
+        # 新对话在写入第一条消息时才落库，避免产生空对话
+        self._persisted = False
+        if conversation_id is not None:
+            self._load_index()
+
+    def _load_index(self):
+        """加载已有对话的元数据（不读取消息内容）"""
+        row = self._conn.execute(
+            "SELECT mode_name, model_name, created, window_start, summary, summary_until "
+            "FROM conversations WHERE id = ?",
+            (self.conversation_id,)
+        ).fetchone()
+        if row is None:
+            return
+        self._persisted = True
+        self.mode_name = row["mode_name"]
+        self.model_name = row["model_name"]
+        self.start_time = datetime.fromisoformat(row["created"])
+        for meta in self._conn.execute(
+            "SELECT role, tokens FROM messages WHERE conversation_id = ? ORDER BY seq",
+            (self.conversation_id,)
+        ):
+            self._index_message(meta["role"], meta["tokens"])
+        self.summary_until = min(row["summary_until"], len(self._roles))
+        self.summary = row["summary"] if self.summary_until else ""
+        self._summary_tokens = count_message_tokens(self.summary) if self.summary else 0
+        self._window_start = min(max(row["window_start"], self.summary_until), len(self._roles))
+
+    def _store_message(self, message: Dict[str, str], tokens: int):
+        """在一个事务中写入消息、更新全文索引和对话元数据"""
+        seq = len(self._roles)
+        with self._lock, self._conn:
+            self._conn.execute("BEGIN IMMEDIATE")
+            if not self._persisted:
+                self._conn.execute(
+                    "INSERT OR IGNORE INTO conversations (id, mode_name, model_name, created, updated) "
+                    "VALUES (?, ?, ?, ?, ?)",
+                    (self.conversation_id, self.mode_name, self.model_name,
+                     self.start_time.isoformat(), message["timestamp"])
+                )
+                self._persisted = True
+            self._conn.execute(
+                "INSERT INTO messages (conversation_id, seq, role, content, reasoning_content, "
+                "interrupted, tokens, timestamp) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (self.conversation_id, seq, message["role"], message["content"],
+                 message.get("reasoning_content"), int(message.get("interrupted", False)),
+                 tokens, message["timestamp"])
+            )
+            if message["role"] != "system":
+                _index_message_content(self._conn, self.conversation_id, seq, message["content"])
+            self._conn.execute(
+                "UPDATE conversations SET updated = ?, message_count = ?, "
+                "title = CASE WHEN title = '' AND ? = 'user' THEN ? ELSE title END WHERE id = ?",
+                (message["timestamp"], seq + 1, message["role"],
+                 message["content"][:TITLE_LENGTH], self.conversation_id)
+            )
+
+    def _load_messages(self, indices: List[int]) -> List[Dict[str, str]]:
+        """按下标读取消息；连续的下标合并为一次区间查询"""
+        if not indices:
+            return []
+        messages: List[Dict[str, str]] = []
+        run_start = prev = indices[0]
+        with self._lock:
+            for i in indices[1:] + [None]:
+                if i is not None and i == prev + 1:
+                    prev = i
+                    continue
+                rows = self._conn.execute(
+                    "SELECT role, content, reasoning_content, interrupted, timestamp FROM messages "
+                    "WHERE conversation_id = ? AND seq BETWEEN ? AND ? ORDER BY seq",
+                    (self.conversation_id, run_start, prev)
+                ).fetchall()
+                messages.extend(_row_to_message(row) for row in rows)
+                if i is not None:
+                    run_start = prev = i
+        return messages
+
+    def _on_window_moved(self):
+        """保存前缀稳定窗口起点，重新打开对话后请求前缀保持不变"""
+        with self._lock:
+            self._conn.execute(
+                "UPDATE conversations SET window_start = ? WHERE id = ?",
+                (self._window_start, self.conversation_id)
+            )
+
+    def _store_summary(self):
+        """保存滚动摘要"""
+        with self._lock:
+            self._conn.execute(
+                "UPDATE conversations SET summary = ?, summary_until = ? WHERE id = ?",
+                (self.summary, self.summary_until, self.conversation_id)
+            )
+
+    def set_metadata(self, mode_name: Optional[str] = None, model_name: Optional[str] = None):
+        """更新对话的提示模式和模型信息"""
+        if mode_name is not None:
+            self.mode_name = mode_name
+        if model_name is not None:
+            self.model_name = model_name
+        if self._persisted:
+            with self._lock:
+                self._conn.execute(
+                    "UPDATE conversations SET mode_name = ?, model_name = ? WHERE id = ?",
+                    (self.mode_name, self.model_name, self.conversation_id)
+                )
+
+    def get_all_messages(self) -> List[Dict[str, str]]:
+        """获取所有消息（包含时间戳）；长对话请优先使用 get_recent / get_page"""
+        return self._load_messages(list(range(self.count())))
+
+    def clear(self):
+        """清除本对话的全部消息"""
+        with self._lock, self._conn:
+            self._conn.execute("BEGIN IMMEDIATE")
+            _unindex_conversation(self._conn, self.conversation_id)
+            self._conn.execute("DELETE FROM messages WHERE conversation_id = ?", (self.conversation_id,))
+            self._conn.execute(
+                "UPDATE conversations SET message_count = 0, window_start = 0, title = '', "
+                "summary = '', summary_until = 0 WHERE id = ?",
+                (self.conversation_id,)
+            )
+            self.start_time = datetime.now()
+            self._reset_index()
+            self.version += 1
+
+    def snapshot(self) -> Dict[str, Any]:
+        """消息和元数据都已保存在数据库中，只需记录对话ID和打开参数"""
+        return {
+            "conversation_id": self.conversation_id,
+            "db_path": self.db_path,
+            "mode_name": self.mode_name,
+            "model_name": self.model_name,
+            "version": self.version,
+        }
+
+    @classmethod
+    def restore(cls, state: Dict[str, Any]) -> "SQLiteConversationHistory":
+        """重新打开对话（只加载元数据）"""
+        history = cls(state["conversation_id"], state["db_path"], state["mode_name"], state["model_name"])
+        history.version = state["version"]
+        return history
+
+    def close(self):
+        """关闭数据库连接"""
+        self._conn.close()
@@ -2,33 +2,116 @@
 """
 提示加载器
 """
+import hashlib
+import json
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import Dict
+
+from prompts.minify import minify_layers
+from utils.token_counter import count_message_tokens, count_tokens
+
+# 组成系统提示的各层，按拼接顺序排列
+PROMPT_LAYERS = ("cognitive", "meta", "system")
+
+LAYER_HEADERS = {
+    "cognitive": "COGNITIVE ARCHITECTURE",
+    "meta": "META-PROMPT",
+    "system": "SYSTEM PROMPT",
+}
+
+
+@dataclass(frozen=True)
+class CompiledPrompt:
+    """组合后的系统提示及其统计信息"""
+    text: str
+    # 各层内容、模式名和压缩选项的 sha256，可在别处用作缓存键
+    fingerprint: str
+    # 每层正文（启用压缩时为压缩后）的token数
+    layer_tokens: Dict[str, int] = field(default_factory=dict)
+    # 整条系统消息的token数（含消息格式开销）
+    message_tokens: int = 0
+
+
+def prompt_fingerprint(layers: Dict[str, str], mode_name: str, minify: bool = False) -> str:
+    """各层内容、模式名和压缩选项的内容指纹"""
+    payload = json.dumps(
+        [mode_name, minify] + [layers.get(layer, "") for layer in PROMPT_LAYERS], ensure_ascii=False
+    )
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class _CompiledPromptCache:
+    """按内容指纹缓存组合结果的 LRU 缓存，进程内共享"""
+
+    def __init__(self, max_entries: int = 64):
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[str, CompiledPrompt]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, fingerprint: str):
+        with self._lock:
+            compiled = self._entries.get(fingerprint)
+            if compiled is not None:
+                self._entries.move_to_end(fingerprint)
+            return compiled
+
+    def put(self, compiled: CompiledPrompt):
+        with self._lock:
+            self._entries[compiled.fingerprint] = compiled
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+
+_compiled_cache = _CompiledPromptCache()
+
 
 class PromptLoader:
     """根据传入的配置动态组合提示词"""
-    
-    def __init__(self, prompt_config: dict, mode_name: str = "custom"):
+
+    def __init__(self, prompt_config: dict, mode_name: str = "custom", minify: bool = False):
         """
         初始化加载器
         Args:
             prompt_config: 包含 'cognitive', 'meta', 'system' 键的字典
             mode_name: 当前模式的名称，用于显示
+            minify: 组合前压缩各层的空白和标记（见 prompts.minify）
         """
         self.cognitive = prompt_config.get("cognitive", "")
         self.meta = prompt_config.get("meta", "")
         self.system = prompt_config.get("system", "")
         self.mode_name = mode_name.upper()
+        self.minify = minify
+
+    def compile(self) -> CompiledPrompt:
+        """
+        组合各层提示并统计token数。
+        结果按内容指纹缓存，同一模式的新对话直接复用，不再重复拼接和计数。
+        """
+        layers = {layer: getattr(self, layer) for layer in PROMPT_LAYERS}
+        fingerprint = prompt_fingerprint(layers, self.mode_name, self.minify)
+        compiled = _compiled_cache.get(fingerprint)
+        if compiled is not None:
+            return compiled
+
+        if self.minify:
+            layers = minify_layers(layers, PROMPT_LAYERS)
+
+        prompts = [
+            f"[{LAYER_HEADERS[layer]} - {self.mode_name}]\n{layers[layer]}"
+            for layer in PROMPT_LAYERS if layers[layer]
+        ]
+        text = "\n\n".join(prompts)
+        compiled = CompiledPrompt(
+            text=text,
+            fingerprint=fingerprint,
+            layer_tokens={layer: count_tokens(layers[layer]) for layer in PROMPT_LAYERS},
+            message_tokens=count_message_tokens(text) if text else 0,
+        )
+        _compiled_cache.put(compiled)
+        return compiled
 
     def get_combined_prompt(self):
-        """获取组合后的完整提示"""
-        prompts = []
-        if self.cognitive:
-            prompts.append(f"[COGNITIVE ARCHITECTURE - {self.mode_name}]\n{self.cognitive}")
-        if self.meta:
-            prompts.append(f"[META-PROMPT - {self.mode_name}]\n{self.meta}")
-        if self.system:
-            prompts.append(f"[SYSTEM PROMPT - {self.mode_name}]\n{self.system}")
-        
-        if prompts:
-            return "\n\n".join(prompts)
-        
-        return "" # 如果没有提示，返回空字符串
+        """获取组合后的完整提示；如果没有提示，返回空字符串"""
+        return self.compile().text
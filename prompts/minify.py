@@ -0,0 +1,205 @@
+# prompts/minify.py
+"""
+提示词压缩
+
+系统提示在每一轮请求中都会重新发送，其中的缩进、空行和装饰性标记同样计入输入token。
+这里在不改变内容含义的前提下做保守的压缩：
+- 去掉行尾空白，连续的空行合并为一行；缩进按层级统一为每级两个空格，
+  嵌套列表和伪代码的父子结构保持不变
+- 删除空元素（如 <notes></notes>）和纯装饰的分隔线（如 ----、====）
+- 独占一行的 XML 式标签改写为按嵌套层级的 Markdown 标题，
+  <rules> ... </rules> 变成 "## rules"，层级信息不变，省去闭合标签
+- 删除与前文完全相同的较长正文行（重复的套话），标签行不参与去重
+代码块（``` 围起的部分）原样保留。
+
+用法（在项目根目录运行，输出各模式各层压缩前后的token数）:
+    python -m prompts.minify
+"""
+import re
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+from utils.token_counter import count_tokens
+
+FENCE = "```"
+
+# 只有这么长的正文行才参与去重，避免误删 "- 简洁" 这类短句
+MIN_DEDUP_LENGTH = 40
+
+_INDENT_RE = re.compile(r"^[ \t　]*")
+_SEPARATOR_RE = re.compile(r"^([-=*#_~])\1{2,}$")
+_EMPTY_ELEMENT_RE = re.compile(r"<([A-Za-z_][\w\-]*)>\s*</\1>")
+_TAG_LINE_RE = re.compile(r"^</?[A-Za-z_][\w\-]*>$")
+_OPEN_TAG_RE = re.compile(r"^<([A-Za-z_][\w\-]*)>$")
+_CLOSE_TAG_RE = re.compile(r"^</([A-Za-z_][\w\-]*)>$")
+
+# Markdown 最多支持六级标题
+MAX_HEADING_LEVEL = 6
+
+# 每级缩进输出的空格数
+INDENT_WIDTH = 2
+
+
+def _indent_width(line: str) -> int:
+    """行首空白的宽度：制表符计为4，全角空格计为2"""
+    indent = _INDENT_RE.match(line).group(0)
+    return sum(4 if char == "\t" else 2 if char == "　" else 1 for char in indent)
+
+
+def _split_fences(lines: List[str]) -> List[Tuple[bool, List[str]]]:
+    """按代码块切分为 (是否代码块, 行列表) 的片段，围栏行计入代码块"""
+    segments: List[Tuple[bool, List[str]]] = []
+    in_fence = False
+    for line in lines:
+        is_fence_line = line.strip().startswith(FENCE)
+        fenced = in_fence or is_fence_line
+        if not segments or segments[-1][0] != fenced:
+            segments.append((fenced, []))
+        segments[-1][1].append(line)
+        if is_fence_line:
+            in_fence = not in_fence
+            if not in_fence:
+                # 闭合围栏之后另起一段，紧邻的下一个代码块不会并入
+                segments.append((False, []))
+    return [segment for segment in segments if segment[1]]
+
+
+def minify_prompt(text: str, seen_lines: Optional[Set[str]] = None) -> str:
+    """
+    压缩一段提示词。
+    seen_lines: 跨多段文本共享的已出现行集合，用于在各层之间去除重复的套话
+    """
+    if not text:
+        return text
+    seen = seen_lines if seen_lines is not None else set()
+
+    lines: List[str] = []
+    # 当前各级缩进的宽度，同 Python 的缩进规则：更深的缩进开启新的一级，回退时弹出
+    indent_stack = [0]
+    for fenced, segment in _split_fences(text.replace("\r\n", "\n").split("\n")):
+        if fenced:
+            # 代码块原样保留，只去掉行尾空白
+            lines.extend(line.rstrip() for line in segment)
+            continue
+        for raw_line in _EMPTY_ELEMENT_RE.sub("", "\n".join(segment)).split("\n"):
+            stripped = raw_line.strip()
+            if not stripped:
+                if lines and lines[-1]:
+                    lines.append("")
+                continue
+            if _SEPARATOR_RE.match(stripped):
+                continue
+            if _TAG_LINE_RE.match(stripped):
+                # 标签行会被改写为标题，不保留缩进
+                lines.append(stripped)
+                continue
+            width = _indent_width(raw_line)
+            if width > indent_stack[-1]:
+                indent_stack.append(width)
+            else:
+                while len(indent_stack) > 1 and indent_stack[-1] > width:
+                    indent_stack.pop()
+            line = " " * (INDENT_WIDTH * (len(indent_stack) - 1)) + stripped
+            if len(stripped) >= MIN_DEDUP_LENGTH:
+                if line in seen:
+                    continue
+                seen.add(line)
+            lines.append(line)
+    # 闭合标签被删去后，两侧的空行可能相邻，再合并一次
+    converted: List[str] = []
+    for line in _tags_to_headings(lines):
+        if line or (converted and converted[-1]):
+            converted.append(line)
+    while converted and not converted[-1]:
+        converted.pop()
+    return "\n".join(converted)
+
+
+def _tags_to_headings(lines: List[str]) -> List[str]:
+    """
+    把独占一行的标签改写为标题。
+    漏写的闭合标签按 HTML 的方式隐式闭合；出现没有对应开始标签的闭合标签时
+    无法确定层级，原样返回
+    """
+    stack: List[str] = []
+    converted: List[str] = []
+    in_fence = False
+    for line in lines:
+        is_fence_line = line.strip().startswith(FENCE)
+        if is_fence_line:
+            in_fence = not in_fence
+        if in_fence or is_fence_line:
+            converted.append(line)
+            continue
+        open_match = _OPEN_TAG_RE.match(line)
+        if open_match:
+            stack.append(open_match.group(1))
+            level = min(len(stack), MAX_HEADING_LEVEL)
+            converted.append(f"{'#' * level} {open_match.group(1)}")
+            continue
+        close_match = _CLOSE_TAG_RE.match(line)
+        if close_match:
+            if close_match.group(1) not in stack:
+                return lines
+            while stack.pop() != close_match.group(1):
+                pass
+            continue
+        converted.append(line)
+    return converted
+
+
+def minify_layers(layers: Dict[str, str], order: Iterable[str]) -> Dict[str, str]:
+    """按拼接顺序压缩各层，后面的层中与前面重复的套话会被去掉"""
+    seen: Set[str] = set()
+    minified = dict(layers)
+    for layer in order:
+        minified[layer] = minify_prompt(layers.get(layer, ""), seen)
+    return minified
+
+
+def minification_report(modes: Dict[str, Dict[str, str]]) -> List[Dict]:
+    """
+    统计各模式各层压缩前后的token数。
+    Returns:
+        [{"mode", "layer", "before", "after", "saved", "ratio"}]，每个模式最后一行的 layer 为 "total"
+    """
+    from prompts.loader import PROMPT_LAYERS
+
+    rows = []
+    for mode_name, config in modes.items():
+        minified = minify_layers(config, PROMPT_LAYERS)
+        total_before = total_after = 0
+        for layer in PROMPT_LAYERS:
+            before = count_tokens(config.get(layer, ""))
+            after = count_tokens(minified[layer])
+            total_before += before
+            total_after += after
+            rows.append(_report_row(mode_name, layer, before, after))
+        rows.append(_report_row(mode_name, "total", total_before, total_after))
+    return rows
+
+
+def _report_row(mode_name: str, layer: str, before: int, after: int) -> Dict:
+    return {
+        "mode": mode_name,
+        "layer": layer,
+        "before": before,
+        "after": after,
+        "saved": before - after,
+        "ratio": (before - after) / before if before else 0.0,
+    }
+
+
+def main():
+    from user_configs import prompt_manager
+
+    modes = {name: prompt_manager.load_prompt_mode(name) for name in prompt_manager.get_available_modes()}
+    if not modes:
+        modes = prompt_manager.DEFAULT_PROMPTS
+    print(f"{'模式':<16}{'层':<12}{'压缩前':>8}{'压缩后':>8}{'节省':>8}{'比例':>8}")
+    for row in minification_report(modes):
+        print(f"{row['mode']:<16}{row['layer']:<12}{row['before']:>8}{row['after']:>8}"
+              f"{row['saved']:>8}{row['ratio']:>8.1%}")
+
+
+if __name__ == "__main__":
+    main()
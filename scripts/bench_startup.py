@@ -0,0 +1,102 @@
+# scripts/bench_startup.py
+
+"""
+启动耗时基准
+
+在全新的解释器中用 `python -X importtime` 导入指定模块，重复多次取中位数，
+输出总耗时和各模块的累计/自身导入耗时，用于比较冷启动优化前后的差异。
+
+用法（在项目根目录运行）:
+    python scripts/bench_startup.py
+    python scripts/bench_startup.py conversation.manager --repeat 10 --top 30
+"""
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import time
+from collections import defaultdict
+from typing import Dict, List, Tuple
+
+PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# 默认测量的入口：界面依赖的模块和不需要界面的 CLI/批处理路径
+DEFAULT_MODULES = [
+    "user_configs.prompt_manager",
+    "conversation.manager",
+    "conversation.sqlite_history",
+    "api.deepseek_client",
+]
+
+
+def _parse_importtime(stderr: str) -> Dict[str, Tuple[int, int]]:
+    """解析 -X importtime 的输出，返回 {模块: (自身耗时us, 累计耗时us)}"""
+    timings = {}
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:"):].split("|", 2)
+        timings[name.strip()] = (int(self_us), int(cumulative_us))
+    return timings
+
+
+def measure(module: str, repeat: int) -> Tuple[List[float], Dict[str, Tuple[float, float]]]:
+    """
+    在子进程中重复导入模块。
+    Returns:
+        (每次的进程总耗时秒数, {模块: (自身耗时中位数us, 累计耗时中位数us)})
+    """
+    wall_times = []
+    samples: Dict[str, List[Tuple[int, int]]] = defaultdict(list)
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = subprocess.run(
+            [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+            cwd=PROJECT_ROOT, capture_output=True, text=True
+        )
+        wall_times.append(time.perf_counter() - start)
+        if result.returncode != 0:
+            last_line = result.stderr.strip().splitlines()[-1] if result.stderr.strip() else ""
+            raise RuntimeError(f"导入 {module} 失败: {last_line}")
+        for name, timing in _parse_importtime(result.stderr).items():
+            samples[name].append(timing)
+
+    medians = {
+        name: (statistics.median(t[0] for t in timings), statistics.median(t[1] for t in timings))
+        for name, timings in samples.items()
+    }
+    return wall_times, medians
+
+
+def report(module: str, wall_times: List[float], medians: Dict[str, Tuple[float, float]], top: int):
+    """打印单个入口模块的结果"""
+    total_us = medians.get(module, (0, 0))[1]
+    print(f"\n== {module} ==")
+    print(f"进程总耗时: 中位数 {statistics.median(wall_times) * 1000:.1f} ms"
+          f"（最小 {min(wall_times) * 1000:.1f} / 最大 {max(wall_times) * 1000:.1f}）")
+    print(f"导入耗时: {total_us / 1000:.1f} ms，共导入 {len(medians)} 个模块")
+    print(f"{'累计(ms)':>10} {'自身(ms)':>10}  模块")
+    ranked = sorted(medians.items(), key=lambda item: item[1][1], reverse=True)
+    for name, (self_us, cumulative_us) in ranked[:top]:
+        print(f"{cumulative_us / 1000:>10.2f} {self_us / 1000:>10.2f}  {name}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="测量模块冷启动导入耗时")
+    parser.add_argument("modules", nargs="*", default=DEFAULT_MODULES, help="要测量的模块")
+    parser.add_argument("--repeat", type=int, default=5, help="每个模块的重复次数")
+    parser.add_argument("--top", type=int, default=15, help="显示累计耗时最高的前 N 个模块")
+    args = parser.parse_args()
+
+    for module in args.modules:
+        try:
+            wall_times, medians = measure(module, args.repeat)
+        except RuntimeError as e:
+            print(f"\n== {module} ==\n{e}")
+            continue
+        report(module, wall_times, medians, args.top)
+
+
+if __name__ == "__main__":
+    main()
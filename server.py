@@ -0,0 +1,338 @@
+# server.py
+
+"""
+无界面的 HTTP/SSE 对话服务
+
+与 app.py 共用对话历史数据库、提示模式和API配置，可以与界面同时运行，也可以单独部署。
+服务基于 asyncio，每个流式回复只占用一个协程，由 ConversationManager 的异步接口驱动，
+单个进程即可同时服务大量并发的流式连接。
+数据库读写、会话池的换入换出等阻塞操作都放到线程池中执行，一个慢对话不会拖住其他连接。
+
+接口：
+    GET    /health                              健康检查
+    GET    /stats                               会话池统计和各会话的内存占用
+    GET    /modes                               提示模式列表
+    GET    /modes/{name}                        提示模式配置
+    GET    /conversations?limit=&offset=        已保存的对话
+    POST   /conversations                       新建对话 {"mode": "编程模式"}
+    GET    /conversations/{id}/messages?limit=  最近的消息
+    POST   /conversations/{id}/messages         发送消息 {"input": "...", "stream": true}
+    DELETE /conversations/{id}                  删除对话
+
+stream 为 true（默认）时以 Server-Sent Events 返回：
+    event: reasoning / content   data: {"text": "..."}
+    event: done                  data: {"usage": {...}, "error": null}
+
+用法（在项目根目录运行）:
+    python server.py --port 8765 --token 访问令牌
+"""
+import argparse
+import asyncio
+import json
+import logging
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Dict, Optional, Tuple
+from urllib.parse import parse_qs, unquote, urlsplit
+
+from conversation.manager import ConversationManager
+from conversation.session_pool import get_session_pool
+from conversation.sqlite_history import (
+    SQLiteConversationHistory, delete_conversation, list_conversations, recover_pending_replies
+)
+from user_configs import prompt_manager
+from user_configs.api_config_manager import APIConfigManager
+
+logger = logging.getLogger(__name__)
+
+# 请求体大小上限（字节）
+MAX_BODY_BYTES = 1024 * 1024
+
+_STATUS_TEXT = {
+    200: "OK", 201: "Created", 204: "No Content", 400: "Bad Request", 401: "Unauthorized",
+    404: "Not Found", 405: "Method Not Allowed", 413: "Payload Too Large", 500: "Internal Server Error",
+}
+
+
+class HTTPError(Exception):
+    def __init__(self, status: int, message: str):
+        super().__init__(message)
+        self.status = status
+        self.message = message
+
+
+class _SessionLock:
+    """一个对话的请求锁及持有、等待它的请求数"""
+    __slots__ = ("lock", "users")
+
+    def __init__(self):
+        self.lock = asyncio.Lock()
+        self.users = 0
+
+
+class ChatServer:
+    """按对话ID管理 ConversationManager 的 HTTP 服务"""
+
+    def __init__(self, api_config: Dict, token: Optional[str] = None):
+        self.api_config = api_config
+        self.token = token
+        # 按对话ID保存的会话；超出内存上限时空闲的会话被换出到磁盘，再次访问时还原
+        self.sessions = get_session_pool(api_config.get('session_pool'))
+        # 同一对话的多个请求依次执行，不同对话之间互不阻塞
+        self._session_locks: Dict[str, _SessionLock] = {}
+
+    # --- 会话 ---
+
+    def _open_session(self, conversation_id: Optional[str] = None, mode_name: Optional[str] = None) -> ConversationManager:
+        """
+        打开（或新建）对话；已打开（或已换出）的对话直接复用。
+        已有对话通过会话池的 get_or_create 打开，同一对话的并发请求只会创建一个会话
+        """
+        if conversation_id is None:
+            manager = self._create_session(None, mode_name)
+            self.sessions.put(manager.history.conversation_id, manager)
+            return manager
+        return self.sessions.get_or_create(
+            conversation_id, self.api_config, lambda: self._create_session(conversation_id, mode_name)
+        )
+
+    def _create_session(self, conversation_id: Optional[str], mode_name: Optional[str]) -> ConversationManager:
+        history = SQLiteConversationHistory(
+            conversation_id=conversation_id,
+            mode_name=mode_name or "",
+            model_name=self.api_config['model_name']
+        )
+        if conversation_id is not None and history.count() == 0:
+            history.close()
+            raise HTTPError(404, f"对话 '{conversation_id}' 不存在")
+        mode_name = history.mode_name or mode_name
+        if mode_name not in prompt_manager.get_available_modes():
+            history.close()
+            raise HTTPError(400, f"提示模式 '{mode_name}' 不存在")
+        manager = ConversationManager(
+            api_config=self.api_config,
+            prompt_config=prompt_manager.load_prompt_mode(mode_name),
+            prompt_mode_name=mode_name,
+            history=history
+        )
+        manager.initialize()
+        manager.recover_interrupted()
+        return manager
+
+    @asynccontextmanager
+    async def _session_lock(self, conversation_id: str) -> AsyncIterator[None]:
+        """按对话串行化请求；没有请求持有或等待时移除该对话的锁"""
+        entry = self._session_locks.get(conversation_id)
+        if entry is None:
+            entry = self._session_locks[conversation_id] = _SessionLock()
+        entry.users += 1
+        try:
+            async with entry.lock:
+                yield
+        finally:
+            entry.users -= 1
+            if entry.users == 0 and self._session_locks.get(conversation_id) is entry:
+                del self._session_locks[conversation_id]
+
+    # --- HTTP ---
+
+    async def handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        """处理一个连接上的一个请求（响应后关闭连接）"""
+        try:
+            method, path, query, headers, body = await self._read_request(reader)
+            if self.token and headers.get("authorization") != f"Bearer {self.token}":
+                raise HTTPError(401, "未授权")
+            await self._dispatch(method, path, query, body, writer)
+        except HTTPError as e:
+            await self._send_json(writer, e.status, {"error": e.message})
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        except Exception as e:
+            logger.exception(f"处理请求出错: {e}")
+            try:
+                await self._send_json(writer, 500, {"error": "服务器内部错误"})
+            except ConnectionError:
+                pass
+        finally:
+            writer.close()
+
+    async def _read_request(self, reader: asyncio.StreamReader) -> Tuple[str, str, Dict, Dict, Dict]:
+        request_line = (await reader.readline()).decode("latin-1").strip()
+        if not request_line:
+            raise ConnectionError("空请求")
+        try:
+            method, target, _ = request_line.split(" ", 2)
+        except ValueError:
+            raise HTTPError(400, "请求行格式错误")
+        headers = {}
+        while True:
+            line = (await reader.readline()).decode("latin-1").strip()
+            if not line:
+                break
+            name, _, value = line.partition(":")
+            headers[name.strip().lower()] = value.strip()
+
+        length = int(headers.get("content-length") or 0)
+        if length > MAX_BODY_BYTES:
+            raise HTTPError(413, "请求体过大")
+        body = {}
+        if length:
+            try:
+                body = json.loads(await reader.readexactly(length))
+            except json.JSONDecodeError:
+                raise HTTPError(400, "请求体不是有效的 JSON")
+        url = urlsplit(target)
+        query = {key: values[-1] for key, values in parse_qs(url.query).items()}
+        return method.upper(), unquote(url.path), query, headers, body
+
+    async def _dispatch(self, method: str, path: str, query: Dict, body: Dict, writer: asyncio.StreamWriter):
+        parts = [part for part in path.split("/") if part]
+
+        if parts == ["health"] and method == "GET":
+            pool_stats = await asyncio.to_thread(self.sessions.stats)
+            return await self._send_json(writer, 200, {"status": "ok", "sessions": pool_stats["resident"]})
+
+        if parts == ["stats"] and method == "GET":
+            pool_stats = await asyncio.to_thread(self.sessions.stats)
+            session_stats = await asyncio.to_thread(self.sessions.session_stats)
+            return await self._send_json(writer, 200, {"pool": pool_stats, "sessions": session_stats})
+
+        if parts[:1] == ["modes"] and method == "GET":
+            if len(parts) == 1:
+                return await self._send_json(writer, 200, {"modes": prompt_manager.get_available_modes()})
+            if len(parts) == 2 and parts[1] in prompt_manager.get_available_modes():
+                return await self._send_json(writer, 200, prompt_manager.load_prompt_mode(parts[1]))
+            raise HTTPError(404, "提示模式不存在")
+
+        if parts[:1] == ["conversations"]:
+            if len(parts) == 1 and method == "GET":
+                conversations = await asyncio.to_thread(
+                    list_conversations,
+                    limit=_int_param(query, "limit", 20, maximum=500),
+                    offset=_int_param(query, "offset", 0)
+                )
+                return await self._send_json(writer, 200, {"conversations": conversations})
+            if len(parts) == 1 and method == "POST":
+                manager = await asyncio.to_thread(
+                    self._open_session, mode_name=body.get("mode") or self._default_mode()
+                )
+                return await self._send_json(writer, 201, {
+                    "conversation_id": manager.history.conversation_id,
+                    "mode": manager.history.mode_name,
+                })
+            if len(parts) == 2 and method == "DELETE":
+                async with self._session_lock(parts[1]):
+                    await asyncio.to_thread(self.sessions.discard, parts[1])
+                    await asyncio.to_thread(delete_conversation, parts[1])
+                return await self._send_json(writer, 204, None)
+            if len(parts) == 3 and parts[2] == "messages":
+                if method == "GET":
+                    limit = _int_param(query, "limit", 50, maximum=1000)
+                    manager = await asyncio.to_thread(self._open_session, parts[1])
+                    messages = await asyncio.to_thread(manager.get_recent_history, limit)
+                    return await self._send_json(writer, 200, {"messages": messages})
+                if method == "POST":
+                    return await self._post_message(parts[1], body, writer)
+            raise HTTPError(405 if len(parts) <= 3 else 404, "不支持的请求")
+
+        raise HTTPError(404, "接口不存在")
+
+    def _default_mode(self) -> str:
+        modes = prompt_manager.get_available_modes()
+        if not modes:
+            raise HTTPError(400, "没有可用的提示模式")
+        return modes[0]
+
+    async def _post_message(self, conversation_id: str, body: Dict, writer: asyncio.StreamWriter):
+        user_input = body.get("input")
+        if not isinstance(user_input, str) or not user_input:
+            raise HTTPError(400, "缺少 input")
+        async with self._session_lock(conversation_id):
+            # 在锁内取出会话，排队等待期间会话可能已被换出
+            manager = await asyncio.to_thread(self._open_session, conversation_id)
+            events = manager.achat_stream_events(user_input)
+            if not body.get("stream", True):
+                parts = {"reasoning": [], "content": []}
+                async for event in events:
+                    parts[event.kind].append(event.text)
+                return await self._send_json(writer, 200, {
+                    "content": "".join(parts["content"]),
+                    "reasoning": "".join(parts["reasoning"]) or None,
+                    "usage": manager.async_client.last_usage,
+                    "error": str(manager.last_error) if manager.last_error else None,
+                })
+
+            writer.write(
+                b"HTTP/1.1 200 OK\r\n"
+                b"Content-Type: text/event-stream; charset=utf-8\r\n"
+                b"Cache-Control: no-cache\r\n"
+                b"Connection: close\r\n\r\n"
+            )
+            try:
+                async for event in events:
+                    writer.write(_sse(event.kind, {"text": event.text}))
+                    # 等待发送缓冲区排空：客户端读得慢时自然限速，断开时抛出异常
+                    await writer.drain()
+                writer.write(_sse("done", {
+                    "usage": manager.async_client.last_usage,
+                    "error": str(manager.last_error) if manager.last_error else None,
+                }))
+                await writer.drain()
+            finally:
+                # 客户端中途断开时关闭生成器，已生成的部分作为被中断的回复保存
+                await events.aclose()
+
+    async def _send_json(self, writer: asyncio.StreamWriter, status: int, payload):
+        body = b"" if payload is None else json.dumps(payload, ensure_ascii=False).encode("utf-8")
+        writer.write(
+            f"HTTP/1.1 {status} {_STATUS_TEXT.get(status, '')}\r\n"
+            f"Content-Type: application/json; charset=utf-8\r\n"
+            f"Content-Length: {len(body)}\r\n"
+            f"Connection: close\r\n\r\n".encode("latin-1") + body
+        )
+        await writer.drain()
+
+    async def serve(self, host: str, port: int):
+        server = await asyncio.start_server(self.handle_connection, host, port)
+        logger.info(f"对话服务已启动: http://{host}:{port}")
+        async with server:
+            await server.serve_forever()
+
+
+def _int_param(query: Dict, name: str, default: int, minimum: int = 0, maximum: Optional[int] = None) -> int:
+    """读取整数查询参数，格式或范围不对时返回 400"""
+    if name not in query:
+        return default
+    try:
+        value = int(query[name])
+    except ValueError:
+        raise HTTPError(400, f"参数 {name} 必须是整数")
+    if value < minimum or (maximum is not None and value > maximum):
+        raise HTTPError(400, f"参数 {name} 超出范围")
+    return value
+
+
+def _sse(event: str, data: Dict) -> bytes:
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n".encode("utf-8")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="DeepSeek 对话 HTTP/SSE 服务")
+    parser.add_argument("--host", default="127.0.0.1", help="监听地址")
+    parser.add_argument("--port", type=int, default=8765, help="监听端口")
+    parser.add_argument("--token", help="访问令牌，设置后请求需携带 Authorization: Bearer <token>")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+    api_config = APIConfigManager().load_config()
+    if not api_config.get("api_key"):
+        parser.error("未配置 API Key，请先在界面中保存 API 配置")
+    prompt_manager.initialize_default_prompts()
+    recovered = recover_pending_replies()
+    if recovered["recovered"] or recovered["discarded"]:
+        logger.info(f"残留的回复日志: 恢复 {recovered['recovered']} 个，丢弃 {recovered['discarded']} 个")
+
+    asyncio.run(ChatServer(api_config, token=args.token).serve(args.host, args.port))
+
+
+if __name__ == "__main__":
+    main()
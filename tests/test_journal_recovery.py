@@ -0,0 +1,80 @@
+# tests/test_journal_recovery.py
+
+"""
+进程在流式回复中途被杀死后，新进程应能从回复日志中恢复已生成的部分
+"""
+import os
+import subprocess
+import sys
+import textwrap
+
+from conversation.sqlite_history import SQLiteConversationHistory, recover_pending_replies
+
+PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# 子进程：用假的流式客户端开始一次回复，输出若干增量后等待被杀死
+STREAMING_CHILD = textwrap.dedent("""
+    import sys, time
+    import api.deepseek_client as deepseek_client
+    deepseek_client.get_client = lambda *args, **kwargs: None
+    from api.deepseek_client import CONTENT, StreamEvent
+    from conversation.manager import ConversationManager
+    from conversation.sqlite_history import SQLiteConversationHistory
+
+    def slow_stream(messages, **kwargs):
+        for i in range(1000):
+            time.sleep(0.05)
+            yield StreamEvent(CONTENT, f"片段{i};")
+
+    history = SQLiteConversationHistory(db_path="history.db", mode_name="测试", model_name="m")
+    manager = ConversationManager(
+        {"api_key": "k", "base_url": "http://localhost", "model_name": "m"}, {}, "测试", history=history
+    )
+    manager.client.chat_stream_events = slow_stream
+    print(history.conversation_id, flush=True)
+    for count, event in enumerate(manager.chat_stream_events("问题"), 1):
+        if count == 20:
+            print("streaming", flush=True)
+""")
+
+
+def test_partial_reply_recovered_after_kill(tmp_path):
+    env = dict(os.environ, PYTHONPATH=PROJECT_ROOT)
+    child = subprocess.Popen(
+        [sys.executable, "-c", STREAMING_CHILD], cwd=tmp_path, env=env,
+        stdout=subprocess.PIPE, text=True
+    )
+    try:
+        conversation_id = child.stdout.readline().strip()
+        assert child.stdout.readline().strip() == "streaming"
+    finally:
+        child.kill()
+        child.wait()
+
+    db_path = str(tmp_path / "history.db")
+    journal_dir = str(tmp_path / "output" / "journal")
+    assert os.path.exists(os.path.join(journal_dir, f"{conversation_id}.jsonl"))
+
+    result = recover_pending_replies(db_path=db_path, journal_dir=journal_dir)
+
+    assert result == {"recovered": 1, "discarded": 0}
+    assert os.listdir(journal_dir) == []
+    history = SQLiteConversationHistory(conversation_id, db_path=db_path)
+    try:
+        user, assistant = history.get_recent(2)
+        assert user["role"] == "user" and user["content"] == "问题"
+        assert assistant["interrupted"] is True
+        assert assistant["content"].startswith("片段0;片段1;")
+    finally:
+        history.close()
+
+
+def test_orphaned_journal_discarded(tmp_path):
+    journal_dir = tmp_path / "journal"
+    journal_dir.mkdir()
+    (journal_dir / "never-saved.jsonl").write_text('{"type": "begin", "user": "问题"}\n', encoding="utf-8")
+
+    result = recover_pending_replies(db_path=str(tmp_path / "history.db"), journal_dir=str(journal_dir))
+
+    assert result == {"recovered": 0, "discarded": 1}
+    assert os.listdir(journal_dir) == []
@@ -0,0 +1,66 @@
+# tests/test_session_pool.py
+
+"""
+会话池：换出快照在锁外写入，写入期间其他会话照常可用，被再次访问的会话取消换出
+"""
+import os
+import threading
+
+import api.deepseek_client as deepseek_client
+from conversation.history import ConversationHistory
+from conversation.manager import ConversationManager
+from conversation.session_pool import SessionPool
+
+API_CONFIG = {"api_key": "k", "base_url": "http://localhost", "model_name": "m"}
+
+
+def make_manager(text: str) -> ConversationManager:
+    history = ConversationHistory()
+    history.add_message("user", text)
+    return ConversationManager(API_CONFIG, {}, "测试", history=history)
+
+
+def test_spill_and_rehydrate(tmp_path, monkeypatch):
+    monkeypatch.setattr(deepseek_client, "get_client", lambda *args, **kwargs: None)
+    pool = SessionPool(max_bytes=1, idle_seconds=0, spill_dir=str(tmp_path))
+    pool.put("a", make_manager("问题a"))
+
+    assert pool.stats()["spilled"] == 1
+    manager = pool.get("a", API_CONFIG)
+    assert manager.history.get_recent(1)[0]["content"] == "问题a"
+    stats = pool.stats()
+    assert stats["rehydrated_sessions"] == 1 and stats["sessions"] == 1
+
+
+def test_slow_spill_does_not_block_other_sessions(tmp_path, monkeypatch):
+    monkeypatch.setattr(deepseek_client, "get_client", lambda *args, **kwargs: None)
+    pool = SessionPool(max_bytes=1, idle_seconds=3600, spill_dir=str(tmp_path))
+    slow = make_manager("慢")
+    snapshot_started = threading.Event()
+    release = threading.Event()
+    original_snapshot = slow.snapshot
+
+    def blocking_snapshot():
+        snapshot_started.set()
+        release.wait(5)
+        return original_snapshot()
+
+    slow.snapshot = blocking_snapshot
+    pool.put("slow", slow)
+    other = make_manager("其他")
+    pool.put("other", other)
+    pool._resident["slow"].last_used -= 7200
+    spiller = threading.Thread(target=pool.put, args=("new", make_manager("新")))
+    spiller.start()
+    try:
+        assert snapshot_started.wait(5)
+        # 快照写入期间其他会话照常可取；正在换出的会话被取回后取消换出
+        assert pool.get("other", API_CONFIG) is other
+        assert pool.get("slow", API_CONFIG) is slow
+    finally:
+        release.set()
+        spiller.join(5)
+
+    assert pool.session_bytes("slow") is not None
+    assert pool.stats()["evictions"] == 0
+    assert not os.path.exists(pool._spill_path("slow"))
@@ -0,0 +1,57 @@
+# tests/test_stream_coalescer.py
+
+"""
+流式输出合并：下游关闭时上游回复同步结束并保存，下一轮对话不会与之交错
+"""
+import time
+
+import pytest
+
+import api.deepseek_client as deepseek_client
+from api.deepseek_client import CONTENT, StreamEvent
+from conversation.manager import ConversationManager
+from conversation.sqlite_history import SQLiteConversationHistory
+from utils.stream_coalescer import FlushPolicy, coalesce_events
+
+API_CONFIG = {"api_key": "k", "base_url": "http://localhost", "model_name": "m"}
+
+
+def slow_stream(messages, **kwargs):
+    for i in range(1000):
+        time.sleep(0.01)
+        yield StreamEvent(CONTENT, f"r{i};")
+
+
+def test_closing_consumer_finishes_turn_before_next(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(deepseek_client, "get_client", lambda *args, **kwargs: None)
+    history = SQLiteConversationHistory(db_path=str(tmp_path / "history.db"), mode_name="测试", model_name="m")
+    manager = ConversationManager(API_CONFIG, {}, "测试", history=history)
+    manager.client.chat_stream_events = slow_stream
+
+    first = coalesce_events(manager.chat_stream_events("Q1"), FlushPolicy(window=0))
+    next(first)
+    next(first)
+    first.close()
+    assert not manager.is_busy()
+
+    second = manager.chat_stream_events("Q2")
+    next(second)
+    # 同一会话上一轮未结束时拒绝新的一轮
+    with pytest.raises(RuntimeError):
+        next(manager.chat_stream_events("Q3"))
+    second.close()
+
+    roles = [(m["role"], m["content"][:2], m.get("interrupted", False)) for m in history.get_all_messages()]
+    assert roles == [
+        ("user", "Q1", False), ("assistant", "r0", True),
+        ("user", "Q2", False), ("assistant", "r0", True),
+    ]
+    history.close()
+
+
+def test_events_are_merged_within_window():
+    events = [StreamEvent(CONTENT, c) for c in "abcdef"]
+    merged = list(coalesce_events(iter(events), FlushPolicy(window=60)))
+    # 首个增量直接输出，其余在窗口内合并
+    assert [event.text for event in merged] == ["a", "bcdef"]
@@ -0,0 +1,34 @@
+# tests/test_text_search.py
+
+"""
+全文检索：单个中日韩文字的查询按前缀匹配双字，段首、段中、段尾的字都能命中
+"""
+import sqlite3
+
+from utils.text_search import SearchIndex
+
+
+def test_single_cjk_character_query():
+    conn = sqlite3.connect(":memory:", isolation_level=None)
+    index = SearchIndex("test")
+    index.create_tables(conn)
+    documents = {1: "我爱猫", 2: "猫咪很可爱", 3: "今天天气好", 4: "小狗"}
+    for doc_id, text in documents.items():
+        index.index_document(conn, doc_id, text)
+
+    assert sorted(doc_id for doc_id, _ in index.search(conn, "猫")) == [1, 2]
+    assert [doc_id for doc_id, _ in index.search(conn, "狗")] == [4]
+    assert [doc_id for doc_id, _ in index.search(conn, "天气")] == [3]
+
+
+def test_filter_applies_before_postings_cut(monkeypatch):
+    conn = sqlite3.connect(":memory:", isolation_level=None)
+    index = SearchIndex("test")
+    index.create_tables(conn)
+    for doc_id in range(1, 21):
+        index.index_document(conn, doc_id, f"python {doc_id}")
+    monkeypatch.setattr(SearchIndex, "MAX_POSTINGS_PER_TERM", 5)
+
+    hits = index.search(conn, "python", doc_filter="d.doc_id <= ?", filter_params=(3,))
+
+    assert sorted(doc_id for doc_id, _ in hits) == [1, 2, 3]
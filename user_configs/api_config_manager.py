@@ -29,6 +29,7 @@ class APIConfigManager:
             "model_name": "deepseek-reasoner",
             "temperature": 1.0,
             "max_tokens": 4096,
+            "context_window": 65536,
             "top_p": 0.95
         }
         
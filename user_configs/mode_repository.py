@@ -0,0 +1,136 @@
+# user_configs/mode_repository.py
+
+"""
+提示模式仓库
+
+进程内所有会话共享一份已解析的提示模式缓存。列出和切换模式直接读取内存；
+目录最多每隔 CHECK_INTERVAL 秒按文件的 mtime 和大小检查一次，
+被其他会话或手工修改过的文件会重新加载，并递增 version，
+各会话比较 version 即可得知模式有了变化。
+"""
+import json
+import logging
+import os
+import threading
+import time
+from typing import Dict, Iterable, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+
+class PromptModeRepository:
+    """以目录中的 JSON 文件为数据源、带失效检查的提示模式缓存"""
+
+    # 两次检查目录之间的最短间隔（秒）
+    CHECK_INTERVAL = 1.0
+
+    def __init__(self, config_dir: str, excluded_files: Iterable[str] = ()):
+        self.config_dir = config_dir
+        self.excluded_files = set(excluded_files)
+        # 模式名 -> ((mtime_ns, size), 配置)
+        self._entries: Dict[str, Tuple[Tuple[int, int], Dict[str, str]]] = {}
+        self._names: List[str] = []
+        self._version = 0
+        self._last_check = None
+        self._lock = threading.Lock()
+
+    @property
+    def version(self) -> int:
+        """模式集合或任一模式内容发生变化时递增"""
+        self._refresh_if_stale()
+        return self._version
+
+    def list_modes(self) -> List[str]:
+        """按名称排序的全部模式名"""
+        self._refresh_if_stale()
+        return list(self._names)
+
+    def exists(self, name: str) -> bool:
+        self._refresh_if_stale()
+        return name in self._entries
+
+    def get(self, name: str) -> Optional[Dict[str, str]]:
+        """返回模式配置的副本（调用方可以直接修改），不存在时返回 None"""
+        self._refresh_if_stale()
+        entry = self._entries.get(name)
+        return dict(entry[1]) if entry else None
+
+    def save(self, name: str, config: Dict[str, str]):
+        """写入模式文件（先写临时文件再替换，其他进程不会读到写了一半的文件）并更新缓存"""
+        os.makedirs(self.config_dir, exist_ok=True)
+        filepath = self._path(name)
+        tmp_path = f"{filepath}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(config, f, indent=2, ensure_ascii=False)
+        os.replace(tmp_path, filepath)
+        with self._lock:
+            self._entries[name] = (self._signature(filepath), dict(config))
+            self._changed()
+
+    def delete(self, name: str):
+        """删除模式文件并更新缓存"""
+        filepath = self._path(name)
+        if os.path.exists(filepath):
+            os.remove(filepath)
+        with self._lock:
+            if self._entries.pop(name, None) is not None:
+                self._changed()
+
+    def refresh(self):
+        """立即检查目录，重新加载有变化的模式文件"""
+        with self._lock:
+            self._last_check = time.monotonic()
+            self._scan()
+
+    def _refresh_if_stale(self):
+        if self._last_check is not None and time.monotonic() - self._last_check < self.CHECK_INTERVAL:
+            return
+        self.refresh()
+
+    def _scan(self):
+        """对比文件签名，只解析新增或修改过的文件"""
+        seen = set()
+        changed = False
+        try:
+            entries = list(os.scandir(self.config_dir))
+        except FileNotFoundError:
+            entries = []
+        for entry in entries:
+            if not entry.name.endswith(".json") or entry.name in self.excluded_files:
+                continue
+            name = entry.name[:-len(".json")]
+            seen.add(name)
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                continue
+            signature = (stat.st_mtime_ns, stat.st_size)
+            cached = self._entries.get(name)
+            if cached and cached[0] == signature:
+                continue
+            try:
+                with open(entry.path, 'r', encoding='utf-8') as f:
+                    config = json.load(f)
+            except (OSError, json.JSONDecodeError) as e:
+                logger.warning(f"加载提示模式 '{name}' 失败: {e}")
+                continue
+            self._entries[name] = (signature, config)
+            changed = True
+
+        for name in set(self._entries) - seen:
+            del self._entries[name]
+            changed = True
+        if changed:
+            self._changed()
+
+    def _changed(self):
+        self._names = sorted(self._entries)
+        self._version += 1
+
+    def _path(self, name: str) -> str:
+        return os.path.join(self.config_dir, f"{name}.json")
+
+    @staticmethod
+    def _signature(filepath: str) -> Tuple[int, int]:
+        stat = os.stat(filepath)
+        return (stat.st_mtime_ns, stat.st_size)
@@ -2,117 +2,241 @@
 
 import os
 import json
+import importlib
+import sqlite3
+import threading
+from contextlib import contextmanager
 from datetime import datetime 
-from typing import Dict, List
+from typing import Dict, Iterator, List, Optional
 
-# 从原始项目中导入默认提示
-from prompts.programming_prompts import get_programming_prompts
-from prompts.strategic_prompts import get_strategic_prompts
-from prompts.tutorial_writing_prompts import get_tutorial_writing_prompts
+from user_configs.mode_repository import PromptModeRepository
+from utils.text_search import SearchIndex
 
 CONFIG_DIR = "user_configs"
-os.makedirs(CONFIG_DIR, exist_ok=True)
 
-DEFAULT_PROMPTS = {
-    "编程模式": get_programming_prompts(),
-    "战略分析模式": get_strategic_prompts(),
-    "教程写作模式": get_tutorial_writing_prompts(),
+# 内置模式 -> (模块, 函数)。提示文本很大，只在需要创建对应的模式文件时才导入
+_DEFAULT_PROMPT_SOURCES = {
+    "编程模式": ("prompts.programming_prompts", "get_programming_prompts"),
+    "战略分析模式": ("prompts.strategic_prompts", "get_strategic_prompts"),
+    "教程写作模式": ("prompts.tutorial_writing_prompts", "get_tutorial_writing_prompts"),
 }
 
+def get_default_prompt(name: str) -> Dict[str, str]:
+    """加载一个内置模式的默认提示"""
+    module_name, function_name = _DEFAULT_PROMPT_SOURCES[name]
+    return getattr(importlib.import_module(module_name), function_name)()
+
+def __getattr__(name: str):
+    # 兼容直接访问 DEFAULT_PROMPTS 的代码：访问时才导入全部内置提示
+    if name == "DEFAULT_PROMPTS":
+        return {mode: get_default_prompt(mode) for mode in _DEFAULT_PROMPT_SOURCES}
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+# 进程内共享的提示模式缓存，所有会话的列出/切换模式都不再读盘
+_mode_repository = PromptModeRepository(
+    CONFIG_DIR, excluded_files=['api_config.json', 'prompt_dictionary.json']
+)
+
+def get_mode_repository() -> PromptModeRepository:
+    """进程内共享的提示模式仓库"""
+    return _mode_repository
+
 def initialize_default_prompts():
     """如果默认模式不存在，则创建它们"""
-    for name, content in DEFAULT_PROMPTS.items():
-        filepath = os.path.join(CONFIG_DIR, f"{name}.json")
-        if not os.path.exists(filepath):
-            save_prompt_mode(name, content)
+    for name in _DEFAULT_PROMPT_SOURCES:
+        if not _mode_repository.exists(name):
+            save_prompt_mode(name, get_default_prompt(name))
 
 def save_prompt_mode(name: str, config: Dict[str, str]):
     """将提示模式保存为JSON文件"""
-    filename = f"{name}.json"
-    filepath = os.path.join(CONFIG_DIR, filename)
-    with open(filepath, 'w', encoding='utf-8') as f:
-        json.dump(config, f, indent=2, ensure_ascii=False)
+    _mode_repository.save(name, config)
 
 def load_prompt_mode(name: str) -> Dict[str, str]:
-    """从JSON文件加载提示模式"""
-    filename = f"{name}.json"
-    filepath = os.path.join(CONFIG_DIR, filename)
-    try:
-        with open(filepath, 'r', encoding='utf-8') as f:
-            return json.load(f)
-    except FileNotFoundError:
+    """加载提示模式（返回副本，可直接修改）"""
+    config = _mode_repository.get(name)
+    if config is None:
         return {"cognitive": "", "meta": "", "system": ""}
-
-# user_configs/prompt_manager.py (修改 get_available_modes 函数)
+    return config
 
 def get_available_modes() -> List[str]:
     """获取所有可用的模式名称"""
-    # 需要排除的文件
-    excluded_files = ['api_config.json', 'prompt_dictionary.json']
-    
-    modes = []
-    for f in os.listdir(CONFIG_DIR):
-        if f.endswith(".json") and f not in excluded_files:
-            modes.append(f.replace(".json", ""))
-    
-    return sorted(modes)
+    return _mode_repository.list_modes()
 
 def delete_prompt_mode(name: str):
     """删除一个提示模式"""
-    filepath = os.path.join(CONFIG_DIR, f"{name}.json")
-    if os.path.exists(filepath):
-        os.remove(filepath)
+    _mode_repository.delete(name)
 
 
 PROMPT_DICT_FILE = os.path.join(CONFIG_DIR, "prompt_dictionary.json")
+PROMPT_LIBRARY_DB = os.path.join(CONFIG_DIR, "prompt_library.db")
+
+_PROMPT_LIBRARY_SCHEMA = """
+CREATE TABLE IF NOT EXISTS prompts (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    title TEXT NOT NULL,
+    content TEXT NOT NULL,
+    created TEXT NOT NULL,
+    updated TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS library_meta (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+"""
+
+# 进程内共用的Prompt库连接，首次使用时打开并完成建表和迁移检查；使用期间由锁独占
+_library_conn: Optional[sqlite3.Connection] = None
+_library_lock = threading.Lock()
+
+# 标题和内容的全文索引，与条目的增删改在同一事务中更新
+_prompt_index = SearchIndex("prompt_search")
+
+def _index_text(title: str, content: str) -> str:
+    """参与检索的文本；标题重复一次以提高标题命中的权重"""
+    return f"{title}\n{title}\n{content}"
+
+@contextmanager
+def _library() -> Iterator[sqlite3.Connection]:
+    """
+    取得进程内共用的Prompt库连接，使用期间独占。
+    建表和迁移检查每个进程只执行一次；WAL 模式，跨进程写入通过事务串行化
+    """
+    global _library_conn
+    with _library_lock:
+        if _library_conn is None:
+            os.makedirs(CONFIG_DIR, exist_ok=True)
+            conn = sqlite3.connect(PROMPT_LIBRARY_DB, timeout=10, isolation_level=None, check_same_thread=False)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.executescript(_PROMPT_LIBRARY_SCHEMA)
+            _prompt_index.create_tables(conn)
+            _migrate_json_library(conn)
+            _build_search_index(conn)
+            _library_conn = conn
+        yield _library_conn
+
+def _migrate_json_library(conn: sqlite3.Connection):
+    """首次使用时把旧的 prompt_dictionary.json 导入数据库（保留原有ID），原文件保持不变"""
+    with conn:
+        conn.execute("BEGIN IMMEDIATE")
+        if conn.execute("SELECT 1 FROM library_meta WHERE key = 'json_migrated'").fetchone():
+            return
+        if os.path.exists(PROMPT_DICT_FILE):
+            try:
+                with open(PROMPT_DICT_FILE, 'r', encoding='utf-8') as f:
+                    legacy_prompts = json.load(f)
+            except (OSError, ValueError):
+                legacy_prompts = []
+            conn.executemany(
+                "INSERT OR IGNORE INTO prompts (id, title, content, created, updated) VALUES (?, ?, ?, ?, ?)",
+                [(p['id'], p['title'], p['content'], p['created'], p.get('updated', p['created']))
+                 for p in legacy_prompts]
+            )
+        conn.execute("INSERT INTO library_meta (key, value) VALUES ('json_migrated', ?)",
+                     (datetime.now().isoformat(),))
+
+def _build_search_index(conn: sqlite3.Connection):
+    """为建立索引之前已存在的条目补建全文索引；分词规则变化后按新规则重建（每个版本只执行一次）"""
+    version = str(SearchIndex.TOKENIZER_VERSION)
+    with conn:
+        conn.execute("BEGIN IMMEDIATE")
+        row = conn.execute("SELECT value FROM library_meta WHERE key = 'search_index_version'").fetchone()
+        if row and row['value'] == version:
+            return
+        for row in conn.execute("SELECT id, title, content FROM prompts").fetchall():
+            _prompt_index.index_document(conn, row['id'], _index_text(row['title'], row['content']))
+        conn.execute("INSERT OR REPLACE INTO library_meta (key, value) VALUES ('search_index_version', ?)",
+                     (version,))
+
+def search_prompt_entries(query: str, k: int = 10) -> List[Dict]:
+    """全文检索Prompt条目（BM25排序），返回得分最高的 k 条，每条带 score 字段"""
+    results = []
+    with _library() as conn:
+        for prompt_id, score in _prompt_index.search(conn, query, k=k):
+            row = conn.execute(
+                "SELECT id, title, content, created, updated FROM prompts WHERE id = ?", (prompt_id,)
+            ).fetchone()
+            if row:
+                entry = dict(row)
+                entry['score'] = score
+                results.append(entry)
+    return results
 
 def get_prompt_dictionary() -> List[Dict]:
-    """获取Prompt字典列表"""
-    if not os.path.exists(PROMPT_DICT_FILE):
-        return []
-    try:
-        with open(PROMPT_DICT_FILE, 'r', encoding='utf-8') as f:
-            return json.load(f)
-    except:
-        return []
+    """获取Prompt字典列表（全部条目，按创建顺序）"""
+    with _library() as conn:
+        rows = conn.execute("SELECT id, title, content, created, updated FROM prompts ORDER BY id").fetchall()
+    return [dict(row) for row in rows]
+
+def count_prompt_entries() -> int:
+    """Prompt条目总数"""
+    with _library() as conn:
+        return conn.execute("SELECT COUNT(*) FROM prompts").fetchone()[0]
+
+def get_prompt_page(page: int, per_page: int = 10) -> List[Dict]:
+    """分页获取Prompt条目，只读取当前页"""
+    with _library() as conn:
+        rows = conn.execute(
+            "SELECT id, title, content, created, updated FROM prompts ORDER BY id LIMIT ? OFFSET ?",
+            (per_page, page * per_page)
+        ).fetchall()
+    return [dict(row) for row in rows]
+
+def get_prompt_entry(prompt_id: int) -> Optional[Dict]:
+    """按ID获取单个Prompt条目"""
+    with _library() as conn:
+        row = conn.execute(
+            "SELECT id, title, content, created, updated FROM prompts WHERE id = ?", (prompt_id,)
+        ).fetchone()
+    return dict(row) if row else None
 
 def save_prompt_dictionary(prompts: List[Dict]):
-    """保存整个Prompt字典"""
-    with open(PROMPT_DICT_FILE, 'w', encoding='utf-8') as f:
-        json.dump(prompts, f, indent=2, ensure_ascii=False)
+    """保存整个Prompt字典（整体替换，在一个事务中完成）"""
+    with _library() as conn, conn:
+        conn.execute("BEGIN IMMEDIATE")
+        conn.execute("DELETE FROM prompts")
+        conn.executemany(
+            "INSERT INTO prompts (id, title, content, created, updated) VALUES (?, ?, ?, ?, ?)",
+            [(p['id'], p['title'], p['content'], p['created'], p.get('updated', p['created'])) for p in prompts]
+        )
+        _prompt_index.clear(conn)
+        for p in prompts:
+            _prompt_index.index_document(conn, p['id'], _index_text(p['title'], p['content']))
 
 def add_prompt_entry(title: str, content: str) -> Dict:
-    """添加一个Prompt条目"""
-    prompts = get_prompt_dictionary()
-    new_prompt = {
-        "id": int(datetime.now().timestamp() * 1000),
+    """添加一个Prompt条目，ID由数据库自增分配，不会冲突"""
+    now = datetime.now().isoformat()
+    with _library() as conn, conn:
+        conn.execute("BEGIN IMMEDIATE")
+        cursor = conn.execute(
+            "INSERT INTO prompts (title, content, created, updated) VALUES (?, ?, ?, ?)",
+            (title, content, now, now)
+        )
+        _prompt_index.index_document(conn, cursor.lastrowid, _index_text(title, content))
+    return {
+        "id": cursor.lastrowid,
         "title": title,
         "content": content,
-        "created": datetime.now().isoformat(),
-        "updated": datetime.now().isoformat()
+        "created": now,
+        "updated": now
     }
-    prompts.append(new_prompt)
-    save_prompt_dictionary(prompts)
-    return new_prompt
 
 def update_prompt_entry(prompt_id: int, title: str, content: str) -> bool:
-    """更新Prompt条目"""
-    prompts = get_prompt_dictionary()
-    for i, prompt in enumerate(prompts):
-        if prompt['id'] == prompt_id:
-            prompts[i]['title'] = title
-            prompts[i]['content'] = content
-            prompts[i]['updated'] = datetime.now().isoformat()
-            save_prompt_dictionary(prompts)
-            return True
-    return False
+    """更新Prompt条目（只写一行）"""
+    with _library() as conn, conn:
+        conn.execute("BEGIN IMMEDIATE")
+        cursor = conn.execute(
+            "UPDATE prompts SET title = ?, content = ?, updated = ? WHERE id = ?",
+            (title, content, datetime.now().isoformat(), prompt_id)
+        )
+        if cursor.rowcount > 0:
+            _prompt_index.index_document(conn, prompt_id, _index_text(title, content))
+    return cursor.rowcount > 0
 
 def delete_prompt_entry(prompt_id: int) -> bool:
     """删除Prompt条目"""
-    prompts = get_prompt_dictionary()
-    original_len = len(prompts)
-    prompts = [p for p in prompts if p['id'] != prompt_id]
-    if len(prompts) < original_len:
-        save_prompt_dictionary(prompts)
-        return True
-    return False
+    with _library() as conn, conn:
+        conn.execute("BEGIN IMMEDIATE")
+        cursor = conn.execute("DELETE FROM prompts WHERE id = ?", (prompt_id,))
+        _prompt_index.remove_document(conn, prompt_id)
+    return cursor.rowcount > 0
@@ -0,0 +1,283 @@
+# utils/bulk_export.py
+
+"""
+对话存档批量导出
+
+把 history.db 中的对话导出为分片的 JSONL（每条消息一行，可选 gzip 压缩）
+和/或每个对话一个 Markdown 文件，供分析和合规归档使用。
+
+- 对话按批分给多个进程并行导出，每批写一个分片文件；主进程只保持有限个批次在途，
+  各进程逐行读取、逐行写出，内存占用与存档大小无关
+- 每完成一批就更新检查点，中断后重新运行会跳过已完成的批次
+- 记录上一次导出的截止时间，默认只导出此后有更新的对话。消息的时间戳在写入提交之前生成，
+  时间戳早于截止时间、但在选取之后才提交的消息会落在上一次的范围内，
+  因此每次都向前多选 OVERLAP_SECONDS 秒，并跳过上一次已按相同更新时间导出过的对话
+
+用法（在项目根目录运行）:
+    python -m utils.bulk_export --out output/export
+    python -m utils.bulk_export --out output/export --format jsonl markdown --workers 8 --full
+"""
+import argparse
+import gzip
+import json
+import logging
+import os
+import sqlite3
+import time
+import uuid
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional, Sequence
+
+from conversation.sqlite_history import DEFAULT_DB_PATH, connect
+from utils.markdown_export import MarkdownExporter
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_OUTPUT_DIR = "output/export"
+STATE_FILE = "export_state.json"
+# 每批包含的对话数
+DEFAULT_BATCH_SIZE = 200
+# 增量导出时向上一次截止时间之前多选的秒数，应远大于消息从生成时间戳到提交的最长耗时
+OVERLAP_SECONDS = 300
+
+_worker_conn: Optional[sqlite3.Connection] = None
+
+
+def _init_worker(db_path: str):
+    """工作进程初始化：打开只读连接，整个进程复用"""
+    global _worker_conn
+    _worker_conn = sqlite3.connect(f"file:{db_path}?mode=ro", uri=True)
+    _worker_conn.row_factory = sqlite3.Row
+
+
+def _write_atomic(path: str, write):
+    """先写临时文件再替换，进程被中断时不会留下写了一半的分片"""
+    tmp_path = f"{path}.tmp"
+    write(tmp_path)
+    os.replace(tmp_path, path)
+
+
+def _export_batch(batch_no: int, conversation_ids: List[str], output_dir: str, run_id: str,
+                  formats: Sequence[str], compress: bool) -> Dict[str, int]:
+    """导出一批对话（在工作进程中执行），返回消息数和对话数"""
+    placeholders = ",".join("?" * len(conversation_ids))
+    conversations = {
+        row["id"]: dict(row) for row in _worker_conn.execute(
+            f"SELECT id, title, mode_name, model_name, created, updated FROM conversations "
+            f"WHERE id IN ({placeholders})", conversation_ids
+        )
+    }
+
+    def iter_messages(conversation_id: str):
+        return _worker_conn.execute(
+            "SELECT seq, role, content, reasoning_content, interrupted, tokens, timestamp "
+            "FROM messages WHERE conversation_id = ? ORDER BY seq", (conversation_id,)
+        )
+
+    message_count = 0
+    if "jsonl" in formats:
+        shard_dir = os.path.join(output_dir, "jsonl", run_id)
+        os.makedirs(shard_dir, exist_ok=True)
+        shard_path = os.path.join(shard_dir, f"part-{batch_no:05d}.jsonl" + (".gz" if compress else ""))
+
+        def write_shard(path: str):
+            nonlocal message_count
+            opener = (lambda p: gzip.open(p, "wt", encoding="utf-8", compresslevel=5)) if compress \
+                else (lambda p: open(p, "w", encoding="utf-8"))
+            with opener(path) as f:
+                for conversation_id in conversation_ids:
+                    meta = conversations.get(conversation_id)
+                    if meta is None:
+                        continue
+                    for row in iter_messages(conversation_id):
+                        record = {
+                            "conversation_id": conversation_id,
+                            "title": meta["title"],
+                            "mode_name": meta["mode_name"],
+                            "model_name": meta["model_name"],
+                            "seq": row["seq"],
+                            "role": row["role"],
+                            "content": row["content"],
+                            "reasoning_content": row["reasoning_content"],
+                            "interrupted": bool(row["interrupted"]),
+                            "tokens": row["tokens"],
+                            "timestamp": row["timestamp"],
+                        }
+                        f.write(json.dumps(record, ensure_ascii=False) + "\n")
+                        message_count += 1
+
+        _write_atomic(shard_path, write_shard)
+
+    if "markdown" in formats:
+        markdown_dir = os.path.join(output_dir, "markdown")
+        os.makedirs(markdown_dir, exist_ok=True)
+        for conversation_id, meta in conversations.items():
+            messages = (
+                {k: v for k, v in dict(row).items() if v is not None and k not in ("seq", "tokens")}
+                for row in iter_messages(conversation_id)
+            )
+
+            def write_markdown(path: str):
+                with open(path, "w", encoding="utf-8") as f:
+                    for chunk in MarkdownExporter.iter_markdown(messages, {"model_name": meta["model_name"]}, {}):
+                        f.write(chunk)
+
+            _write_atomic(os.path.join(markdown_dir, f"{conversation_id}.md"), write_markdown)
+
+    return {"batch": batch_no, "messages": message_count, "conversations": len(conversations)}
+
+
+class BulkExporter:
+    """可断点续传、增量的并行导出"""
+
+    def __init__(self, db_path: str = DEFAULT_DB_PATH, output_dir: str = DEFAULT_OUTPUT_DIR,
+                 formats: Sequence[str] = ("jsonl",), compress: bool = True,
+                 workers: Optional[int] = None, batch_size: int = DEFAULT_BATCH_SIZE):
+        self.db_path = db_path
+        self.output_dir = output_dir
+        self.formats = tuple(formats)
+        self.compress = compress
+        self.workers = workers or os.cpu_count() or 1
+        self.batch_size = batch_size
+        self.state_path = os.path.join(output_dir, STATE_FILE)
+
+    def _load_state(self) -> Dict:
+        if not os.path.exists(self.state_path):
+            return {}
+        with open(self.state_path, "r", encoding="utf-8") as f:
+            return json.load(f)
+
+    def _save_state(self, state: Dict):
+        def write(path: str):
+            with open(path, "w", encoding="utf-8") as f:
+                json.dump(state, f, ensure_ascii=False, indent=2)
+        _write_atomic(self.state_path, write)
+
+    def _plan_run(self, since: Optional[str], exported: Optional[Dict[str, str]] = None) -> Dict:
+        """
+        确定本次要导出的对话并分批；批次列表写入检查点，续传时保持不变。
+        since: 上一次的截止时间，实际从它之前 OVERLAP_SECONDS 秒开始选取
+        exported: 上一次导出的、更新时间在重叠范围内的对话 {对话ID: 更新时间}，更新时间未变的跳过
+        """
+        now = datetime.now()
+        cutoff = now.isoformat()
+        lower = (datetime.fromisoformat(since) - timedelta(seconds=OVERLAP_SECONDS)).isoformat() if since else ""
+        exported = exported or {}
+        conn = connect(self.db_path)
+        try:
+            rows = conn.execute(
+                "SELECT id, updated FROM conversations WHERE message_count > 0 AND updated > ? AND updated <= ? "
+                "ORDER BY updated", (lower, cutoff)
+            ).fetchall()
+        finally:
+            conn.close()
+        ids = [row["id"] for row in rows if exported.get(row["id"]) != row["updated"]]
+        # 下一次的重叠范围内的对话，供下一次去重
+        overlap_start = (now - timedelta(seconds=OVERLAP_SECONDS)).isoformat()
+        recent = {row["id"]: row["updated"] for row in rows if row["updated"] > overlap_start}
+        return {
+            "run_id": datetime.now().strftime("%Y%m%d_%H%M%S_") + uuid.uuid4().hex[:6],
+            "since": since,
+            "cutoff": cutoff,
+            "recent": recent,
+            "formats": list(self.formats),
+            "compress": self.compress,
+            "batches": [ids[i:i + self.batch_size] for i in range(0, len(ids), self.batch_size)],
+            "completed": [],
+        }
+
+    def run(self, full: bool = False) -> Dict:
+        """
+        执行导出。
+        full: 忽略上一次的截止时间，导出全部对话
+        Returns:
+            {"run_id", "conversations", "messages", "batches", "seconds"}
+        """
+        os.makedirs(self.output_dir, exist_ok=True)
+        state = self._load_state()
+        run = state.get("current_run")
+        if run is not None and (run["formats"] != list(self.formats) or run["compress"] != self.compress):
+            logger.warning("导出参数与未完成的导出不同，放弃续传并重新开始")
+            run = None
+        if run is None:
+            if full:
+                run = self._plan_run(None)
+            else:
+                run = self._plan_run(state.get("last_cutoff"), state.get("last_recent"))
+            state["current_run"] = run
+            self._save_state(state)
+        else:
+            logger.info(f"继续未完成的导出 {run['run_id']}：已完成 {len(run['completed'])}/{len(run['batches'])} 批")
+
+        started = time.monotonic()
+        completed = set(run["completed"])
+        pending = [(no, ids) for no, ids in enumerate(run["batches"]) if no not in completed]
+        totals = {"conversations": 0, "messages": 0}
+
+        with ProcessPoolExecutor(max_workers=self.workers, initializer=_init_worker,
+                                 initargs=(self.db_path,)) as executor:
+            # 滑动窗口提交，在途批次数有上限，主进程内存不随批次总数增长
+            in_flight = set()
+            queue = iter(pending)
+            max_in_flight = self.workers * 2
+            while True:
+                for no, ids in queue:
+                    in_flight.add(executor.submit(
+                        _export_batch, no, ids, self.output_dir, run["run_id"], self.formats, self.compress
+                    ))
+                    if len(in_flight) >= max_in_flight:
+                        break
+                if not in_flight:
+                    break
+                done, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+                for future in done:
+                    result = future.result()
+                    totals["conversations"] += result["conversations"]
+                    totals["messages"] += result["messages"]
+                    run["completed"].append(result["batch"])
+                self._save_state(state)
+
+        # 全部批次完成：记录截止时间，下次只导出此后有更新的对话
+        state["last_cutoff"] = run["cutoff"]
+        state["last_recent"] = run.get("recent", {})
+        state.pop("current_run", None)
+        state.setdefault("history", []).append({
+            "run_id": run["run_id"], "since": run["since"], "cutoff": run["cutoff"], **totals
+        })
+        self._save_state(state)
+
+        return {
+            "run_id": run["run_id"],
+            "batches": len(run["batches"]),
+            "seconds": round(time.monotonic() - started, 2),
+            **totals,
+        }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="批量导出对话存档")
+    parser.add_argument("--db", default=DEFAULT_DB_PATH, help="历史数据库路径")
+    parser.add_argument("--out", default=DEFAULT_OUTPUT_DIR, help="输出目录")
+    parser.add_argument("--format", nargs="+", choices=["jsonl", "markdown"], default=["jsonl"], help="导出格式")
+    parser.add_argument("--no-gzip", action="store_true", help="JSONL 分片不压缩")
+    parser.add_argument("--workers", type=int, default=None, help="工作进程数，默认为CPU核数")
+    parser.add_argument("--batch-size", type=int, default=DEFAULT_BATCH_SIZE, help="每个分片包含的对话数")
+    parser.add_argument("--full", action="store_true", help="导出全部对话，而不只是上次导出后有更新的")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+    result = BulkExporter(
+        db_path=args.db,
+        output_dir=args.out,
+        formats=args.format,
+        compress=not args.no_gzip,
+        workers=args.workers,
+        batch_size=args.batch_size,
+    ).run(full=args.full)
+    print(f"导出完成 {result['run_id']}: {result['conversations']} 个对话，{result['messages']} 条消息，"
+          f"{result['batches']} 批，用时 {result['seconds']} 秒")
+
+
+if __name__ == "__main__":
+    main()
@@ -2,78 +2,195 @@
 
 """
 Markdown导出工具
+
+导出内容按消息逐段生成（iter_markdown），可以直接流式写入文件或下载响应，
+不必先在内存中拼出整篇文档；界面用的完整文档按对话的消息条数缓存，
+对话没有变化时重新运行脚本不会重复生成。
 """
 import os
+import re
+import threading
+from collections import OrderedDict
 from datetime import datetime
+from typing import Dict, Generator, Iterable, Optional
 # 注意：'from config import config' 已被彻底删除
 
+# 增量导出时写在文件末尾的标记，记录已导出的消息条数
+EXPORT_MARKER = "<!-- exported_messages: {count} -->"
+_EXPORT_MARKER_RE = re.compile(r"\n?<!-- exported_messages: (\d+) -->\n?$")
+# 读取文件末尾的字节数，足以包含标记
+_MARKER_TAIL_BYTES = 128
+
+
 class MarkdownExporter:
     """导出对话为Markdown格式"""
-    
+
+    # 按 (对话ID, 消息条数, 最后一条消息的时间戳, 配置) 缓存生成的完整文档
+    _cache: "OrderedDict[tuple, str]" = OrderedDict()
+    _cache_lock = threading.Lock()
+    MAX_CACHED_DOCUMENTS = 32
+
     @staticmethod
     def export_conversation(messages, api_config, prompt_config, filename=None, output_dir="output/conversations"):
         """
         导出对话到Markdown文件。
         现在接收 api_config 和 prompt_config 作为参数。
+        messages 可以是任意可迭代对象（如 history.iter_messages() 的结果），边生成边写入。
         """
         os.makedirs(output_dir, exist_ok=True)
-        
+
         if not filename:
             timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
             filename = f"conversation_{timestamp}.md"
-        
+
         filepath = os.path.join(output_dir, filename)
-        
+
         # 将配置信息传递给生成函数
-        content = MarkdownExporter._generate_markdown(messages, api_config, prompt_config)
-        
         with open(filepath, 'w', encoding='utf-8') as f:
-            f.write(content)
-        
+            for chunk in MarkdownExporter.iter_markdown(messages, api_config, prompt_config):
+                f.write(chunk)
+
         return filepath
-    
+
+    @staticmethod
+    def append_conversation(filepath, history, api_config, prompt_config) -> int:
+        """
+        增量导出：只把上次导出之后新增的消息追加到已有文件末尾。
+        文件不存在或不是由本方法生成时，完整导出一次。
+        返回本次写入的消息条数。
+        """
+        exported = MarkdownExporter._exported_count(filepath)
+        total = history.count()
+        if exported is None:
+            os.makedirs(os.path.dirname(filepath) or ".", exist_ok=True)
+            with open(filepath, 'w', encoding='utf-8') as f:
+                for chunk in MarkdownExporter.iter_markdown(history.iter_messages(), api_config, prompt_config):
+                    f.write(chunk)
+                f.write("\n" + EXPORT_MARKER.format(count=total) + "\n")
+            return total
+        if exported >= total:
+            return 0
+
+        with open(filepath, 'r+b') as f:
+            # 去掉旧的标记，在其位置续写
+            f.seek(0, os.SEEK_END)
+            size = f.tell()
+            f.seek(max(size - _MARKER_TAIL_BYTES, 0))
+            tail = f.read().decode('utf-8', errors='ignore')
+            marker = _EXPORT_MARKER_RE.search(tail)
+            f.seek(size - len(tail[marker.start():].encode('utf-8')))
+            f.truncate()
+            for message in history.iter_messages(start=exported):
+                block = MarkdownExporter._message_block(message)
+                if block:
+                    f.write(("\n" + block).encode('utf-8'))
+            f.write(("\n" + EXPORT_MARKER.format(count=total) + "\n").encode('utf-8'))
+        return total - exported
+
+    @staticmethod
+    def _exported_count(filepath) -> Optional[int]:
+        """读取文件末尾标记中已导出的消息条数"""
+        if not os.path.exists(filepath):
+            return None
+        with open(filepath, 'rb') as f:
+            f.seek(0, os.SEEK_END)
+            f.seek(max(f.tell() - _MARKER_TAIL_BYTES, 0))
+            tail = f.read().decode('utf-8', errors='ignore')
+        marker = _EXPORT_MARKER_RE.search(tail)
+        return int(marker.group(1)) if marker else None
+
+    @staticmethod
+    def cached_markdown(history, api_config, prompt_config) -> str:
+        """
+        返回整段对话的Markdown文档。
+        按对话ID、消息条数和最后一条消息的时间戳缓存：对话没有新消息时直接返回上次生成的结果。
+        不使用 history.version：它属于历史对象，重新打开同一对话得到的新对象会从 0 重新计数。
+        """
+        last_message = history.get_recent(1)
+        key = (
+            history.conversation_id,
+            history.count(),
+            last_message[0]["timestamp"] if last_message else None,
+            api_config.get('model_name'), api_config.get('temperature'), api_config.get('max_tokens'),
+            tuple(bool(prompt_config.get(layer)) for layer in ("cognitive", "meta", "system")),
+        )
+        with MarkdownExporter._cache_lock:
+            document = MarkdownExporter._cache.get(key)
+            if document is not None:
+                MarkdownExporter._cache.move_to_end(key)
+                return document
+
+        document = "".join(MarkdownExporter.iter_markdown(history.iter_messages(), api_config, prompt_config))
+        with MarkdownExporter._cache_lock:
+            MarkdownExporter._cache[key] = document
+            while len(MarkdownExporter._cache) > MarkdownExporter.MAX_CACHED_DOCUMENTS:
+                MarkdownExporter._cache.popitem(last=False)
+        return document
+
+    @staticmethod
+    def iter_markdown(messages: Iterable[Dict], api_config, prompt_config) -> Generator[str, None, None]:
+        """逐段生成Markdown内容：先是标题和配置信息，之后每条消息一段"""
+        yield MarkdownExporter._header_block(api_config, prompt_config)
+        for msg in messages:
+            block = MarkdownExporter._message_block(msg)
+            if block:
+                yield "\n" + block
+
     @staticmethod
     def _generate_markdown(messages, api_config, prompt_config):
         """
         生成Markdown格式内容。
         使用传入的配置字典，而不是全局config。
         """
+        return "".join(MarkdownExporter.iter_markdown(messages, api_config, prompt_config))
+
+    @staticmethod
+    def _header_block(api_config, prompt_config) -> str:
         lines = []
-        
+
         lines.append("# DeepSeek 对话记录")
         lines.append(f"\n生成时间: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}\n")
-        
+
         # 从传入的字典中获取配置信息
         lines.append("## 配置信息")
         lines.append(f"- 模型: {api_config.get('model_name', 'N/A')}")
         lines.append(f"- 温度: {api_config.get('temperature', 'N/A')}")
         lines.append(f"- 最大令牌: {api_config.get('max_tokens', 'N/A')}")
-        
+
         enabled_prompts = []
         if prompt_config.get("cognitive"): enabled_prompts.append("认知架构")
         if prompt_config.get("meta"): enabled_prompts.append("元提示")
         if prompt_config.get("system"): enabled_prompts.append("系统提示")
-        
+
         lines.append(f"- 启用的提示: {', '.join(enabled_prompts) or '无'}\n")
-        
+
         lines.append("## 对话内容\n")
-        
-        for msg in messages:
-            role = msg.get("role")
-            content = msg.get("content")
-            timestamp = msg.get("timestamp")
-            
-            header = f"### 👤 用户" if role == "user" else f"### 🤖 助手"
-            if role == "system":
-                header = "### ⚙️ 系统提示"
-                lines.append(header)
-                lines.append("```")
-                lines.append(content)
-                lines.append("```\n")
-            elif role in ["user", "assistant"]:
-                 lines.append(header)
-                 if timestamp:
-                     lines.append(f"*{timestamp}*\n")
-                 lines.append(content + "\n")
-        
         return "\n".join(lines)
+
+    @staticmethod
+    def _message_block(msg) -> str:
+        """单条消息的Markdown片段，不导出的消息返回空字符串"""
+        lines = []
+        role = msg.get("role")
+        content = msg.get("content")
+        timestamp = msg.get("timestamp")
+
+        header = f"### 👤 用户" if role == "user" else f"### 🤖 助手"
+        if role == "system":
+            header = "### ⚙️ 系统提示"
+            lines.append(header)
+            lines.append("```")
+            lines.append(content)
+            lines.append("```\n")
+        elif role in ["user", "assistant"]:
+             lines.append(header)
+             if timestamp:
+                 lines.append(f"*{timestamp}*\n")
+             if msg.get("reasoning_content"):
+                 lines.append("<details><summary>💭 思考过程</summary>\n")
+                 lines.append(msg["reasoning_content"])
+                 lines.append("\n</details>\n")
+             lines.append(content + "\n")
+
+        return "\n".join(lines)
+
@@ -0,0 +1,96 @@
+# utils/stream_coalescer.py
+
+"""
+流式输出合并工具
+
+API 每个增量往往只有一两个字符，直接逐个送进 st.write_stream 会导致
+每个增量都触发一次 websocket 消息和整条消息的 Markdown 重新渲染。
+这里在流和界面之间按时间窗口/大小合并增量，首个增量仍立即输出。
+"""
+import time
+from dataclasses import dataclass
+from typing import Any, Dict, Generator, Iterable, Optional
+
+from api.deepseek_client import StreamEvent, CONTENT
+
+
+@dataclass
+class FlushPolicy:
+    """合并策略"""
+    # 时间窗口（秒）：缓冲区中最早的增量最多等待这么久就会输出
+    window: float = 0.04
+    # 缓冲区累计字符数达到该值时立即输出
+    max_chars: int = 512
+    # 遇到换行时立即输出（便于逐行渲染代码块）
+    flush_on_newline: bool = False
+
+    @classmethod
+    def from_config(cls, config: Optional[Dict[str, Any]]) -> "FlushPolicy":
+        """从配置字典创建策略，window_ms 以毫秒为单位"""
+        config = config or {}
+        return cls(
+            window=config.get("window_ms", cls.window * 1000) / 1000,
+            max_chars=config.get("max_chars", cls.max_chars),
+            flush_on_newline=config.get("flush_on_newline", cls.flush_on_newline),
+        )
+
+
+def coalesce_events(events: Iterable[StreamEvent],
+                    policy: Optional[FlushPolicy] = None) -> Generator[StreamEvent, None, None]:
+    """
+    合并连续的同类流式事件。
+    距上次输出已超过一个时间窗口的增量（包括首个增量）直接输出，不增加延迟；
+    其余增量进入缓冲区，在时间窗口到期后随下一个增量一起输出。
+    上游在调用方的线程中读取：下游提前关闭时上游随之同步关闭，
+    被中断的回复在关闭返回前就已保存，不会与下一轮对话同时进行。
+    """
+    policy = policy or FlushPolicy()
+    buffer = []
+    buffered_chars = 0
+    kind = None
+    deadline = 0.0
+    last_flush = float("-inf")
+
+    try:
+        for item in events:
+            now = time.monotonic()
+            if buffer and (item.kind != kind or now >= deadline):
+                yield StreamEvent(kind, "".join(buffer))
+                buffer, buffered_chars = [], 0
+                last_flush = now = time.monotonic()
+
+            if not buffer and now - last_flush >= policy.window:
+                # 空闲了一个窗口以上（或首个增量）：直接输出
+                yield item
+                last_flush = time.monotonic()
+                continue
+
+            if not buffer:
+                kind = item.kind
+                deadline = now + policy.window
+            buffer.append(item.text)
+            buffered_chars += len(item.text)
+            if buffered_chars >= policy.max_chars or (policy.flush_on_newline and "\n" in item.text):
+                yield StreamEvent(kind, "".join(buffer))
+                buffer, buffered_chars = [], 0
+                last_flush = time.monotonic()
+
+        if buffer:
+            yield StreamEvent(kind, "".join(buffer))
+    finally:
+        if hasattr(events, "close"):
+            events.close()
+
+
+def coalesce(chunks: Iterable[str], policy: Optional[FlushPolicy] = None) -> Generator[str, None, None]:
+    """合并纯文本流（如 ConversationManager.chat_stream 的输出）"""
+    def as_events():
+        try:
+            for chunk in chunks:
+                yield StreamEvent(CONTENT, chunk)
+        finally:
+            if hasattr(chunks, "close"):
+                chunks.close()
+
+    for event in coalesce_events(as_events(), policy):
+        yield event.text
@@ -0,0 +1,212 @@
+# utils/text_search.py
+
+"""
+全文检索工具
+
+分词：中日韩文字按相邻双字（bigram）切分，每段末尾的单字也单独索引，拉丁字母和数字按单词切分；
+查询中单独的一个中日韩文字按前缀匹配所有以它开头的词，这样也能检索单字；
+排序：BM25。倒排索引存放在调用方提供的 SQLite 连接中，随文档增删增量更新，
+写入操作不单独开启事务，可以和业务数据的写入放在同一个事务里。
+
+每个词的文档频率单独存放，检索时先据此跳过出现在大部分文档中的常见词，
+每个词最多读取 MAX_POSTINGS_PER_TERM 条（满足过滤条件的）倒排记录，打分、过滤和取前 k 条都在一条 SQL 中完成，
+不带过滤条件时单次检索的开销不随索引规模增长；带过滤条件时为了不漏掉较早的匹配，最多扫描词的全部倒排记录。
+"""
+import math
+import re
+import sqlite3
+from collections import Counter
+from typing import List, Sequence, Tuple
+
+# 假名、CJK 统一汉字、韩文音节和兼容汉字（不含 CJK 标点）
+_CJK_CHARS = "\u3040-\u9fff\uac00-\ud7af\uf900-\ufaff"
+_WORD_RE = re.compile(f"[0-9a-z_]+|[{_CJK_CHARS}]+")
+_CJK_RE = re.compile(f"[{_CJK_CHARS}]")
+
+
+def tokenize(text: str) -> List[str]:
+    """
+    文档分词：CJK 双字切分 + 拉丁单词切分。
+    CJK 段末尾的单字也作为一个词，单字查询按前缀匹配时才能命中段尾的字（如"爱猫"中的"猫"）
+    """
+    tokens = []
+    for word in _WORD_RE.findall(text.lower()):
+        if _CJK_RE.match(word):
+            tokens.extend(word[i:i + 2] for i in range(len(word) - 1))
+            tokens.append(word[-1])
+        else:
+            tokens.append(word)
+    return tokens
+
+
+def tokenize_query(query: str) -> List[str]:
+    """查询分词（去重）：CJK 只取双字，单独的一个 CJK 字保留为单字，检索时按前缀匹配"""
+    terms = []
+    for word in _WORD_RE.findall(query.lower()):
+        if len(word) > 1 and _CJK_RE.match(word):
+            terms.extend(word[i:i + 2] for i in range(len(word) - 1))
+        else:
+            terms.append(word)
+    return list(dict.fromkeys(terms))
+
+
+def _is_prefix_term(term: str) -> bool:
+    return len(term) == 1 and _CJK_RE.match(term) is not None
+
+
+def _prefix_range(char: str) -> Tuple[str, str]:
+    """以 char 开头的词的取值范围 [char, 下一个字符)"""
+    return char, chr(ord(char) + 1)
+
+
+class SearchIndex:
+    """存放在 SQLite 中的增量倒排索引，表名以 name 为前缀"""
+
+    # BM25 参数
+    K1 = 1.2
+    B = 0.75
+    # 出现在超过该比例文档中的词视为常见词；查询中还有其他词时不参与检索
+    MAX_DF_RATIO = 0.2
+    # 每个词最多读取的倒排记录数（优先读取最新的文档）
+    MAX_POSTINGS_PER_TERM = 20000
+    # 分词规则的版本；规则变化后，已有的索引需由调用方重新写入
+    TOKENIZER_VERSION = 2
+
+    def __init__(self, name: str):
+        self.terms_table = f"{name}_terms"
+        self.docs_table = f"{name}_docs"
+        # 每个词的文档频率
+        self.df_table = f"{name}_df"
+        # 文档总数和总长度，随增删维护，避免每次检索都做全表聚合
+        self.stats_table = f"{name}_stats"
+
+    def create_tables(self, conn: sqlite3.Connection):
+        """建表（幂等）；executescript 会先提交当前事务，应在事务之外调用"""
+        conn.executescript(f"""
+            CREATE TABLE IF NOT EXISTS {self.terms_table} (
+                term TEXT NOT NULL,
+                doc_id INTEGER NOT NULL,
+                tf INTEGER NOT NULL,
+                PRIMARY KEY (term, doc_id)
+            ) WITHOUT ROWID;
+            CREATE INDEX IF NOT EXISTS idx_{self.terms_table}_doc ON {self.terms_table}(doc_id);
+            CREATE TABLE IF NOT EXISTS {self.docs_table} (
+                doc_id INTEGER PRIMARY KEY,
+                length INTEGER NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS {self.stats_table} (
+                id INTEGER PRIMARY KEY CHECK (id = 1),
+                docs INTEGER NOT NULL,
+                length INTEGER NOT NULL
+            );
+            INSERT OR IGNORE INTO {self.stats_table} (id, docs, length) VALUES (1, 0, 0);
+            CREATE TABLE IF NOT EXISTS {self.df_table} (
+                term TEXT PRIMARY KEY,
+                df INTEGER NOT NULL
+            ) WITHOUT ROWID;
+        """)
+        # 文档频率表是后来加入的：已有索引时补建
+        if conn.execute(f"SELECT 1 FROM {self.df_table} LIMIT 1").fetchone() is None \
+                and conn.execute(f"SELECT 1 FROM {self.terms_table} LIMIT 1").fetchone() is not None:
+            conn.execute(
+                f"INSERT INTO {self.df_table} (term, df) "
+                f"SELECT term, COUNT(*) FROM {self.terms_table} GROUP BY term"
+            )
+
+    def index_document(self, conn: sqlite3.Connection, doc_id: int, text: str):
+        """写入（或替换）一个文档的索引"""
+        self.remove_document(conn, doc_id)
+        counts = Counter(tokenize(text))
+        length = sum(counts.values())
+        conn.execute(f"INSERT INTO {self.docs_table} (doc_id, length) VALUES (?, ?)", (doc_id, length))
+        conn.execute(
+            f"UPDATE {self.stats_table} SET docs = docs + 1, length = length + ? WHERE id = 1", (length,)
+        )
+        conn.executemany(
+            f"INSERT INTO {self.terms_table} (term, doc_id, tf) VALUES (?, ?, ?)",
+            [(term, doc_id, tf) for term, tf in counts.items()]
+        )
+        conn.executemany(
+            f"INSERT INTO {self.df_table} (term, df) VALUES (?, 1) "
+            f"ON CONFLICT (term) DO UPDATE SET df = df + 1",
+            [(term,) for term in counts]
+        )
+
+    def remove_document(self, conn: sqlite3.Connection, doc_id: int):
+        """删除一个文档的索引"""
+        row = conn.execute(f"SELECT length FROM {self.docs_table} WHERE doc_id = ?", (doc_id,)).fetchone()
+        if row is None:
+            return
+        doc_terms = f"SELECT term FROM {self.terms_table} WHERE doc_id = ?"
+        conn.execute(f"UPDATE {self.df_table} SET df = df - 1 WHERE term IN ({doc_terms})", (doc_id,))
+        conn.execute(f"DELETE FROM {self.df_table} WHERE term IN ({doc_terms}) AND df <= 0", (doc_id,))
+        conn.execute(f"DELETE FROM {self.terms_table} WHERE doc_id = ?", (doc_id,))
+        conn.execute(f"DELETE FROM {self.docs_table} WHERE doc_id = ?", (doc_id,))
+        conn.execute(
+            f"UPDATE {self.stats_table} SET docs = docs - 1, length = length - ? WHERE id = 1", (row[0],)
+        )
+
+    def clear(self, conn: sqlite3.Connection):
+        """清空索引"""
+        conn.execute(f"DELETE FROM {self.terms_table}")
+        conn.execute(f"DELETE FROM {self.docs_table}")
+        conn.execute(f"DELETE FROM {self.df_table}")
+        conn.execute(f"UPDATE {self.stats_table} SET docs = 0, length = 0 WHERE id = 1")
+
+    def search(self, conn: sqlite3.Connection, query: str, k: int = 10,
+               doc_filter: str = "", filter_params: Sequence = ()) -> List[Tuple[int, float]]:
+        """
+        BM25 检索，返回按得分降序的 [(doc_id, score)]。
+        doc_filter: 可选的 SQL 条件（以 d.doc_id 引用文档ID），用于按业务字段过滤候选文档；
+                    在截断每个词的倒排记录之前应用，过滤掉的文档不占用 MAX_POSTINGS_PER_TERM 的名额
+        """
+        terms = tokenize_query(query)
+        if not terms:
+            return []
+        total_docs, total_length = conn.execute(
+            f"SELECT docs, length FROM {self.stats_table} WHERE id = 1"
+        ).fetchone()
+        if not total_docs:
+            return []
+        avg_length = total_length / total_docs
+
+        # 单字的文档频率取所有以它开头的词的文档频率之和（上限为文档总数）
+        df = {}
+        for term in terms:
+            if _is_prefix_term(term):
+                row = conn.execute(
+                    f"SELECT SUM(df) FROM {self.df_table} WHERE term >= ? AND term < ?", _prefix_range(term)
+                ).fetchone()
+            else:
+                row = conn.execute(f"SELECT df FROM {self.df_table} WHERE term = ?", (term,)).fetchone()
+            if row and row[0]:
+                df[term] = min(row[0], total_docs)
+        terms = [term for term in terms if term in df]
+        if not terms:
+            return []
+        # 常见词的 idf 很低，几乎不影响排序，却要读取大量倒排记录；有更有区分度的词时跳过
+        selective = [term for term in terms if df[term] <= total_docs * self.MAX_DF_RATIO]
+        if selective:
+            terms = selective
+
+        # 每个词的倒排记录先按 doc_filter 过滤、再按最新文档优先截断（先截断会漏掉较早的匹配），
+        # 合并后在 SQL 中打分并取前 k 条
+        term_filter = f" AND ({doc_filter})" if doc_filter else ""
+        postings = " UNION ALL ".join(
+            f"SELECT * FROM (SELECT d.doc_id, d.tf, ? AS idf FROM {self.terms_table} d "
+            f"WHERE {'d.term >= ? AND d.term < ?' if _is_prefix_term(term) else 'd.term = ?'}{term_filter} "
+            f"ORDER BY d.doc_id DESC LIMIT ?)"
+            for term in terms
+        )
+        params: List = []
+        for term in terms:
+            idf = math.log(1 + (total_docs - df[term] + 0.5) / (df[term] + 0.5))
+            term_params = _prefix_range(term) if _is_prefix_term(term) else (term,)
+            params.extend((idf, *term_params, *filter_params, self.MAX_POSTINGS_PER_TERM))
+        rows = conn.execute(
+            f"SELECT p.doc_id, SUM(p.idf * p.tf * ? / (p.tf + ? * (1 - ? + ? * l.length / ?))) AS score "
+            f"FROM ({postings}) p JOIN {self.docs_table} l ON l.doc_id = p.doc_id "
+            f"GROUP BY p.doc_id ORDER BY score DESC LIMIT ?",
+            (self.K1 + 1, self.K1, self.B, self.B, avg_length, *params, k)
+        ).fetchall()
+        return [(doc_id, score) for doc_id, score in rows]
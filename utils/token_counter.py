@@ -0,0 +1,54 @@
+# utils/token_counter.py
+
+"""
+Token 计数工具
+"""
+import logging
+
+logger = logging.getLogger(__name__)
+
+# DeepSeek 未公开 tiktoken 兼容的编码，这里使用 cl100k_base 作为近似
+ENCODING_NAME = "cl100k_base"
+
+# 每条消息在对话格式中的固定开销（角色标记、分隔符等）
+MESSAGE_OVERHEAD_TOKENS = 4
+
+_encoding = None
+_encoding_unavailable = False
+
+
+def _get_encoding():
+    """懒加载 tiktoken 编码器，失败时只警告一次"""
+    global _encoding, _encoding_unavailable
+    if _encoding is None and not _encoding_unavailable:
+        try:
+            import tiktoken
+            _encoding = tiktoken.get_encoding(ENCODING_NAME)
+        except Exception as e:
+            _encoding_unavailable = True
+            logger.warning(f"tiktoken 不可用，改用字符数估算token: {e}")
+    return _encoding
+
+
+def estimate_tokens(text: str) -> int:
+    """按字符类型粗略估算token数（无tiktoken时的后备方案）"""
+    if not text:
+        return 0
+    cjk_chars = sum(1 for ch in text if ord(ch) >= 0x2E80)
+    other_chars = len(text) - cjk_chars
+    return int(cjk_chars * 0.6 + other_chars * 0.3) + 1
+
+
+def count_tokens(text: str) -> int:
+    """计算文本的token数"""
+    if not text:
+        return 0
+    encoding = _get_encoding()
+    if encoding is not None:
+        return len(encoding.encode(text, disallowed_special=()))
+    return estimate_tokens(text)
+
+
+def count_message_tokens(content: str) -> int:
+    """计算单条消息的token数（含消息格式开销）"""
+    return count_tokens(content) + MESSAGE_OVERHEAD_TOKENS